@@ -14,6 +14,11 @@ class NotebookSystem:
         """Save task information to the notebook"""
         self.tasks[agent_name] = task_content
         
+    def discard(self, agent_name):
+        """Remove an agent's task and response from the notebook"""
+        self.notebook.pop(agent_name, None)
+        self.tasks.pop(agent_name, None)
+        
     def format_notebook_for_agent(self, exclude_agent=None):
         """Format notebook content, with option to exclude current agent's own content"""
         formatted_content = ""
@@ -7,16 +7,10 @@ from dataclasses import dataclass
 from autogen_agentchat.agents import AssistantAgent
 from autogen_ext.models.openai import OpenAIChatCompletionClient
 
-from memory import load_memory, planer_memory, investigator_memory, log_explorer_memory, metric_explorer_memory, trace_explorer_memory, reasoner_memory
+from memory import agent_memories, load_memory
 
 from prompt import get_prompt_module
-
-prompt_module = get_prompt_module()
-
-system_planer = getattr(prompt_module, "system_planer", "")
-system_investigator = getattr(prompt_module, "system_investigator", "")
-system_explorer = getattr(prompt_module, "system_explorer", "")
-system_reasoner = getattr(prompt_module, "system_reasoner", "")
+from llm_gateway import LLMGateway
 
 
 @dataclass
@@ -70,55 +64,119 @@ model_client =  OpenAIChatCompletionClient(
         temperature=0,
 )
 
-
-
-
-# Planner Agent
-planner_agent = AssistantAgent(
-    name="planner",
-    system_message=system_planer,
-    model_client=model_client,
-)
-
-# Investigator Agent (Controller)
-investigator_agent = AssistantAgent(
-    name="investigator",
-    system_message=system_investigator,
-    model_client=model_client,
+# Client-side limits, set them to the provider quota of each endpoint (None means unlimited)
+llm_gateway = LLMGateway(
+    model_client,
+    max_concurrency=8,
+    requests_per_minute=None,
+    tokens_per_minute=None,
 )
 
-
-metric_explorer = AssistantAgent(
-    name="metric_explorer",
-    description="Agent for exploring metric data",
-    system_message="You are the metric explorer "+system_explorer,
-    model_client=model_client,
+reason_llm_gateway = LLMGateway(
+    reason_model_client,
+    max_concurrency=4,
+    requests_per_minute=None,
+    tokens_per_minute=None,
 )
 
 
-log_explorer = AssistantAgent(
-    name="log_explorer",
-    description="Agent for exploring log data",
-    system_message="You are the log explorer "+system_explorer,
-    model_client=model_client,
-)
-
-
-trace_explorer = AssistantAgent(
-    name="trace_explorer",
-    description="Agent for exploring trace data",
-    system_message="You are the trace explorer "+system_explorer,
-    model_client=model_client,
-)
-
-
-# Reasoner Agent
-reasoner_agent = AssistantAgent(
-    name="reasoner",
-    system_message=system_reasoner,
-    model_client=model_client,
-)
-
-
-
-
+# Prompt module setting holding the system message of each agent, the explorers share one
+SYSTEM_MESSAGES = {
+    "planner": "system_planer",
+    "investigator": "system_investigator",
+    "metric_explorer": "system_explorer",
+    "log_explorer": "system_explorer",
+    "trace_explorer": "system_explorer",
+    "reasoner": "system_reasoner",
+}
+
+
+def system_message(prompt_module, agent_name):
+    """System message of an agent created by create_agents"""
+    message = getattr(prompt_module, SYSTEM_MESSAGES[agent_name], "")
+    if agent_name.endswith("_explorer"):
+        # e.g. "You are the metric explorer "
+        return f"You are the {agent_name.replace('_', ' ')} " + message
+    return message
+
+
+def create_agents(prompt_module=None, memory_scope=None):
+    """
+    Create the conversational agents of one diagnosis
+
+    Each diagnosis gets its own agents (and so its own model contexts), built from the
+    prompt module of the diagnosed dataset. All agents share the process-wide LLM gateways,
+    and each agent retrieves the entries of its long-term memory relevant to every request.
+
+    Args:
+        prompt_module: Prompt module of the dataset, see prompt.get_prompt_module. Bank if None
+        memory_scope: Dataset and window of the current diagnosis, which the agents' memories
+            are restricted to. None for every memory entry
+
+    Returns:
+        dict: Agent name -> AssistantAgent
+    """
+    if prompt_module is None:
+        prompt_module = get_prompt_module()
+    memories = agent_memories(memory_scope)
+
+    # Planner Agent
+    planner_agent = AssistantAgent(
+        name="planner",
+        system_message=system_message(prompt_module, "planner"),
+        model_client=llm_gateway.for_agent("planner"),
+        memory=[memories["planner"]],
+    )
+
+    # Investigator Agent (Controller)
+    investigator_agent = AssistantAgent(
+        name="investigator",
+        system_message=system_message(prompt_module, "investigator"),
+        model_client=llm_gateway.for_agent("investigator"),
+        memory=[memories["investigator"]],
+        model_client_stream=True,
+    )
+
+    metric_explorer = AssistantAgent(
+        name="metric_explorer",
+        description="Agent for exploring metric data",
+        system_message=system_message(prompt_module, "metric_explorer"),
+        model_client=llm_gateway.for_agent("metric_explorer"),
+        memory=[memories["metric_explorer"]],
+        model_client_stream=True,
+    )
+
+    log_explorer = AssistantAgent(
+        name="log_explorer",
+        description="Agent for exploring log data",
+        system_message=system_message(prompt_module, "log_explorer"),
+        model_client=llm_gateway.for_agent("log_explorer"),
+        memory=[memories["log_explorer"]],
+        model_client_stream=True,
+    )
+
+    trace_explorer = AssistantAgent(
+        name="trace_explorer",
+        description="Agent for exploring trace data",
+        system_message=system_message(prompt_module, "trace_explorer"),
+        model_client=llm_gateway.for_agent("trace_explorer"),
+        memory=[memories["trace_explorer"]],
+        model_client_stream=True,
+    )
+
+    # Reasoner Agent
+    reasoner_agent = AssistantAgent(
+        name="reasoner",
+        system_message=system_message(prompt_module, "reasoner"),
+        model_client=llm_gateway.for_agent("reasoner"),
+        memory=[memories["reasoner"]],
+    )
+
+    return {
+        "planner": planner_agent,
+        "investigator": investigator_agent,
+        "metric_explorer": metric_explorer,
+        "log_explorer": log_explorer,
+        "trace_explorer": trace_explorer,
+        "reasoner": reasoner_agent,
+    }
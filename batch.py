@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+import os
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from codegenrca import DIAGNOSIS_TIMEOUT, extract_final_result, get_static_prediction
+from investigation_cache import InvestigationCache
+from query_parser import QueryWindow, parse_query
+from workflow import (
+    CODE_EXECUTORS,
+    CODE_WORK_DIR,
+    DEFAULT_CODE_EXECUTOR,
+    DiagnosisWorkflow,
+    acquire_code_executor,
+    release_code_executor,
+    start_columnar_build,
+)
+
+# Columns of the prediction file, eval/evaluate.py reads "prediction" row by row
+PREDICTION_COLUMNS = ["row_id", "task_index", "instruction", "prediction", "incident"]
+
+
+@dataclass
+class BatchTask:
+    row: int
+    task_index: str
+    instruction: str
+    window: Optional[QueryWindow]
+
+
+@dataclass
+class IncidentGroup:
+    """Queries about the same failure window, diagnosed one after another by one workflow"""
+    name: str
+    window: Optional[QueryWindow]
+    tasks: List[BatchTask] = field(default_factory=list)
+
+    @property
+    def day_dir(self) -> Optional[str]:
+        """Telemetry directory of the incident's day in the executor work_dir"""
+        if self.window is None:
+            return None
+        return os.path.join(CODE_WORK_DIR, self.window.telemetry_dir)
+
+
+def load_tasks(query_file: str, dataset: Optional[str] = None) -> List[BatchTask]:
+    """
+    Read a query file (query/*_query.csv) and parse the window of every query
+
+    Args:
+        query_file: CSV file with task_index and instruction columns
+        dataset: Dataset of the queries (Bank/Market/Telecom), inferred from each query if None
+    """
+    queries = pd.read_csv(query_file)
+    return [
+        BatchTask(row, str(query["task_index"]), query["instruction"], parse_query(query["instruction"], dataset=dataset))
+        for row, query in enumerate(queries.to_dict("records"))
+    ]
+
+
+def group_tasks(tasks: List[BatchTask]) -> List[IncidentGroup]:
+    """
+    Group queries by incident (dataset, system, window) and order the groups by day
+
+    Incidents of the same day are scheduled next to each other, so they run while the day's
+    columnar data is built and in the page cache. A query whose window cannot be parsed is
+    a group of its own.
+
+    Returns:
+        List[IncidentGroup] in scheduling order
+    """
+    groups: Dict[object, IncidentGroup] = {}
+    for task in tasks:
+        if task.window is None:
+            key = ("unparsed", task.row)
+            name = f"row {task.row}"
+        else:
+            key = task.window.incident_key
+            name = f"{task.window.dataset}{' ' + task.window.system if task.window.system else ''} {task.window.describe()}"
+        groups.setdefault(key, IncidentGroup(name, task.window)).tasks.append(task)
+
+    def order(group: IncidentGroup):
+        window = group.window
+        if window is None:
+            return (1, "", "", 0, group.tasks[0].row)
+        return (0, window.dataset, window.system or "", window.start, group.tasks[0].row)
+
+    return sorted(groups.values(), key=order)
+
+
+def load_predictions(output: str) -> Dict[int, dict]:
+    """Predictions already written to the output file, by query row"""
+    if not os.path.exists(output):
+        return {}
+    done = pd.read_csv(output)
+    return {int(row["row_id"]): row for row in done.to_dict("records") if isinstance(row.get("prediction"), str)}
+
+
+def write_predictions(output: str, tasks: List[BatchTask], predictions: Dict[int, dict]) -> None:
+    """Write the predictions in query file order, queries without a prediction are left out"""
+    rows = [predictions[task.row] for task in tasks if task.row in predictions]
+    directory = os.path.dirname(output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    pd.DataFrame(rows, columns=PREDICTION_COLUMNS).to_csv(output + ".tmp", index=False)
+    os.replace(output + ".tmp", output)
+
+
+async def run_group(group: IncidentGroup, predictions: Dict[int, dict], args, on_prediction,
+                    investigation_cache: Optional[InvestigationCache] = None) -> None:
+    """Diagnose the queries of an incident with one workflow, in query file order"""
+    tasks = [task for task in group.tasks if task.row not in predictions]
+    if not tasks:
+        return
+    print(f"[Batch] Incident {group.name}: {len(tasks)} queries")
+    prompt_type = group.window.prompt_type if group.window is not None else None
+    started = time.time()
+
+    def record(task: BatchTask, prediction: Optional[str]) -> None:
+        on_prediction({
+            "row_id": task.row,
+            "task_index": task.task_index,
+            "instruction": task.instruction,
+            "prediction": prediction if prediction is not None else get_static_prediction(),
+            "incident": group.name,
+        })
+
+    try:
+        async with asyncio.timeout(args.timeout):
+            workflow = await DiagnosisWorkflow.create(speculative=args.speculative, prompt_type=prompt_type, executor=args.executor,
+                                                     investigation_cache=investigation_cache, record_memory=args.record_memory)
+    except Exception as e:
+        print(f"[Batch] Workflow creation failed for incident {group.name}: {e}")
+        for task in tasks:
+            record(task, None)
+        return
+
+    async with workflow:
+        for task in tasks:
+            prediction = None
+            try:
+                # Later queries of the incident reuse the investigation of the first one
+                diagnosis_result = await workflow.run_diagnosis(
+                    user_query=task.instruction,
+                    queried_issue="",
+                    reference_books=[""],
+                    timeout=args.timeout,
+                )
+                prediction = extract_final_result(diagnosis_result)
+            except TimeoutError:
+                print(f"[Batch] {task.task_index} (row {task.row}) timed out after {args.timeout / 60:.0f} minutes")
+            except Exception as e:
+                print(f"[Batch] {task.task_index} (row {task.row}) failed: {e}")
+                traceback.print_exc()
+            record(task, prediction)
+    print(f"[Batch] Incident {group.name} done in {time.time() - started:.1f}s")
+
+
+async def prefetch_days(groups: List[IncidentGroup]) -> None:
+    """Build the columnar data of the batch's days one after another, in scheduling order"""
+    seen = set()
+    for group in groups:
+        day_dir = group.day_dir
+        if day_dir is None or day_dir in seen or not os.path.isdir(day_dir):
+            continue
+        seen.add(day_dir)
+        try:
+            await start_columnar_build(day_dir)
+        except Exception as e:
+            print(f"[Batch] Columnar build of {day_dir} failed: {e}")
+
+
+async def run_batch(args) -> Dict[int, dict]:
+    tasks = load_tasks(args.queries, args.dataset)
+    if args.limit is not None:
+        tasks = tasks[:args.limit]
+    groups = group_tasks(tasks)
+    predictions = load_predictions(args.output) if args.resume else {}
+    days = {group.day_dir for group in groups if group.day_dir is not None}
+    print(f"[Batch] {len(tasks)} queries, {len(groups)} incidents on {len(days)} days, "
+          f"{len(predictions)} already predicted, {args.concurrency} incidents at a time")
+
+    # The queries of an incident share its investigation, see investigation_cache.py
+    investigation_cache = None if args.no_investigation_reuse else InvestigationCache(args.investigation_cache)
+
+    def on_prediction(row: dict) -> None:
+        predictions[row["row_id"]] = row
+        write_predictions(args.output, tasks, predictions)
+
+    # The executor stays warm for the whole batch, not only while an incident runs
+    await acquire_code_executor(args.executor)
+    prefetch = asyncio.create_task(prefetch_days(groups))
+    queue: asyncio.Queue = asyncio.Queue()
+    for group in groups:
+        queue.put_nowait(group)
+
+    async def worker():
+        while not queue.empty():
+            group = queue.get_nowait()
+            await run_group(group, predictions, args, on_prediction, investigation_cache)
+
+    started = time.time()
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(args.concurrency, 1))))
+    finally:
+        prefetch.cancel()
+        await release_code_executor(args.executor)
+    write_predictions(args.output, tasks, predictions)
+    print(f"[Batch] {len(predictions)}/{len(tasks)} queries predicted in {time.time() - started:.1f}s, saved to {args.output}")
+    return predictions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Diagnose a query file, grouping queries by incident and day")
+    parser.add_argument("--queries", type=str, default="query/bank_query.csv", help="Query file (task_index, instruction)")
+    parser.add_argument("--dataset", type=str, default=None, choices=["Bank", "Market", "Telecom"], help="Dataset of the queries, inferred from each query if omitted")
+    parser.add_argument("--output", type=str, default="predictions.csv", help="Prediction file, can be scored with eval/evaluate.py")
+    parser.add_argument("--concurrency", type=int, default=1, help="Incidents diagnosed at the same time")
+    parser.add_argument("--timeout", type=float, default=DIAGNOSIS_TIMEOUT, help="Seconds a single diagnosis may take")
+    parser.add_argument("--executor", type=str, default=DEFAULT_CODE_EXECUTOR, choices=CODE_EXECUTORS, help="Code executor backend shared by the batch")
+    parser.add_argument("--speculative", action="store_true", help="Run the standard window scans while the planner is thinking")
+    parser.add_argument("--resume", action="store_true", help="Keep the predictions already in the output file and skip their queries")
+    parser.add_argument("--investigation-cache", type=str, default=None, help="Directory to save the investigations in, so later batches can reuse them")
+    parser.add_argument("--no-investigation-reuse", action="store_true", help="Investigate every query, even if its failure window has been investigated")
+    parser.add_argument("--record-memory", action="store_true", help="Add the unverified answers to long-term memory (memory_store.jsonl), off for benchmark runs")
+    parser.add_argument("--limit", type=int, default=None, help="Only diagnose the first N queries of the file")
+    args = parser.parse_args()
+
+    asyncio.run(run_batch(args))
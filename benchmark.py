@@ -0,0 +1,427 @@
+import argparse
+import ast
+import json
+import math
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+import telemetry
+from query_parser import QueryWindow, make_window
+
+# Window sizes the tools are run with, in minutes
+DEFAULT_WINDOW_MINUTES = [15, 30, 60, 120]
+
+# A tool whose net run time grows faster than window_size ** SUPERLINEAR_EXPONENT is flagged
+SUPERLINEAR_EXPONENT = 1.3
+
+# Growth is only judged for tools that take at least this long on the largest window,
+# below it interpreter start-up and noise dominate
+MIN_GROWTH_SECONDS = 1.0
+
+# Query windows of the datasets are aligned to half hours
+WINDOW_ALIGNMENT = 30 * 60
+
+# Tools written against the window constants (see prompt.WorkflowPrompt.tool_window_prompt) can be re-windowed
+REQUIRED_WINDOW_PARAMETERS = ("WINDOW_START", "WINDOW_END")
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+# Prepended to every tool: counts the rows parsed by pandas.read_csv and the CSV files opened
+PROBE = '''
+import atexit as _bench_atexit
+import json as _bench_json
+import os as _bench_os
+import pandas as _bench_pd
+
+_bench_stats = {"rows_scanned": 0, "files": set()}
+_bench_read_csv = _bench_pd.read_csv
+
+
+class _BenchReader:
+    def __init__(self, reader):
+        self._reader = reader
+
+    def __iter__(self):
+        for chunk in self._reader:
+            _bench_stats["rows_scanned"] += len(chunk)
+            yield chunk
+
+    def __next__(self):
+        chunk = next(self._reader)
+        _bench_stats["rows_scanned"] += len(chunk)
+        return chunk
+
+    def get_chunk(self, size=None):
+        chunk = self._reader.get_chunk(size)
+        _bench_stats["rows_scanned"] += len(chunk)
+        return chunk
+
+    def __enter__(self):
+        self._reader.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._reader.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self._reader, name)
+
+
+def _bench_counting_read_csv(filepath_or_buffer, *args, **kwargs):
+    if isinstance(filepath_or_buffer, (str, _bench_os.PathLike)) and _bench_os.path.isfile(filepath_or_buffer):
+        _bench_stats["files"].add(_bench_os.path.abspath(filepath_or_buffer))
+    result = _bench_read_csv(filepath_or_buffer, *args, **kwargs)
+    if isinstance(result, _bench_pd.DataFrame):
+        _bench_stats["rows_scanned"] += len(result)
+        return result
+    return _BenchReader(result)
+
+
+_bench_pd.read_csv = _bench_counting_read_csv
+
+
+@_bench_atexit.register
+def _bench_dump():
+    files = sorted(_bench_stats["files"])
+    with open(_bench_os.environ["CODEGENRCA_BENCH_STATS"], "w") as f:
+        _bench_json.dump({
+            "rows_scanned": _bench_stats["rows_scanned"],
+            "files": len(files),
+            "csv_bytes": sum(_bench_os.path.getsize(path) for path in files),
+        }, f)
+'''
+
+
+@dataclass
+class Tool:
+    name: str
+    description: str
+    code: str
+
+    @property
+    def windowed(self) -> bool:
+        """True if the tool reads its window from the window constants"""
+        assigned = _constant_assignments(self.code)
+        return all(name in assigned for name in REQUIRED_WINDOW_PARAMETERS)
+
+
+@dataclass
+class RunResult:
+    tool: str
+    date: str
+    window_minutes: Optional[float]
+    start: Optional[int]
+    end: Optional[int]
+    wall_seconds: float
+    peak_rss_mb: float
+    rows_scanned: Optional[int]
+    files: Optional[int]
+    csv_bytes: Optional[int]
+    exit_code: int
+    timed_out: bool
+
+
+def load_tools(path: str = "generated_functions.py", select: Optional[str] = None) -> List[Tool]:
+    """
+    Load the tools of the tool store
+
+    Args:
+        path: Tool store written by code_utils.save_code_as_functions
+        select: Regular expression, only tools whose name or description matches it are loaded
+
+    Returns:
+        List[Tool] with the tool bodies as standalone scripts
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        source = f.read()
+    lines = source.split("\n")
+    tools = []
+    for node in ast.parse(source).body:
+        if not isinstance(node, ast.FunctionDef) or not node.name.startswith("function_"):
+            continue
+        docstring = ast.get_docstring(node) or ""
+        match = re.search(r"Tool description:\s*(.*)", docstring, re.S)
+        description = " ".join(match.group(1).split()) if match else ""
+        body = node.body[1:] if docstring else node.body
+        if not body:
+            continue
+        code = textwrap.dedent("\n".join(lines[body[0].lineno - 1:node.end_lineno]))
+        if select and not (re.search(select, node.name) or re.search(select, description)):
+            continue
+        tools.append(Tool(node.name, description, code))
+    return tools
+
+
+def _constant_assignments(code: str) -> Dict[str, ast.Assign]:
+    """Module-level `NAME = <literal>` assignments of a tool"""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return {}
+    assignments = {}
+    for node in tree.body:
+        if (isinstance(node, ast.Assign) and len(node.targets) == 1
+                and isinstance(node.targets[0], ast.Name) and isinstance(node.value, ast.Constant)):
+            assignments[node.targets[0].id] = node
+    return assignments
+
+
+def apply_window(code: str, window: QueryWindow) -> str:
+    """
+    Point a tool at another diagnosis window by rewriting its window constants
+
+    Args:
+        code: Tool source with the constants of tool_window_prompt at module level
+        window: The window to run the tool on
+
+    Returns:
+        str: The rewritten source
+    """
+    parameters = window.tool_parameters()
+    lines = code.split("\n")
+    assignments = _constant_assignments(code)
+    # Replace from the end of the file so earlier line numbers stay valid
+    for name, node in sorted(assignments.items(), key=lambda item: item[1].lineno, reverse=True):
+        if name in parameters:
+            indent = lines[node.lineno - 1][:node.col_offset]
+            lines[node.lineno - 1:node.end_lineno] = [f"{indent}{name} = {parameters[name]!r}"]
+    return "\n".join(lines)
+
+
+def load_windows(
+    records: List[str],
+    dataset: str,
+    system: Optional[str] = None,
+    window_minutes: List[float] = DEFAULT_WINDOW_MINUTES,
+    dates: Optional[List[str]] = None,
+    limit: Optional[int] = None,
+) -> List[List[QueryWindow]]:
+    """
+    Build the benchmark windows around the failures of record files
+
+    Every failure gives an anchor, the start of its half-hour query window. Each anchor is
+    benchmarked with windows of every size starting at the anchor.
+
+    Args:
+        records: record.csv files (columns timestamp and datetime)
+        dataset: Dataset of the records (Bank/Market/Telecom)
+        system: Market system of the records, e.g. cloudbed-1
+        window_minutes: Window sizes in minutes
+        dates: Only use failures of these days (YYYY_MM_DD)
+        limit: Maximum number of anchors
+
+    Returns:
+        One list of windows (ascending size) per anchor
+    """
+    anchors = []
+    for path in records:
+        for timestamp in pd.read_csv(path)["timestamp"]:
+            anchor = int(timestamp) // WINDOW_ALIGNMENT * WINDOW_ALIGNMENT
+            if anchor not in anchors:
+                anchors.append(anchor)
+    windows = []
+    for anchor in anchors:
+        sizes = [make_window(dataset, anchor, anchor + int(minutes * 60), system=system) for minutes in sorted(window_minutes)]
+        if dates and sizes[0].date_dir not in dates:
+            continue
+        windows.append(sizes)
+        if limit is not None and len(windows) >= limit:
+            break
+    return windows
+
+
+def run_code(code: str, work_dir: str, timeout: float) -> Dict[str, object]:
+    """
+    Run a tool as a script in its own process, the way the code executor runs it
+
+    Args:
+        code: Tool source
+        work_dir: Working directory of the run, the code executor's work_dir
+        timeout: Seconds after which the run is killed
+
+    Returns:
+        dict with wall_seconds, peak_rss_mb, exit_code, timed_out and the probe counters
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, "tool.py")
+        stats_path = os.path.join(tmp, "stats.json")
+        with open(script, "w", encoding="utf-8") as f:
+            f.write(PROBE + "\n" + code + "\n")
+        env = dict(os.environ, CODEGENRCA_BENCH_STATS=stats_path)
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.abspath(work_dir), env.get("PYTHONPATH")]))
+
+        with open(os.path.join(tmp, "output.txt"), "w") as output:
+            start = time.perf_counter()
+            process = subprocess.Popen([sys.executable, script], cwd=work_dir, stdout=output, stderr=subprocess.STDOUT, env=env)
+            timed_out = threading.Event()
+
+            def kill():
+                timed_out.set()
+                process.kill()
+
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+            # wait4 reports the resource usage of this child alone
+            _, status, usage = os.wait4(process.pid, 0)
+            wall_seconds = time.perf_counter() - start
+            timer.cancel()
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        stats = {"rows_scanned": None, "files": None, "csv_bytes": None}
+        if os.path.exists(stats_path):
+            with open(stats_path) as f:
+                stats.update(json.load(f))
+        return {
+            "wall_seconds": round(wall_seconds, 3),
+            "peak_rss_mb": round(usage.ru_maxrss * RSS_UNIT / 2**20, 1),
+            "exit_code": process.returncode,
+            "timed_out": timed_out.is_set(),
+            **stats,
+        }
+
+
+def growth_exponent(sizes: List[float], costs: List[float]) -> Optional[float]:
+    """
+    Exponent k of cost ~ size ** k, fitted in log-log space
+
+    Returns:
+        The exponent, or None with fewer than two distinct sizes of positive cost
+    """
+    points = [(math.log(size), math.log(cost)) for size, cost in zip(sizes, costs) if size > 0 and cost > 0]
+    if len({x for x, _ in points}) < 2:
+        return None
+    mean_x = statistics.fmean(x for x, _ in points)
+    mean_y = statistics.fmean(y for _, y in points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / sum((x - mean_x) ** 2 for x, _ in points)
+
+
+def benchmark_tool(tool: Tool, windows: List[List[QueryWindow]], work_dir: str, timeout: float) -> List[RunResult]:
+    """Run a tool on every benchmark window, or once if it does not use the window constants"""
+    if not tool.windowed:
+        print(f"[Benchmark] {tool.name} does not use the window constants, running it once on its own window")
+        result = run_code(tool.code, work_dir, timeout)
+        print(f"[Benchmark] {tool.name}: {result['wall_seconds']}s, {result['peak_rss_mb']} MB, {result['rows_scanned']} rows, exit code {result['exit_code']}")
+        return [RunResult(tool.name, "", None, None, None, **result)]
+
+    results = []
+    for sizes in windows:
+        for window in sizes:
+            result = run_code(apply_window(tool.code, window), work_dir, timeout)
+            minutes = (window.end - window.start) / 60
+            print(f"[Benchmark] {tool.name} {window.describe()}: {result['wall_seconds']}s, {result['peak_rss_mb']} MB, {result['rows_scanned']} rows, exit code {result['exit_code']}")
+            results.append(RunResult(tool.name, window.date_dir, minutes, window.start, window.end, **result))
+            if result["timed_out"]:
+                # Larger windows will not be faster
+                break
+    return results
+
+
+def summarize(tool: Tool, results: List[RunResult], baseline_seconds: float,
+              max_exponent: float = SUPERLINEAR_EXPONENT, min_seconds: float = MIN_GROWTH_SECONDS) -> Dict[str, object]:
+    """
+    Summarize the runs of a tool and judge how its cost grows with the window size
+
+    Args:
+        tool: The benchmarked tool
+        results: Its runs
+        baseline_seconds: Wall time of an empty tool, subtracted before fitting the growth
+        max_exponent: Growth exponent above which the tool is flagged
+        min_seconds: Net seconds on the largest window below which growth is not judged
+
+    Returns:
+        dict with the run statistics, the time and rows growth exponents and the flag
+    """
+    succeeded = [result for result in results if result.exit_code == 0]
+    time_exponents, row_exponents = [], []
+    for date, start in {(result.date, result.start) for result in succeeded if result.window_minutes}:
+        runs = sorted((result for result in succeeded if (result.date, result.start) == (date, result.start)),
+                      key=lambda result: result.window_minutes)
+        sizes = [result.window_minutes for result in runs]
+        net_seconds = [max(result.wall_seconds - baseline_seconds, 0.0) for result in runs]
+        if net_seconds and net_seconds[-1] >= min_seconds:
+            exponent = growth_exponent(sizes, net_seconds)
+            if exponent is not None:
+                time_exponents.append(exponent)
+        exponent = growth_exponent(sizes, [result.rows_scanned or 0 for result in runs])
+        if exponent is not None:
+            row_exponents.append(exponent)
+
+    time_exponent = statistics.median(time_exponents) if time_exponents else None
+    return {
+        "tool": tool.name,
+        "description": tool.description[:80],
+        "windowed": tool.windowed,
+        "runs": len(results),
+        "failed": len(results) - len(succeeded),
+        "timed_out": sum(result.timed_out for result in results),
+        "median_seconds": round(statistics.median(result.wall_seconds for result in results), 2) if results else None,
+        "max_seconds": max((result.wall_seconds for result in results), default=None),
+        "max_rss_mb": max((result.peak_rss_mb for result in results), default=None),
+        "max_rows_scanned": max((result.rows_scanned or 0 for result in results), default=None),
+        "time_exponent": round(time_exponent, 2) if time_exponent is not None else None,
+        "rows_exponent": round(statistics.median(row_exponents), 2) if row_exponents else None,
+        "superlinear": time_exponent is not None and time_exponent > max_exponent,
+    }
+
+
+def run_benchmark(args) -> pd.DataFrame:
+    telemetry.install(args.work_dir)
+    tools = load_tools(args.tools, args.select)
+    windows = load_windows(args.records, args.dataset, args.system, args.windows, args.dates, args.limit)
+    print(f"[Benchmark] {len(tools)} tools, {len(windows)} anchors x {len(args.windows)} window sizes")
+
+    baseline = run_code("pass", args.work_dir, args.timeout)
+    print(f"[Benchmark] Baseline (interpreter and pandas start-up): {baseline['wall_seconds']}s, {baseline['peak_rss_mb']} MB")
+
+    runs, summaries = [], []
+    for tool in tools:
+        results = benchmark_tool(tool, windows, args.work_dir, args.timeout)
+        runs.extend(results)
+        summaries.append(summarize(tool, results, baseline["wall_seconds"], args.max_exponent, args.min_seconds))
+
+    if args.output:
+        pd.DataFrame([asdict(result) for result in runs]).to_csv(args.output, index=False)
+        print(f"[Benchmark] Runs saved to {args.output}")
+
+    summary = pd.DataFrame(summaries)
+    print("--------------------------------Benchmark Summary--------------------------------")
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(summary.drop(columns=["description"]).to_string(index=False) if not summary.empty else "No tools benchmarked")
+    for row in summaries:
+        if row["superlinear"]:
+            print(f"[Benchmark] WARNING {row['tool']} run time grows with window size ** {row['time_exponent']} "
+                  f"(> {args.max_exponent}): {row['description']}")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the generated tools on the OpenRCA datasets")
+    parser.add_argument("--tools", type=str, default="generated_functions.py", help="Tool store to benchmark")
+    parser.add_argument("--select", type=str, default=None, help="Regular expression selecting tools by name or description")
+    parser.add_argument("--records", type=str, nargs="+", default=["query/record.csv"], help="record.csv files the benchmark windows are taken from")
+    parser.add_argument("--dataset", type=str, default="Bank", choices=["Bank", "Market", "Telecom"], help="Dataset of the records")
+    parser.add_argument("--system", type=str, default=None, help="Market system of the records, e.g. cloudbed-1")
+    parser.add_argument("--dates", type=str, nargs="+", default=None, help="Only benchmark these days (YYYY_MM_DD)")
+    parser.add_argument("--windows", type=float, nargs="+", default=DEFAULT_WINDOW_MINUTES, help="Window sizes in minutes")
+    parser.add_argument("--limit", type=int, default=3, help="Maximum number of failure windows per tool")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds after which a run is killed")
+    parser.add_argument("--work-dir", type=str, default="coding", help="Working directory of the runs (the code executor's work_dir)")
+    parser.add_argument("--max-exponent", type=float, default=SUPERLINEAR_EXPONENT, help="Growth exponent above which a tool is flagged")
+    parser.add_argument("--min-seconds", type=float, default=MIN_GROWTH_SECONDS, help="Net seconds on the largest window below which growth is not judged")
+    parser.add_argument("--output", type=str, default="benchmark.csv", help="CSV file the individual runs are saved to")
+    args = parser.parse_args()
+
+    summary = run_benchmark(args)
+    sys.exit(1 if not summary.empty and summary["superlinear"].any() else 0)
@@ -0,0 +1,184 @@
+import asyncio
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, Optional
+
+# Assumed cost of a step before it has been observed, in seconds and tokens
+DEFAULT_STEP_SECONDS = {
+    "plan": 120.0,
+    "round": 240.0,
+    "refine": 90.0,
+    "retry": 30.0,
+    "reason": 180.0,
+}
+DEFAULT_STEP_TOKENS = {
+    "plan": 8000,
+    "round": 30000,
+    "refine": 10000,
+    "retry": 5000,
+    "reason": 20000,
+}
+
+
+@dataclass
+class StepStats:
+    count: int = 0
+    seconds: float = 0.0
+    tokens: int = 0
+
+    def mean_seconds(self, default: float) -> float:
+        return self.seconds / self.count if self.count else default
+
+    def mean_tokens(self, default: int) -> float:
+        return self.tokens / self.count if self.count else default
+
+
+class StepMark:
+    """Start of a measured step, see BudgetScheduler.begin"""
+
+    def __init__(self, step: str, started: float, tokens: int):
+        self.step = step
+        self.started = started
+        self.tokens = tokens
+
+
+class BudgetScheduler:
+    """
+    Time and token budget of a diagnosis
+
+    The scheduler learns how long and how many tokens each kind of step takes (an
+    investigation round, a coder refine attempt, an explorer retry, ...) and allows
+    another step only if it is expected to finish before the reasoning stage has to
+    start, i.e. before the deadline minus the time reserved for reasoning. Hard limits
+    such as the maximum number of rounds stay in place, the budget can only stop earlier.
+
+    Statistics are kept across diagnoses of the same workflow, so estimates improve over
+    a batch of incidents.
+
+    Args:
+        safety_factor: Multiplier applied to estimated step durations and token counts
+        plan_share: Maximum share of the time before the reasoning deadline spent on planning
+        max_reason_share: Maximum share of the whole time budget reserved for reasoning
+    """
+
+    def __init__(self, safety_factor: float = 1.2, plan_share: float = 0.25, max_reason_share: float = 0.5):
+        self.safety_factor = safety_factor
+        self.plan_share = plan_share
+        self.max_reason_share = max_reason_share
+        self.stats: Dict[str, StepStats] = {step: StepStats() for step in DEFAULT_STEP_SECONDS}
+        self.deadline: Optional[float] = None
+        self.token_budget: Optional[int] = None
+        self.started = 0.0
+        self._tokens_used: Callable[[], int] = lambda: 0
+        self._token_offset = 0
+
+    @staticmethod
+    def now() -> float:
+        return asyncio.get_running_loop().time()
+
+    def start(self, deadline: Optional[float], token_budget: Optional[int] = None, tokens_used: Optional[Callable[[], int]] = None) -> None:
+        """
+        Start the budget of a new diagnosis
+
+        Args:
+            deadline: Event loop time by which the diagnosis must finish, None for no time limit
+            token_budget: Tokens the diagnosis may use, None for no limit
+            tokens_used: Returns the running token count the budget is checked against
+        """
+        self.deadline = deadline
+        self.token_budget = token_budget
+        self.started = self.now()
+        if tokens_used is not None:
+            self._tokens_used = tokens_used
+        self._token_offset = self._tokens_used()
+
+    def tokens_used(self) -> int:
+        """Tokens used by the current diagnosis"""
+        return self._tokens_used() - self._token_offset
+
+    def estimate_seconds(self, step: str) -> float:
+        return self.stats[step].mean_seconds(DEFAULT_STEP_SECONDS[step]) * self.safety_factor
+
+    def estimate_tokens(self, step: str) -> float:
+        return self.stats[step].mean_tokens(DEFAULT_STEP_TOKENS[step]) * self.safety_factor
+
+    def reasoning_deadline(self) -> Optional[float]:
+        """Time by which the investigation must end so that reasoning can still finish"""
+        if self.deadline is None:
+            return None
+        reserve = min(self.estimate_seconds("reason"), (self.deadline - self.started) * self.max_reason_share)
+        return self.deadline - max(reserve, 0.0)
+
+    def planning_deadline(self) -> Optional[float]:
+        """Time by which planning must end"""
+        reasoning_deadline = self.reasoning_deadline()
+        if reasoning_deadline is None:
+            return None
+        return self.started + max(reasoning_deadline - self.started, 0.0) * self.plan_share
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left before the reasoning deadline, None for no time limit"""
+        reasoning_deadline = self.reasoning_deadline()
+        if reasoning_deadline is None:
+            return None
+        return reasoning_deadline - self.now()
+
+    def allow(self, step: str, label: str = "") -> bool:
+        """
+        Decide whether another step of the given kind fits in the budget
+
+        Args:
+            step: Kind of step, e.g. "round", "refine" or "retry"
+            label: Who asks, used in the log message
+
+        Returns:
+            bool: True if the step is expected to finish within the time and token budget
+        """
+        remaining = self.remaining()
+        needed = self.estimate_seconds(step)
+        if remaining is not None and remaining < needed:
+            print(f"[Budget] No time for another {step}{' of ' + label if label else ''}: {remaining:.0f}s left before reasoning, about {needed:.0f}s needed")
+            return False
+        if self.token_budget is not None:
+            # Tokens of the reasoning stage are reserved as well
+            left = self.token_budget - self.tokens_used() - self.estimate_tokens("reason")
+            needed_tokens = self.estimate_tokens(step)
+            if left < needed_tokens:
+                print(f"[Budget] No tokens for another {step}{' of ' + label if label else ''}: {max(left, 0):.0f} left after the reasoning reserve, about {needed_tokens:.0f} needed")
+                return False
+        return True
+
+    def begin(self, step: str) -> StepMark:
+        """Mark the start of a step, pass the mark to end() when it is done"""
+        return StepMark(step, self.now(), self._tokens_used())
+
+    def end(self, mark: StepMark) -> None:
+        """Record the duration and token usage of a step started with begin()"""
+        self.record(mark.step, self.now() - mark.started, self._tokens_used() - mark.tokens)
+
+    def record(self, step: str, seconds: float, tokens: int = 0) -> None:
+        stats = self.stats[step]
+        stats.count += 1
+        stats.seconds += seconds
+        stats.tokens += max(tokens, 0)
+
+    @contextmanager
+    def measure(self, step: str) -> Iterator[None]:
+        """Record the duration and token usage of the enclosed step"""
+        mark = self.begin(step)
+        try:
+            yield
+        finally:
+            self.end(mark)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Observed count, mean seconds and mean tokens per step"""
+        return {
+            step: {
+                "count": stats.count,
+                "mean_seconds": round(stats.mean_seconds(0.0), 1),
+                "mean_tokens": round(stats.mean_tokens(0), 1),
+            }
+            for step, stats in self.stats.items()
+            if stats.count
+        }
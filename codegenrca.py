@@ -1,19 +1,18 @@
 import asyncio
-from workflow import DiagnosisWorkflow
+from workflow import CODE_EXECUTORS, DEFAULT_CODE_EXECUTOR, DiagnosisWorkflow
+from investigation_cache import InvestigationCache
 import pprint
 import re
 import json
 import os
 import sys
 import time
-import signal
 import argparse  # Add argparse import
 
-# Add a timeout handler decorator
-def timeout_handler(signum, frame):
-    raise TimeoutError("Function execution timeout (exceeded 30 minutes)")
+# Time limit of one diagnosis, in seconds
+DIAGNOSIS_TIMEOUT = 1800
 
-async def run_rca(instruction=None, dataset=None, record_idx=None, model=None, groundtruth_reason=None):
+async def run_rca(instruction=None, dataset=None, record_idx=None, model=None, groundtruth_reason=None, speculative=False, prompt_type=None, timeout=DIAGNOSIS_TIMEOUT, trace_path=None, trace_format=None, executor=DEFAULT_CODE_EXECUTOR, investigation_cache=None, record_memory=False):
     """
     RCA (Root Cause Analysis) entry function for the CodeGenRCA diagnosis system
     
@@ -21,6 +20,16 @@ async def run_rca(instruction=None, dataset=None, record_idx=None, model=None, g
         instruction: User-provided diagnosis instruction, if None then use default instruction
         dataset: Dataset name, used for generating output filename
         record_idx: Record index, used for generating output filename
+        speculative: Run the standard window scans while the planner is thinking
+        prompt_type: Dataset prompt set (bank, market, telecom), detected from the instruction if None
+        timeout: Seconds the diagnosis may take, including workflow creation. Only this diagnosis
+            is cancelled when it runs out of time, so several can run concurrently in one process
+        trace_path: Write the spans of the diagnosis (agent calls, tool runs, refine attempts) to this file
+        trace_format: "chrome" or "otlp", by default "otlp" for *.otlp.json files and "chrome" otherwise
+        executor: Code executor backend, "docker" or "local" (sandboxed subprocesses, for trusted runs)
+        investigation_cache: InvestigationCache of earlier diagnoses, a query about an already
+            investigated failure window goes straight to the reasoning stage
+        record_memory: Add the answer to the long-term memory of later diagnoses
         
     Returns:
         str: Root cause analysis result
@@ -29,14 +38,15 @@ async def run_rca(instruction=None, dataset=None, record_idx=None, model=None, g
     final_result = None
     
     try:
-        # Set 30-minute timeout
-        signal.signal(signal.SIGALRM, timeout_handler)
-        signal.alarm(1800)  
+        # The deadline is shared by workflow creation and the diagnosis itself
+        deadline = asyncio.get_running_loop().time() + timeout
         
         # Direct output to terminal without capturing
         print("[DEBUG] Starting workflow creation...")
         try:
-            async with await DiagnosisWorkflow.create() as workflow:
+            async with asyncio.timeout_at(deadline):
+                workflow = await DiagnosisWorkflow.create(speculative=speculative, prompt_type=prompt_type, executor=executor, investigation_cache=investigation_cache, record_memory=record_memory)
+            async with workflow:
                 print("[DEBUG] Workflow created successfully")
                 # If no instruction is provided, use default instruction
                 if instruction is None:
@@ -49,14 +59,15 @@ async def run_rca(instruction=None, dataset=None, record_idx=None, model=None, g
                 
                 print(f"[Execution Start] Processing instruction: {user_query}")
                 print(f"[Dataset: {dataset}, Record Index: {record_idx}]")
-                print(f"[Timeout limit set: 30 minutes]")
+                print(f"[Timeout limit set: {timeout / 60:.0f} minutes]")
                 
                 try:
                     start_time = time.time()
                     diagnosis_result = await workflow.run_diagnosis(
                         user_query=user_query,
                         queried_issue=queried_issue,
-                        reference_books=reference_books
+                        reference_books=reference_books,
+                        deadline=deadline
                     )
                     end_time = time.time()
                     print(f"[Execution Complete] Time taken: {end_time - start_time:.2f} seconds")
@@ -64,13 +75,14 @@ async def run_rca(instruction=None, dataset=None, record_idx=None, model=None, g
                     print("[Main] Diagnosis Result:")
                     pprint.pprint(diagnosis_result)
                     
-                    final_result = diagnosis_result["root_cause"]
-                    if "```json" in final_result:
-                        final_result = re.search(r"```json\n(.*)\n```", final_result, re.S).group(1).strip()
+                    final_result = extract_final_result(diagnosis_result)
                     
                     print("--------------------------------Final Result--------------------------------")
                     print(final_result)
                     print("--------------------------------Final Result--------------------------------")
+                except TimeoutError:
+                    print(f"Diagnosis process timeout: exceeded {timeout / 60:.0f} minutes")
+                    final_result = None
                 except Exception as inner_e:
                     print(f"[ERROR] Error during diagnosis execution: {str(inner_e)}")
                     print(f"[ERROR] Error type: {type(inner_e).__name__}")
@@ -78,6 +90,12 @@ async def run_rca(instruction=None, dataset=None, record_idx=None, model=None, g
                     print(f"[ERROR] Full traceback:")
                     traceback.print_exc()
                     final_result = None
+                finally:
+                    if trace_path:
+                        workflow.export_trace(trace_path, trace_format)
+        except TimeoutError:
+            print(f"Diagnosis process timeout: exceeded {timeout / 60:.0f} minutes during workflow creation")
+            final_result = None
         except Exception as workflow_e:
             print(f"[ERROR] Error during workflow creation: {str(workflow_e)}")
             print(f"[ERROR] Error type: {type(workflow_e).__name__}")
@@ -85,10 +103,6 @@ async def run_rca(instruction=None, dataset=None, record_idx=None, model=None, g
             traceback.print_exc()
             final_result = None
         
-        # Disable timeout alarm
-        signal.alarm(0)
-        
-        
         # If final_result is None (possibly due to ignored exceptions during code execution), use static prediction
         if final_result is None:
             print("--------------------------------final_result is empty--------------------------------")
@@ -97,16 +111,7 @@ async def run_rca(instruction=None, dataset=None, record_idx=None, model=None, g
             
         return final_result
             
-    except TimeoutError as te:
-        print(f"Diagnosis process timeout: {str(te)}")
-        # Return a timeout prediction result
-        static_result = get_static_prediction()
-        print(f"Returning static prediction result: {static_result}")
-        return static_result
     except Exception as e:
-        # Ensure timeout alarm is disabled
-        signal.alarm(0)
-        
         print(f"[ERROR] Error during diagnosis process: {str(e)}")
         print(f"[ERROR] Error type: {type(e).__name__}")
         import traceback
@@ -117,6 +122,13 @@ async def run_rca(instruction=None, dataset=None, record_idx=None, model=None, g
         print(f"[FALLBACK] Returning static prediction result: {static_result}")
         return static_result
 
+def extract_final_result(diagnosis_result):
+    """Return the root cause answer of a diagnosis, without the ```json fence around it"""
+    final_result = diagnosis_result["root_cause"]
+    if "```json" in final_result:
+        final_result = re.search(r"```json\n(.*)\n```", final_result, re.S).group(1).strip()
+    return final_result
+
 def get_static_prediction():
     """Return a static prediction result for testing the evaluation system"""
     return json.dumps({
@@ -129,6 +141,13 @@ if __name__ == "__main__":
     # Set up argument parser
     parser = argparse.ArgumentParser(description='CodeGenRCA RCA System')
     parser.add_argument('--query', type=str, help='The RCA query to process')
+    parser.add_argument('--speculative', action='store_true', help='Run the standard window scans while the planner is thinking')
+    parser.add_argument('--dataset', type=str, default=None, help='Dataset of the query (bank, market, telecom), detected from the query if omitted')
+    parser.add_argument('--trace', type=str, default=None, help='Write a trace of the diagnosis to this file')
+    parser.add_argument('--trace-format', type=str, default=None, choices=['chrome', 'otlp'], help='Trace file format, by default otlp for *.otlp.json files and chrome otherwise')
+    parser.add_argument('--executor', type=str, default=DEFAULT_CODE_EXECUTOR, choices=CODE_EXECUTORS, help='Run generated tools in a Docker container or in sandboxed local subprocesses (trusted runs only)')
+    parser.add_argument('--record-memory', action='store_true', help='Add the answer to the long-term memory of later diagnoses (memory_store.jsonl)')
+    parser.add_argument('--investigation-cache', type=str, default=None, help='Directory of saved investigations, a query about an already investigated failure window skips planning and investigation')
     args = parser.parse_args()
 
     print("--------------------------------Execution Start--------------------------------")
@@ -136,7 +155,7 @@ if __name__ == "__main__":
     # Use the query from command line if provided, otherwise use default
     query = args.query if args.query else "On March 10, 2021, between 15:00 and 15:30, two system failures were encountered. The components responsible for these failures and the reasons behind them are not yet known. Please identify the root cause components and the root cause reasons."
     
-    final_result = asyncio.run(run_rca(instruction=query))
+    final_result = asyncio.run(run_rca(instruction=query, speculative=args.speculative, prompt_type=args.dataset, trace_path=args.trace, trace_format=args.trace_format, executor=args.executor, investigation_cache=InvestigationCache(args.investigation_cache) if args.investigation_cache else None, record_memory=args.record_memory))
     print("--------------------------------Final Result--------------------------------")
     print(final_result)
     print("--------------------------------Final Result--------------------------------")
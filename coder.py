@@ -2,7 +2,7 @@ import re
 import logging
 import os
 from dataclasses import dataclass
-from typing import List
+from typing import Dict, List, Optional, Tuple
 from autogen_core import AgentId
 from autogen_core import MessageContext, RoutedAgent, default_subscription, message_handler
 from autogen_core.code_executor import CodeBlock, CodeExecutor
@@ -40,21 +40,30 @@ logger.propagate = False
 
 from prompt import get_prompt_module
 from NoteBook import NotebookSystem
+from param_sweep import extract_tunable_parameters, sweep_parameters, swap_code_block
+from tracing import Tracer, add_token_usage
+from cost_analysis import analyze_code_blocks, format_cost_issues, is_blocking
 
-prompt_module = get_prompt_module()
+# Coder settings read from the prompt module of a diagnosis, with the defaults used when a module does not define them
+PROMPT_DEFAULTS = {
+    "metric_system_coder": "",
+    "log_system_coder": "",
+    "trace_system_coder": "",
+    "log_refine_rules": "",
+    "metric_refine_rules": "",
+    "trace_refine_rules": "",
+    "metric_anomaly_events_max_count": 30,
+    "metric_anomaly_events_min_count": 5,
+    "trace_anomaly_events_max_count": 5,
+    "trace_anomaly_events_min_count": 0,
+    "log_anomaly_events_max_count": 3,
+    "log_anomaly_events_min_count": 0,
+}
 
-metric_system_coder = getattr(prompt_module, "metric_system_coder", "")
-log_system_coder = getattr(prompt_module, "log_system_coder", "")
-trace_system_coder = getattr(prompt_module, "trace_system_coder", "")
-log_refine_rules = getattr(prompt_module, "log_refine_rules", "")
-metric_refine_rules = getattr(prompt_module, "metric_refine_rules", "")
-trace_refine_rules = getattr(prompt_module, "trace_refine_rules", "")
-metric_anomaly_events_max_count = getattr(prompt_module, "metric_anomaly_events_max_count", 30)
-metric_anomaly_events_min_count = getattr(prompt_module, "metric_anomaly_events_min_count", 5)
-trace_anomaly_events_max_count = getattr(prompt_module, "trace_anomaly_events_max_count", 5)
-trace_anomaly_events_min_count = getattr(prompt_module, "trace_anomaly_events_min_count", 0)
-log_anomaly_events_max_count = getattr(prompt_module, "log_anomaly_events_max_count", 3)
-log_anomaly_events_min_count = getattr(prompt_module, "log_anomaly_events_min_count", 0)
+
+def prompt_setting(prompt_module, name):
+    """Read a coder setting from a prompt module, falling back to PROMPT_DEFAULTS"""
+    return getattr(prompt_module, name, PROMPT_DEFAULTS[name])
 
 
 
@@ -66,46 +75,36 @@ class Message:
 
 @default_subscription
 class Coder(RoutedAgent):
-    _instances = {}  
     _notebook = NotebookSystem()  
-    _llm_call_count = 0
-    _token_usage = {
-        "prompt": 0,
-        "completion": 0,
-        "total": 0
-    }
     
-    def __init__(self, model_client: ChatCompletionClient, name: str = "coder") -> None:
+    def __init__(self, model_client: ChatCompletionClient, name: str = "coder", prompt_module=None, tracer: Tracer = None) -> None:
         super().__init__("An Coder agent.")
         self._model_client = model_client
         self._name = name  
+        self._tracer = tracer or Tracer()
         self._chat_history: List[LLMMessage] = [
             SystemMessage(
-                content=log_anomaly_events_min_count,
+                content=prompt_setting(prompt_module or get_prompt_module(), "log_anomaly_events_min_count"),
             )
         ]
-        Coder._instances[name if name else id(self)] = self  
-
-    @staticmethod
-    def get_chat_history(instance_name=None):
-        if instance_name and instance_name in Coder._instances:  
-            return Coder._instances[instance_name]._chat_history
-        elif len(Coder._instances) > 0:
-            return next(iter(Coder._instances.values()))._chat_history
-        return []
-    
-    @staticmethod
-    def get_llm_call_count():
+        # Per instance, every workflow runtime has its own coders
+        self._llm_call_count = 0
+        self._token_usage = {"prompt": 0, "completion": 0, "total": 0}
+
+    def get_chat_history(self) -> List[LLMMessage]:
+        return self._chat_history
+
+    def get_llm_call_count(self) -> int:
         """Get LLM call count"""
-        return Coder._llm_call_count
-    
-    @staticmethod
-    def get_token_usage():
-        """Get token usage statistics"""
-        return Coder._token_usage
+        return self._llm_call_count
 
+    def get_token_usage(self) -> Dict[str, int]:
+        """Get token usage statistics"""
+        return self._token_usage
 
-           
+    def reset(self) -> None:
+        """Drop the conversation of earlier diagnoses, keeping the system message"""
+        self._chat_history = self._chat_history[:1]
 
     @message_handler
     async def handle_message(self, message: Message, ctx: MessageContext) -> None:
@@ -129,25 +128,14 @@ class Coder(RoutedAgent):
         
         if not is_success:
             # Increase LLM call count
-            Coder._llm_call_count += 1
-            print(f"[LLM Call Statistics] {self._name} called LLM, Total: {Coder._llm_call_count}")
-            
-            result = await self._model_client.create(self._chat_history)
+            self._llm_call_count += 1
+            print(f"[LLM Call Statistics] {self._name} called LLM, Total: {self._llm_call_count}")
             
-            # Check and update token usage statistics
-            if hasattr(result, 'usage'):
-                # RequestUsage format token statistics
-                prompt_tokens = getattr(result.usage, 'prompt_tokens', 0)
-                completion_tokens = getattr(result.usage, 'completion_tokens', 0)
-                
-                # Calculate total tokens
-                total_tokens = prompt_tokens + completion_tokens
-                
-                Coder._token_usage["prompt"] += prompt_tokens
-                Coder._token_usage["completion"] += completion_tokens
-                Coder._token_usage["total"] += total_tokens
-                
-                print(f"[Token Statistics] {self._name}: prompt={prompt_tokens}, completion={completion_tokens}, total={total_tokens}, cumulative={Coder._token_usage['total']}")
+            with self._tracer.span(self._name, "llm", agent=self._name) as span:
+                result = await self._model_client.create(self._chat_history, cancellation_token=ctx.cancellation_token)
+                prompt_tokens, completion_tokens = self._tracer.record_llm(span, self._name, result.usage, result.content)
+            add_token_usage(self._token_usage, prompt_tokens, completion_tokens)
+            print(f"[Token Statistics] {self._name}: prompt={prompt_tokens}, completion={completion_tokens}, total={prompt_tokens + completion_tokens}, cumulative={self._token_usage['total']}")
             
             logger.coder(f"\n{'-'*80}\n{self._name} Assistant:\n{result.content}")
             self._chat_history.append(AssistantMessage(content=result.content, source="assistant"))
@@ -160,7 +148,8 @@ class Coder(RoutedAgent):
 
             await self.send_message(
                 coder_message,
-                recipient=AgentId("executor", "default")
+                recipient=AgentId("executor", "default"),
+                cancellation_token=ctx.cancellation_token
             )
 
 
@@ -223,6 +212,15 @@ def compress_duplicate_messages(output: str) -> str:
             
     return '\n'.join(final_lines)
 
+# Assignment of the anomaly events list a tool prints, see extract_anomaly_events
+ANOMALY_EVENTS_PATTERN = re.compile(r'(anomaly_events|anomaly_event|events|anomalies)\s*=\s*\[')
+
+
+def reports_anomaly_events(output: str) -> bool:
+    """True if the output contains an anomaly events list, even an empty one"""
+    return ANOMALY_EVENTS_PATTERN.search(output) is not None
+
+
 def extract_anomaly_events(output: str) -> list:
     """
     Extract anomaly events list from output results
@@ -370,29 +368,34 @@ def extract_anomaly_events(output: str) -> list:
 
 @default_subscription
 class Executor(RoutedAgent):
-    def __init__(self, code_executor: CodeExecutor) -> None:
+    def __init__(self, code_executor: CodeExecutor, prompt_module=None, budget=None, tracer: Tracer = None) -> None:
         super().__init__("An executor agent.")
         self._code_executor = code_executor
+        # Records code executions, refine attempts and their decisions
+        self._tracer = tracer or Tracer()
+        # Refine rules and anomaly event bounds of the diagnosed dataset
+        self._prompt_module = prompt_module or get_prompt_module()
+        # BudgetScheduler of the workflow, decides whether another refine attempt is affordable
+        self._budget = budget
+        self._refine_marks = {}  # Start of the current refine attempt per coder
+        self._refine_spans = {}  # Span of the current refine attempt per coder
         self.execution_result = None
         self.execution_code = None
         self._max_output_length = 50000  # Set maximum output length limit
         self._max_anomaly_events = 20  # Add maximum anomaly events limit
         self._refine_count = {}  # Add retry counter dictionary
         self._max_refine_attempts = 3  # Maximum retry attempts
-        Executor._instance = self
+        self._max_sweep_evaluations = 8  # Maximum local runs of a parameter sweep per refine
+        self._cost_rejected = set()  # Coders whose last code was sent back by the static cost analysis
 
-    @staticmethod
-    def get_execution_result():
+    def get_execution_result(self):
         """
         Get execution result and remove pip installation and other noise information
         
         Returns:
             str: Cleaned execution result
         """
-        if not Executor._instance:
-            return None
-            
-        result = Executor._instance.execution_result
+        result = self.execution_result
         if not result:
             return None
             
@@ -435,23 +438,125 @@ class Executor(RoutedAgent):
                 
         return '\n'.join(cleaned_lines)
     
-    @staticmethod
-    def get_execution_code():
+    def get_execution_code(self):
         """
         Get executed code blocks
         
         Returns:
             List[CodeBlock]: Returns list of code blocks
         """
-        if not Executor._instance or not Executor._instance.execution_code:
+        if not self.execution_code:
             return None
             
-        if isinstance(Executor._instance.execution_code, list):
+        if isinstance(self.execution_code, list):
             return [block if isinstance(block, CodeBlock) else 
                    CodeBlock(code=block['code'], language=block['language']) 
-                   for block in Executor._instance.execution_code]
+                   for block in self.execution_code]
         return None
     
+    def _start_refine(self, coder_name: str, reason: str) -> None:
+        """Count a refine attempt of a coder and start measuring it for the budget and the trace"""
+        self._refine_count[coder_name] += 1
+        if self._budget is not None:
+            self._refine_marks[coder_name] = self._budget.begin("refine")
+        self._refine_spans[coder_name] = self._tracer.start_span(
+            f"{coder_name} refine", "refine", agent=coder_name,
+            attempt=self._refine_count[coder_name], reason=reason,
+        )
+
+    async def _execute(self, coder_name: str, code_blocks: List[CodeBlock], ctx: MessageContext, name: str = "execute"):
+        """Run code blocks in the code executor, recorded as an exec span"""
+        with self._tracer.span(name, "exec", agent=coder_name, blocks=len(code_blocks)) as span:
+            result = await self._code_executor.execute_code_blocks(
+                code_blocks, cancellation_token=ctx.cancellation_token
+            )
+            span.set(exit_code=result.exit_code, output_bytes=len(result.output.encode("utf-8")))
+            if result.exit_code != 0:
+                span.outcome = "failed"
+        return result
+
+    async def _reject_slow_code(self, coder_name: str, code_blocks: List[CodeBlock], ctx: MessageContext) -> bool:
+        """
+        Check code for slow idioms before it is executed and send rewrite hints to the coder
+
+        Code is sent back at most once in a row, the rewritten code is executed even if the
+        analysis still finds issues, so a false positive costs one refine attempt at most.
+
+        Args:
+            coder_name: Coder that wrote the code
+            code_blocks: Python blocks about to be executed
+            ctx: Message context, used for cancellation
+
+        Returns:
+            bool: True if the code was sent back instead of being executed
+        """
+        issues = analyze_code_blocks(code_blocks)
+        if not issues:
+            self._cost_rejected.discard(coder_name)
+            return False
+        report = format_cost_issues(issues)
+        logger.coder(f"\n{'-'*80}\nCost analysis of {coder_name}:\n{report}")
+        if (not is_blocking(issues) or coder_name in self._cost_rejected
+                or self._refine_count[coder_name] >= self._max_refine_attempts
+                or (self._budget is not None and not self._budget.allow("refine", coder_name))):
+            self._cost_rejected.discard(coder_name)
+            self._tracer.event("cost analysis", agent=coder_name, decision="execute", issues=len(issues))
+            return False
+        self._cost_rejected.add(coder_name)
+        self._tracer.event("cost analysis", agent=coder_name, decision="refine", issues=len(issues),
+                           rules=sorted({issue.rule for issue in issues}))
+        self._start_refine(coder_name, "slow code")
+        print(f"\n{'-'*80}\nExecutor:\n{report} (Attempt {self._refine_count[coder_name]}/{self._max_refine_attempts})")
+        await self.send_message(
+            Message(content=f"{report}\n(Attempt {self._refine_count[coder_name]}/{self._max_refine_attempts})"),
+            recipient=AgentId(coder_name, "default"),
+            cancellation_token=ctx.cancellation_token
+        )
+        return True
+
+    async def _sweep_event_count(self, coder_name: str, code_blocks: List[CodeBlock], min_count: int, max_count: int, ctx: MessageContext,
+                                 baseline: Optional[Tuple[int, str]] = None):
+        """
+        Run a local sweep over the tunable parameters declared by the tool
+
+        Args:
+            coder_name: Coder whose tool is swept
+            code_blocks: Code blocks of the coder's last message
+            min_count: Minimum acceptable anomaly event count
+            max_count: Maximum acceptable anomaly event count
+            ctx: Message context, used for cancellation
+            baseline: (event count, output) of the last execution, which ran the tool with its default values
+
+        Returns:
+            SweepResult with a `code_blocks` attribute, or None if no block declares tunable parameters
+        """
+        # The last Python block declaring parameters is the detection tool
+        index = None
+        for i, block in enumerate(code_blocks):
+            if block.language.lower() in ['python', 'py'] and extract_tunable_parameters(block.code):
+                index = i
+        if index is None:
+            return None
+        language = code_blocks[index].language
+
+        async def run(source: str):
+            result = await self._execute(coder_name, [CodeBlock(code=source, language=language)], ctx, name="sweep execute")
+            return result.output, result.exit_code
+
+        def count_events(output: str) -> int:
+            truncated, is_truncated = truncate_output(output, self._max_output_length)
+            if is_truncated:
+                return max_count + 1
+            return len(extract_anomaly_events(truncated))
+
+        sweep = await sweep_parameters(
+            code_blocks[index].code, run, count_events, min_count, max_count,
+            max_evaluations=self._max_sweep_evaluations, baseline=baseline,
+        )
+        if sweep is not None:
+            sweep.code_blocks = swap_code_block(code_blocks, index, sweep.code)
+        return sweep
+
     @message_handler
     async def handle_message(self, message: Message, ctx: MessageContext) -> None:
         coder_name = message.content.split(':\n')[0]  
@@ -459,6 +564,12 @@ class Executor(RoutedAgent):
         if coder_name not in self._refine_count:
             self._refine_count[coder_name] = 0
         
+        # A message following a refine request closes that refine attempt
+        if self._budget is not None and coder_name in self._refine_marks:
+            self._budget.end(self._refine_marks.pop(coder_name))
+        if coder_name in self._refine_spans:
+            self._tracer.finish(self._refine_spans.pop(coder_name))
+        
         code_blocks = extract_markdown_code_blocks(message.content)
         execute_code_blocks = []
         for code_block in code_blocks:
@@ -466,10 +577,11 @@ class Executor(RoutedAgent):
                 execute_code_blocks.append(code_block)
                 
 
+        if execute_code_blocks and await self._reject_slow_code(coder_name, execute_code_blocks, ctx):
+            return
+
         if execute_code_blocks:
-            result = await self._code_executor.execute_code_blocks(
-                execute_code_blocks, cancellation_token=ctx.cancellation_token
-            )
+            result = await self._execute(coder_name, execute_code_blocks, ctx)
             
             # compressed_output = compress_duplicate_messages(result.output)
             truncated_output,is_truncated = truncate_output(result.output,self._max_output_length)
@@ -477,11 +589,18 @@ class Executor(RoutedAgent):
             logger.coder(f"\n{'-'*80}\nExecutor:\n{truncated_output}")
             
             if len(result.output) > 5:
+                stop_reason = None
                 if self._refine_count[coder_name] >= self._max_refine_attempts:
-                    print(f"Maximum retry attempts ({self._max_refine_attempts}) reached, will use current result. Execution result:\n" + "<success>"+truncated_output+"</success>")
+                    stop_reason = f"Maximum retry attempts ({self._max_refine_attempts}) reached"
+                elif self._budget is not None and not self._budget.allow("refine", coder_name):
+                    stop_reason = "No time or token budget left for another attempt"
+                if stop_reason:
+                    self._tracer.event("refine decision", agent=coder_name, decision="stop", reason=stop_reason)
+                    print(f"{stop_reason}, will use current result. Execution result:\n" + "<success>"+truncated_output+"</success>")
                     await self.send_message(
-                        Message(content=f"Maximum retry attempts ({self._max_refine_attempts}) reached, will use current result. Execution result:\n" + "<success>"+truncated_output+"</success>"),
-                        recipient=AgentId(coder_name, "default")
+                        Message(content=f"{stop_reason}, will use current result. Execution result:\n" + "<success>"+truncated_output+"</success>"),
+                        recipient=AgentId(coder_name, "default"),
+                        cancellation_token=ctx.cancellation_token
                     )
                     self.execution_result = truncated_output
                     if code_blocks[-1].language.lower() in ['python', 'py']:
@@ -490,9 +609,9 @@ class Executor(RoutedAgent):
                     return
 
                 if result.exit_code != 0:
-                    self._refine_count[coder_name] += 1  # Increase retry count
+                    self._start_refine(coder_name, "execution failed")
                     system_prompt = "When executing, code blocks will be executed sequentially, so if you need to install libraries, please install them in the first code block. Most standard Python environments do not support direct use of `!pip install` statements. You should avoid using this syntax and try to use subprocess to install required Python packages. If you are solving an error, you only need to provide the modified code. Please note that since all code blocks in your output will be executed to verify correctness, please ensure that the content in the output code blocks must be correct and executable. The execution failed with the following error:" + truncated_output
-                    await self.send_message(Message(content=system_prompt),recipient=AgentId(coder_name, "default" ))
+                    await self.send_message(Message(content=system_prompt),recipient=AgentId(coder_name, "default" ),cancellation_token=ctx.cancellation_token)
                 else:
                     # Extract anomaly events list
                     try:
@@ -505,23 +624,23 @@ class Executor(RoutedAgent):
                     
                     # Select different refine_rules and thresholds based on different coders
                     if coder_name.lower().startswith('log'):
-                        refine_rules = log_refine_rules
-                        min_count = log_anomaly_events_min_count  # Should have at least 3 anomalies
-                        max_count = log_anomaly_events_max_count  # No more than 15 anomalies
+                        refine_rules = prompt_setting(self._prompt_module, "log_refine_rules")
+                        min_count = prompt_setting(self._prompt_module, "log_anomaly_events_min_count")  # Should have at least 3 anomalies
+                        max_count = prompt_setting(self._prompt_module, "log_anomaly_events_max_count")  # No more than 15 anomalies
                         # Text length threshold (fallback mechanism)
                         min_length = 0
                         max_length = 600
                     elif coder_name.lower().startswith('metric'):
-                        refine_rules = metric_refine_rules
-                        min_count = metric_anomaly_events_min_count  # Should have at least 5 anomalies
-                        max_count = metric_anomaly_events_max_count  # No more than 25 anomalies
+                        refine_rules = prompt_setting(self._prompt_module, "metric_refine_rules")
+                        min_count = prompt_setting(self._prompt_module, "metric_anomaly_events_min_count")  # Should have at least 5 anomalies
+                        max_count = prompt_setting(self._prompt_module, "metric_anomaly_events_max_count")  # No more than 25 anomalies
                         # Text length threshold (fallback mechanism)
                         min_length = 500
                         max_length = 10000
                     elif coder_name.lower().startswith('trace'):
-                        refine_rules = trace_refine_rules
-                        min_count = trace_anomaly_events_min_count  # Should have at least 3 anomalies
-                        max_count = trace_anomaly_events_max_count  # No more than 15 anomalies
+                        refine_rules = prompt_setting(self._prompt_module, "trace_refine_rules")
+                        min_count = prompt_setting(self._prompt_module, "trace_anomaly_events_min_count")  # Should have at least 3 anomalies
+                        max_count = prompt_setting(self._prompt_module, "trace_anomaly_events_max_count")  # No more than 15 anomalies
                         # Text length threshold (fallback mechanism)
                         min_length = 0
                         max_length = 600
@@ -531,26 +650,45 @@ class Executor(RoutedAgent):
                         max_count = 1000
                         min_length = 0
                         max_length = 10000
-                    # If anomaly events are successfully extracted, use event count; otherwise fallback to text length
-                    if anomaly_count > 0:
+                    # If anomaly events are successfully extracted (an empty anomaly_events list counts), use
+                    # event count; otherwise fallback to text length
+                    if anomaly_count > 0 or (not is_truncated and reports_anomaly_events(truncated_output)):
+                        # Try a local parameter sweep before asking the LLM to edit thresholds
+                        sweep_note = ""
+                        if anomaly_count > max_count or is_truncated or anomaly_count < min_count:
+                            # The tool has just run with its default values, the sweep starts from that result
+                            baseline = (max_count + 1 if is_truncated else anomaly_count, result.output)
+                            sweep = await self._sweep_event_count(coder_name, code_blocks, min_count, max_count, ctx, baseline)
+                            if sweep is not None:
+                                if sweep.success:
+                                    self._tracer.event("refine decision", agent=coder_name, decision="sweep", values=str(sweep.values), events=sweep.event_count)
+                                    print(f"Parameter sweep succeeded with {sweep.values}, detected {sweep.event_count} anomaly events ({sweep.evaluations} runs)")
+                                    logger.coder(f"\n{'-'*80}\nExecutor parameter sweep:\n{sweep.summary()}")
+                                    self.execution_result, _ = truncate_output(sweep.output, self._max_output_length)
+                                    self.execution_code = sweep.code_blocks
+                                    return
+                                sweep_note = f" An automatic sweep over the declared TUNABLE_PARAMETERS could not reach the bounds ({sweep.summary()}), so the detection logic itself needs to change."
                         # Check if anomaly event count is appropriate
                         if anomaly_count > max_count or is_truncated:
-                            self._refine_count[coder_name] += 1  # Increase retry count
-                            print(f"Too many anomaly events detected ({anomaly_count}), exceeding maximum allowed {max_count}. Please increase detection threshold, focus only on the most severe anomalies, and consider temporal correlation of related anomalies, grouping related anomalies as single events. These are the refine principles:{refine_rules}.(Attempt {self._refine_count[coder_name]}/{self._max_refine_attempts}) Execution result:\n" + truncated_output)
+                            self._start_refine(coder_name, "too many anomaly events")
+                            print(f"Too many anomaly events detected ({anomaly_count}), exceeding maximum allowed {max_count}.{sweep_note} Please increase detection threshold, focus only on the most severe anomalies, and consider temporal correlation of related anomalies, grouping related anomalies as single events. These are the refine principles:{refine_rules}.(Attempt {self._refine_count[coder_name]}/{self._max_refine_attempts}) Execution result:\n" + truncated_output)
                             await self.send_message(
-                                Message(content=f"Too many anomaly events detected ({anomaly_count}), exceeding maximum allowed {max_count}. Please increase detection threshold, focus only on the most severe anomalies, and consider temporal correlation of related anomalies, grouping related anomalies as single events. These are the refine principles:{refine_rules}.(Attempt {self._refine_count[coder_name]}/{self._max_refine_attempts}) Execution result:\n" + truncated_output),
-                                recipient=AgentId(coder_name, "default")
+                                Message(content=f"Too many anomaly events detected ({anomaly_count}), exceeding maximum allowed {max_count}.{sweep_note} Please increase detection threshold, focus only on the most severe anomalies, and consider temporal correlation of related anomalies, grouping related anomalies as single events. These are the refine principles:{refine_rules}.(Attempt {self._refine_count[coder_name]}/{self._max_refine_attempts}) Execution result:\n" + truncated_output),
+                                recipient=AgentId(coder_name, "default"),
+                                cancellation_token=ctx.cancellation_token
                             )
                             return
                         elif anomaly_count < min_count:
-                            self._refine_count[coder_name] += 1  # Increase retry count
-                            print(f"Too few anomaly events detected (only {anomaly_count}), below minimum expected {min_count}. Please adjust code to discover more anomalies. These are the refine principles:{refine_rules}.(Attempt {self._refine_count[coder_name]}/{self._max_refine_attempts}) Execution result:\n" + truncated_output)
+                            self._start_refine(coder_name, "too few anomaly events")
+                            print(f"Too few anomaly events detected (only {anomaly_count}), below minimum expected {min_count}.{sweep_note} Please adjust code to discover more anomalies. These are the refine principles:{refine_rules}.(Attempt {self._refine_count[coder_name]}/{self._max_refine_attempts}) Execution result:\n" + truncated_output)
                             await self.send_message(
-                                Message(content=f"Too few anomaly events detected (only {anomaly_count}), below minimum expected {min_count}. Please adjust code to discover more anomalies. These are the refine principles:{refine_rules}.(Attempt {self._refine_count[coder_name]}/{self._max_refine_attempts}) Execution result:\n" + truncated_output),
-                                recipient=AgentId(coder_name, "default")
+                                Message(content=f"Too few anomaly events detected (only {anomaly_count}), below minimum expected {min_count}.{sweep_note} Please adjust code to discover more anomalies. These are the refine principles:{refine_rules}.(Attempt {self._refine_count[coder_name]}/{self._max_refine_attempts}) Execution result:\n" + truncated_output),
+                                recipient=AgentId(coder_name, "default"),
+                                cancellation_token=ctx.cancellation_token
                             )
                             return
                         # Successful execution logic
+                        self._tracer.event("refine decision", agent=coder_name, decision="accept", events=anomaly_count)
                         self.execution_result = truncated_output
                         if code_blocks[-1].language.lower() in ['python', 'py']:
                             self.execution_code = code_blocks
@@ -560,19 +698,21 @@ class Executor(RoutedAgent):
                         
                         # Check if output length is appropriate
                         if content_length > max_length or is_truncated or content_length < min_length:
-                            self._refine_count[coder_name] += 1  # Increase retry count
+                            self._start_refine(coder_name, "too much output" if content_length > max_length or is_truncated else "too little output")
                             
                             if content_length > max_length or is_truncated:
                                 print(f"Too much output content ({content_length} characters). Please increase detection threshold, focus only on the most severe anomalies, and ensure using standard format to return anomaly_events. These are the refine principles:{refine_rules}.(Attempt {self._refine_count[coder_name]}/{self._max_refine_attempts}) Execution result:\n" + truncated_output)
                                 await self.send_message(
                                     Message(content=f"Too much output content ({content_length} characters). Please increase detection threshold, focus only on the most severe anomalies, and ensure using standard format to return anomaly_events. These are the refine principles:{refine_rules}.(Attempt {self._refine_count[coder_name]}/{self._max_refine_attempts}) Execution result:\n" + truncated_output),
-                                    recipient=AgentId(coder_name, "default")
+                                    recipient=AgentId(coder_name, "default"),
+                                    cancellation_token=ctx.cancellation_token
                                 )
                             elif content_length < min_length:
                                 print(f"Too little output content ({content_length} characters). Please adjust code to discover more anomalies, and ensure using standard format to return anomaly_events. These are the refine principles:{refine_rules}.(Attempt {self._refine_count[coder_name]}/{self._max_refine_attempts}) Execution result:\n" + truncated_output)
                                 await self.send_message(
                                     Message(content=f"Too little output content ({content_length} characters). Please adjust code to discover more anomalies, and ensure using standard format to return anomaly_events. These are the refine principles:{refine_rules}.(Attempt {self._refine_count[coder_name]}/{self._max_refine_attempts}) Execution result:\n" + truncated_output),
-                                    recipient=AgentId(coder_name, "default")
+                                    recipient=AgentId(coder_name, "default"),
+                                    cancellation_token=ctx.cancellation_token
                                 )
                             return
 
@@ -581,13 +721,14 @@ class Executor(RoutedAgent):
                         if code_blocks[-1].language.lower() in ['python', 'py']:
                             self.execution_code = code_blocks
                         
+                        self._tracer.event("refine decision", agent=coder_name, decision="accept", events=anomaly_count)
                         # Output different success messages based on whether anomaly events were detected
                         if anomaly_count > 0:
                             print(f"Execution successful, detected {anomaly_count} anomaly events")
                         else:
                             print(f"Execution successful, but no anomaly events detected in standard format")
                             
-                        await self.send_message(Message(content="<success>" + truncated_output + "</success>"),recipient=AgentId(coder_name, "default" ))
+                        await self.send_message(Message(content="<success>" + truncated_output + "</success>"),recipient=AgentId(coder_name, "default" ),cancellation_token=ctx.cancellation_token)
             else:
                 self.execution_result = truncated_output
                 self.execution_code = code_blocks
@@ -603,46 +744,34 @@ class Executor(RoutedAgent):
                 
 @default_subscription
 class MetricCoder(RoutedAgent):
-    _instances = {}  # Use dictionary to store multiple instances
-    # Add LLM call counter
-    _llm_call_count = 0
-    # Add token statistics
-    _token_usage = {
-        "prompt": 0,
-        "completion": 0,
-        "total": 0
-    }
-    
-    def __init__(self, model_client: ChatCompletionClient, name: str = None) -> None:
+    def __init__(self, model_client: ChatCompletionClient, name: str = None, prompt_module=None, tracer: Tracer = None) -> None:
         super().__init__("An assistant agent.")
         self._model_client = model_client
         self._name = name  # Store coder name
+        self._tracer = tracer or Tracer()
         self._chat_history: List[LLMMessage] = [
             SystemMessage(
-                content=metric_system_coder,
+                content=prompt_setting(prompt_module or get_prompt_module(), "metric_system_coder"),
             )
         ]
-        MetricCoder._instances[name if name else id(self)] = self  # Use name or id as key to store instance
-
-    @staticmethod
-    def get_chat_history(instance_name=None):
-        if instance_name and instance_name in MetricCoder._instances:
-            return MetricCoder._instances[instance_name]._chat_history
-        elif len(MetricCoder._instances) > 0:
-            # If no name specified, return first instance's history
-            return next(iter(MetricCoder._instances.values()))._chat_history
-        return []
-    
-    @staticmethod
-    def get_llm_call_count():
+        # Per instance, every workflow runtime has its own coders
+        self._llm_call_count = 0
+        self._token_usage = {"prompt": 0, "completion": 0, "total": 0}
+
+    def get_chat_history(self) -> List[LLMMessage]:
+        return self._chat_history
+
+    def get_llm_call_count(self) -> int:
         """Get LLM call count"""
-        return MetricCoder._llm_call_count
-    
-    @staticmethod
-    def get_token_usage():
+        return self._llm_call_count
+
+    def get_token_usage(self) -> Dict[str, int]:
         """Get token usage statistics"""
-        return MetricCoder._token_usage
+        return self._token_usage
 
+    def reset(self) -> None:
+        """Drop the conversation of earlier diagnoses, keeping the system message"""
+        self._chat_history = self._chat_history[:1]
 
     @message_handler
     async def handle_message(self, message: Message, ctx: MessageContext) -> None:
@@ -655,25 +784,14 @@ class MetricCoder(RoutedAgent):
         
         if not is_success:
             # Increase LLM call count
-            MetricCoder._llm_call_count += 1
-            print(f"[LLM Call Statistics] {self._name} called LLM, Total: {MetricCoder._llm_call_count}")
+            self._llm_call_count += 1
+            print(f"[LLM Call Statistics] {self._name} called LLM, Total: {self._llm_call_count}")
             
-            result = await self._model_client.create(self._chat_history)
-            
-            # Check and update token usage statistics
-            if hasattr(result, 'usage'):
-                # RequestUsage format token statistics
-                prompt_tokens = getattr(result.usage, 'prompt_tokens', 0)
-                completion_tokens = getattr(result.usage, 'completion_tokens', 0)
-                
-                # Calculate total tokens
-                total_tokens = prompt_tokens + completion_tokens
-                
-                MetricCoder._token_usage["prompt"] += prompt_tokens
-                MetricCoder._token_usage["completion"] += completion_tokens
-                MetricCoder._token_usage["total"] += total_tokens
-                
-                print(f"[Token Statistics] {self._name}: prompt={prompt_tokens}, completion={completion_tokens}, total={total_tokens}, cumulative={MetricCoder._token_usage['total']}")
+            with self._tracer.span(self._name, "llm", agent=self._name) as span:
+                result = await self._model_client.create(self._chat_history, cancellation_token=ctx.cancellation_token)
+                prompt_tokens, completion_tokens = self._tracer.record_llm(span, self._name, result.usage, result.content)
+            add_token_usage(self._token_usage, prompt_tokens, completion_tokens)
+            print(f"[Token Statistics] {self._name}: prompt={prompt_tokens}, completion={completion_tokens}, total={prompt_tokens + completion_tokens}, cumulative={self._token_usage['total']}")
             
             logger.coder(f"\n{'-'*80}\n{self._name} Assistant:\n{result.content}")
             self._chat_history.append(AssistantMessage(content=result.content, source="assistant"))
@@ -681,7 +799,8 @@ class MetricCoder(RoutedAgent):
             coder_message = Message(self._name + ":\n" + result.content)
             await self.send_message(
                 coder_message,
-                recipient=AgentId("executor", "default")
+                recipient=AgentId("executor", "default"),
+                cancellation_token=ctx.cancellation_token
             )
 
 
@@ -689,47 +808,34 @@ class MetricCoder(RoutedAgent):
 
 @default_subscription
 class LogCoder(RoutedAgent):
-    _instances = {}  # Each Coder class uses its own instance dictionary
-    # Add LLM call counter
-    _llm_call_count = 0
-    # Add token statistics
-    _token_usage = {
-        "prompt": 0,
-        "completion": 0,
-        "total": 0
-    }
-    
-    def __init__(self, model_client: ChatCompletionClient, name: str = None) -> None:
+    def __init__(self, model_client: ChatCompletionClient, name: str = None, prompt_module=None, tracer: Tracer = None) -> None:
         super().__init__("An assistant agent.")
         self._model_client = model_client
         self._name = name  # Store coder name
+        self._tracer = tracer or Tracer()
         self._chat_history: List[LLMMessage] = [
             SystemMessage(
-                content=log_system_coder,
+                content=prompt_setting(prompt_module or get_prompt_module(), "log_system_coder"),
             )
         ]
-        LogCoder._instances[name if name else id(self)] = self  # Use LogCoder's own dictionary
-
-    @staticmethod
-    def get_chat_history(instance_name=None):
-        if instance_name and instance_name in LogCoder._instances:  # Use LogCoder's dictionary
-            return LogCoder._instances[instance_name]._chat_history
-        elif len(LogCoder._instances) > 0:
-            # If no name specified, return first instance's history
-            return next(iter(LogCoder._instances.values()))._chat_history
-        return []
-    
-    @staticmethod
-    def get_llm_call_count():
+        # Per instance, every workflow runtime has its own coders
+        self._llm_call_count = 0
+        self._token_usage = {"prompt": 0, "completion": 0, "total": 0}
+
+    def get_chat_history(self) -> List[LLMMessage]:
+        return self._chat_history
+
+    def get_llm_call_count(self) -> int:
         """Get LLM call count"""
-        return LogCoder._llm_call_count
-    
-    @staticmethod
-    def get_token_usage():
-        """Get token usage statistics"""
-        return LogCoder._token_usage
+        return self._llm_call_count
 
+    def get_token_usage(self) -> Dict[str, int]:
+        """Get token usage statistics"""
+        return self._token_usage
 
+    def reset(self) -> None:
+        """Drop the conversation of earlier diagnoses, keeping the system message"""
+        self._chat_history = self._chat_history[:1]
 
     @message_handler
     async def handle_message(self, message: Message, ctx: MessageContext) -> None:
@@ -743,26 +849,14 @@ class LogCoder(RoutedAgent):
         
         if not is_success:
             # Increase LLM call count
-            LogCoder._llm_call_count += 1
-            print(f"[LLM Call Statistics] {self._name} called LLM, Total: {LogCoder._llm_call_count}")
-            
-            result = await self._model_client.create(self._chat_history)
+            self._llm_call_count += 1
+            print(f"[LLM Call Statistics] {self._name} called LLM, Total: {self._llm_call_count}")
             
-            # Check and update token usage statistics
-            if hasattr(result, 'usage'):
-                # RequestUsage format token statistics
-                prompt_tokens = getattr(result.usage, 'prompt_tokens', 0)
-                print('result_usage',result.usage)
-                completion_tokens = getattr(result.usage, 'completion_tokens', 0)
-                
-                # Calculate total tokens
-                total_tokens = prompt_tokens + completion_tokens
-                
-                LogCoder._token_usage["prompt"] += prompt_tokens
-                LogCoder._token_usage["completion"] += completion_tokens
-                LogCoder._token_usage["total"] += total_tokens
-                
-                print(f"[Token Statistics] {self._name}: prompt={prompt_tokens}, completion={completion_tokens}, total={total_tokens}, cumulative={LogCoder._token_usage['total']}")
+            with self._tracer.span(self._name, "llm", agent=self._name) as span:
+                result = await self._model_client.create(self._chat_history, cancellation_token=ctx.cancellation_token)
+                prompt_tokens, completion_tokens = self._tracer.record_llm(span, self._name, result.usage, result.content)
+            add_token_usage(self._token_usage, prompt_tokens, completion_tokens)
+            print(f"[Token Statistics] {self._name}: prompt={prompt_tokens}, completion={completion_tokens}, total={prompt_tokens + completion_tokens}, cumulative={self._token_usage['total']}")
             
             logger.coder(f"\n{'-'*80}\n{self._name} Assistant:\n{result.content}")
             self._chat_history.append(AssistantMessage(content=result.content, source="assistant"))
@@ -770,51 +864,41 @@ class LogCoder(RoutedAgent):
             coder_message = Message(self._name + ":\n" + result.content)
             await self.send_message(
                 coder_message,
-                recipient=AgentId("executor", "default")
+                recipient=AgentId("executor", "default"),
+                cancellation_token=ctx.cancellation_token
             )
 
 
 @default_subscription
 class TraceCoder(RoutedAgent):
-    _instances = {}  # Use dictionary to store multiple instances
-    # Add LLM call counter
-    _llm_call_count = 0
-    # Add token statistics
-    _token_usage = {
-        "prompt": 0,
-        "completion": 0,
-        "total": 0
-    }
-    
-    def __init__(self, model_client: ChatCompletionClient, name: str = None) -> None:
+    def __init__(self, model_client: ChatCompletionClient, name: str = None, prompt_module=None, tracer: Tracer = None) -> None:
         super().__init__("An assistant agent.")
         self._model_client = model_client
         self._name = name  # Store coder name
+        self._tracer = tracer or Tracer()
         self._chat_history: List[LLMMessage] = [
             SystemMessage(
-                content=trace_system_coder,
+                content=prompt_setting(prompt_module or get_prompt_module(), "trace_system_coder"),
             )
         ]
-        TraceCoder._instances[name if name else id(self)] = self  # Use name or id as key to store instance
-
-    @staticmethod
-    def get_chat_history(instance_name=None):
-        if instance_name and instance_name in TraceCoder._instances:
-            return TraceCoder._instances[instance_name]._chat_history
-        elif len(TraceCoder._instances) > 0:
-            # If no name specified, return first instance's history
-            return next(iter(TraceCoder._instances.values()))._chat_history
-        return []
-    
-    @staticmethod
-    def get_llm_call_count():
+        # Per instance, every workflow runtime has its own coders
+        self._llm_call_count = 0
+        self._token_usage = {"prompt": 0, "completion": 0, "total": 0}
+
+    def get_chat_history(self) -> List[LLMMessage]:
+        return self._chat_history
+
+    def get_llm_call_count(self) -> int:
         """Get LLM call count"""
-        return TraceCoder._llm_call_count
-    
-    @staticmethod
-    def get_token_usage():
+        return self._llm_call_count
+
+    def get_token_usage(self) -> Dict[str, int]:
         """Get token usage statistics"""
-        return TraceCoder._token_usage
+        return self._token_usage
+
+    def reset(self) -> None:
+        """Drop the conversation of earlier diagnoses, keeping the system message"""
+        self._chat_history = self._chat_history[:1]
 
     @message_handler
     async def handle_message(self, message: Message, ctx: MessageContext) -> None:
@@ -827,25 +911,14 @@ class TraceCoder(RoutedAgent):
         
         if not is_success:
             # Increase LLM call count
-            TraceCoder._llm_call_count += 1
-            print(f"[LLM Call Statistics] {self._name} called LLM, Total: {TraceCoder._llm_call_count}")
+            self._llm_call_count += 1
+            print(f"[LLM Call Statistics] {self._name} called LLM, Total: {self._llm_call_count}")
             
-            result = await self._model_client.create(self._chat_history)
-            
-            # Check and update token usage statistics
-            if hasattr(result, 'usage'):
-                # RequestUsage format token statistics
-                prompt_tokens = getattr(result.usage, 'prompt_tokens', 0)
-                completion_tokens = getattr(result.usage, 'completion_tokens', 0)
-                
-                # Calculate total tokens
-                total_tokens = prompt_tokens + completion_tokens
-                
-                TraceCoder._token_usage["prompt"] += prompt_tokens
-                TraceCoder._token_usage["completion"] += completion_tokens
-                TraceCoder._token_usage["total"] += total_tokens
-                
-                print(f"[Token Statistics] {self._name}: prompt={prompt_tokens}, completion={completion_tokens}, total={total_tokens}, cumulative={TraceCoder._token_usage['total']}")
+            with self._tracer.span(self._name, "llm", agent=self._name) as span:
+                result = await self._model_client.create(self._chat_history, cancellation_token=ctx.cancellation_token)
+                prompt_tokens, completion_tokens = self._tracer.record_llm(span, self._name, result.usage, result.content)
+            add_token_usage(self._token_usage, prompt_tokens, completion_tokens)
+            print(f"[Token Statistics] {self._name}: prompt={prompt_tokens}, completion={completion_tokens}, total={prompt_tokens + completion_tokens}, cumulative={self._token_usage['total']}")
             
             logger.coder(f"\n{'-'*80}\n{self._name} Assistant:\n{result.content}")
             self._chat_history.append(AssistantMessage(content=result.content, source="assistant"))
@@ -853,7 +926,8 @@ class TraceCoder(RoutedAgent):
             coder_message = Message(self._name + ":\n" + result.content)
             await self.send_message(
                 coder_message,
-                recipient=AgentId("executor", "default")
+                recipient=AgentId("executor", "default"),
+                cancellation_token=ctx.cancellation_token
             )
 
 
@@ -0,0 +1,219 @@
+import ast
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set
+
+from autogen_core.code_executor import CodeBlock
+
+# Calls that read a whole file
+READ_FUNCTIONS = {"read_csv", "read_json", "read_parquet", "read_table", "load_window"}
+
+# Arguments that make read_csv read only part of a file
+PARTIAL_READ_ARGUMENTS = {"chunksize", "nrows", "iterator"}
+
+# Constants of tool_window_prompt, a tool using them filters by the diagnosis window
+WINDOW_CONSTANT_PATTERN = re.compile(r"^(EXTENDED_)?WINDOW_(START|END)(_MS)?$")
+
+# Issues of this severity are sent back to the coder before the code is executed
+BLOCKING_SEVERITY = "high"
+
+HINTS = {
+    "row_iteration": "Avoid row-wise iteration over DataFrames. Use vectorized column operations, groupby/agg, or merge instead of iterrows/itertuples/apply(axis=1).",
+    "nested_index_loop": "This nested positional loop is quadratic in the series length. Use vectorized operations such as rolling windows, diff, shift or cumsum over the whole series, or searchsorted to find positions.",
+    "lookup_in_loop": "Each index lookup inside the loop is a search. Iterate over positions directly with enumerate, convert the index to a NumPy array once, or use searchsorted.",
+    "read_in_loop": "The same file is read again on every iteration. Read it once before the loop, filter it to the diagnosis window, then split it with groupby.",
+    "full_read": "The whole CSV file is loaded. Use telemetry.loader.load_window(path, WINDOW_START, WINDOW_END) (or the EXTENDED_WINDOW_* constants) so that only rows in the window are kept, and pass usecols to load only the needed columns.",
+    "no_time_filter": "The data is never filtered to the diagnosis window. Load it with telemetry.loader.load_window(path, WINDOW_START, WINDOW_END) instead of pd.read_csv.",
+    "concat_in_loop": "Calling pd.concat inside a loop copies all accumulated data on every iteration. Collect the frames in a list and concatenate once after the loop.",
+}
+
+
+@dataclass
+class CostIssue:
+    rule: str
+    severity: str
+    line: int
+    snippet: str
+
+    @property
+    def hint(self) -> str:
+        return HINTS[self.rule]
+
+    def describe(self) -> str:
+        return f"line {self.line} [{self.rule}, {self.severity}]: `{self.snippet}` - {self.hint}"
+
+
+def _call_name(node: ast.Call) -> Optional[str]:
+    if isinstance(node.func, ast.Attribute):
+        return node.func.attr
+    if isinstance(node.func, ast.Name):
+        return node.func.id
+    return None
+
+
+def _names(node: ast.AST) -> Set[str]:
+    return {child.id for child in ast.walk(node) if isinstance(child, ast.Name)}
+
+
+def _is_range_loop(node: ast.AST) -> bool:
+    return (isinstance(node, (ast.For, ast.AsyncFor)) and isinstance(node.iter, ast.Call)
+            and isinstance(node.iter.func, ast.Name) and node.iter.func.id == "range")
+
+
+def _loop_targets(node: ast.AST) -> Set[str]:
+    if isinstance(node, (ast.For, ast.AsyncFor)):
+        return _names(node.target)
+    if isinstance(node, (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)):
+        return set().union(*(_names(generator.target) for generator in node.generators))
+    return set()
+
+
+def _reading_functions(tree: ast.AST) -> Set[str]:
+    """Functions and methods of the tool that read a file themselves"""
+    readers = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            if any(isinstance(child, ast.Call) and _call_name(child) in READ_FUNCTIONS for child in ast.walk(node)):
+                readers.add(node.name)
+    return readers
+
+
+class _CostVisitor(ast.NodeVisitor):
+    def __init__(self, source: str, readers: Set[str]):
+        self.source = source
+        self.readers = readers
+        self.loops: List[ast.AST] = []
+        self.issues: List[CostIssue] = []
+        self.full_reads: List[ast.Call] = []
+
+    def snippet(self, node: ast.AST) -> str:
+        text = ast.get_source_segment(self.source, node) or ""
+        text = " ".join(text.split("\n")[0].split())
+        return text if len(text) <= 80 else text[:77] + "..."
+
+    def add(self, rule: str, severity: str, node: ast.AST) -> None:
+        self.issues.append(CostIssue(rule, severity, node.lineno, self.snippet(node)))
+
+    def visit_loop(self, node: ast.AST) -> None:
+        if _is_range_loop(node) and any(
+            child is not node and (_is_range_loop(child) or isinstance(child, ast.While))
+            for child in ast.walk(node)
+        ):
+            # Only report the outermost loop of a nest
+            if not any(_is_range_loop(loop) for loop in self.loops):
+                self.issues.append(CostIssue("nested_index_loop", "high", node.lineno, self.snippet(node).rstrip(":")))
+        self.loops.append(node)
+        self.generic_visit(node)
+        self.loops.pop()
+
+    visit_For = visit_AsyncFor = visit_While = visit_loop
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = visit_loop
+
+    def visit_function(self, node: ast.AST) -> None:
+        # A function body runs when it is called, not once per iteration of the enclosing loop
+        loops, self.loops = self.loops, []
+        self.generic_visit(node)
+        self.loops = loops
+
+    visit_FunctionDef = visit_AsyncFunctionDef = visit_Lambda = visit_function
+
+    def visit_Call(self, node: ast.Call) -> None:
+        name = _call_name(node)
+        keywords = {keyword.arg for keyword in node.keywords}
+
+        if name == "iterrows":
+            self.add("row_iteration", "high", node)
+        elif name == "itertuples":
+            self.add("row_iteration", "medium", node)
+        elif name == "apply" and any(
+            keyword.arg == "axis" and isinstance(keyword.value, ast.Constant) and keyword.value.value in (1, "columns")
+            for keyword in node.keywords
+        ):
+            self.add("row_iteration", "medium", node)
+
+        if self.loops:
+            if name in ("get_loc", "get_indexer") or (name == "index" and isinstance(node.func, ast.Attribute)
+                                                       and isinstance(node.func.value, ast.Name)):
+                self.add("lookup_in_loop", "medium", node)
+            if name == "concat":
+                self.add("concat_in_loop", "medium", node)
+            if name in READ_FUNCTIONS or name in self.readers:
+                # Reading a different file per iteration is fine, the same file every time is not
+                loop_variables = set().union(*(_loop_targets(loop) for loop in self.loops))
+                arguments = set().union(set(), *(_names(arg) for arg in node.args), *(_names(keyword.value) for keyword in node.keywords))
+                if not arguments & loop_variables:
+                    self.add("read_in_loop", "high", node)
+
+        if name in ("read_csv", "read_table") and not keywords & PARTIAL_READ_ARGUMENTS:
+            self.full_reads.append(node)
+        self.generic_visit(node)
+
+
+def _filters_by_time(tree: ast.AST) -> bool:
+    """True if the code compares anything with a window constant or a time-like column"""
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and WINDOW_CONSTANT_PATTERN.match(node.id):
+            return True
+        if isinstance(node, ast.Call) and _call_name(node) in ("load_window", "between"):
+            return True
+        if isinstance(node, ast.Compare):
+            text = ast.dump(node).lower()
+            if "time" in text or "ts" in text.split("'"):
+                return True
+    return False
+
+
+def analyze_code(code: str) -> List[CostIssue]:
+    """
+    Find slow idioms in a generated tool without running it
+
+    Args:
+        code: Python source of the tool
+
+    Returns:
+        List[CostIssue] ordered by line, empty if the code does not parse
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        # The executor reports syntax errors itself
+        return []
+    visitor = _CostVisitor(code, _reading_functions(tree))
+    visitor.visit(tree)
+
+    if visitor.full_reads:
+        filtered = _filters_by_time(tree)
+        for node in visitor.full_reads:
+            if filtered:
+                visitor.add("full_read", "medium", node)
+            else:
+                visitor.add("no_time_filter", "high", node)
+
+    # One issue per rule and line
+    issues: Dict[tuple, CostIssue] = {}
+    for issue in visitor.issues:
+        issues.setdefault((issue.rule, issue.line), issue)
+    return sorted(issues.values(), key=lambda issue: (issue.line, issue.rule))
+
+
+def analyze_code_blocks(code_blocks: List[CodeBlock]) -> List[CostIssue]:
+    """Analyze the Python blocks of a coder message, lines are numbered per block"""
+    issues = []
+    for block in code_blocks:
+        if block.language.lower() in ["python", "py"]:
+            issues.extend(analyze_code(block.code))
+    return issues
+
+
+def is_blocking(issues: List[CostIssue]) -> bool:
+    return any(issue.severity == BLOCKING_SEVERITY for issue in issues)
+
+
+def format_cost_issues(issues: List[CostIssue]) -> str:
+    """Refine message asking the coder to rewrite the slow parts before the code is executed"""
+    lines = "\n".join(f"- {issue.describe()}" for issue in issues)
+    return (
+        "Your code was not executed yet: a static analysis found patterns that are slow on a full day of telemetry "
+        "and can run for minutes. Please rewrite these parts and return the complete corrected code. Keep the "
+        "detection logic and the output format unchanged.\n" + lines
+    )
@@ -0,0 +1,178 @@
+"""
+Fork server for generated tools
+
+Imports pandas, numpy and the telemetry loader once, then forks a copy-on-write child per
+tool execution, so every tool runs in its own process without paying for interpreter
+startup and imports. It only needs the standard library and the preloaded packages, and is
+copied into the code executor's work_dir together with the sandbox bootstrap, so it can run
+wherever the tools run (locally or inside the executor container).
+
+Protocol, one execution per connection on a Unix socket:
+    client -> server: one JSON line {"script": <file in the work_dir>}
+    server -> client: "<pid>\n" from the child, the output of the tool, then EXIT_MARKER and
+                      the exit code once the child has exited
+A negative exit code means the tool was killed by that signal. The client kills a tool
+that runs too long with os.killpg(pid, SIGKILL), every tool runs in its own session.
+
+Usage: python fork_server.py <socket path> <config json>
+    config: {"sandbox": <install_sandbox config>, "rlimits": {name: value},
+             "preload_modules": [...], "preload_paths": [...]}
+"""
+import json
+import mmap
+import os
+import selectors
+import signal
+import socket
+import sys
+
+EXIT_MARKER = b"\n\x00EXIT "
+
+DEFAULT_PRELOAD_MODULES = ["numpy", "pandas", "telemetry", "telemetry.loader", "telemetry.baselines",
+                           "telemetry.metrics", "telemetry.rollups", "telemetry.traces", "telemetry.templates",
+                           "telemetry.log_index"]
+
+# Files mapped by the server before it serves, shared copy-on-write with every tool
+PRELOADED = {}
+
+
+def preload(modules, paths):
+    for module in modules:
+        try:
+            __import__(module)
+        except ImportError as error:
+            print(f"[ForkServer] Could not preload {module}: {error}", file=sys.stderr)
+    for root in paths:
+        files = [root] if os.path.isfile(root) else [
+            os.path.join(directory, name) for directory, _, names in os.walk(root) for name in names
+        ]
+        for path in files:
+            with open(path, "rb") as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    continue
+                mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mapping, "madvise"):
+                mapping.madvise(mmap.MADV_WILLNEED)
+            PRELOADED[os.path.realpath(path)] = mapping
+
+
+def set_limits(rlimits):
+    import resource
+    for name, value in rlimits.items():
+        limit = getattr(resource, name)
+        soft, hard = resource.getrlimit(limit)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        resource.setrlimit(limit, (value, hard))
+
+
+def run_child(connection, script, config, inherited):
+    """Runs in the forked child, never returns"""
+    exit_code = 1
+    try:
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for sock in inherited:
+            sock.close()
+        os.setsid()
+        # The pid comes first, before any output of the tool
+        connection.sendall(f"{os.getpid()}\n".encode())
+        set_limits(config.get("rlimits", {}))
+        # Output of the tool goes straight to the client
+        os.dup2(connection.fileno(), 1)
+        os.dup2(connection.fileno(), 2)
+        connection.close()
+
+        from _sandbox_bootstrap import install_sandbox, run_script
+        install_sandbox(config.get("sandbox", {}))
+        exit_code = 0
+        run_script(script)
+    except SystemExit as error:
+        if error.code is None:
+            exit_code = 0
+        elif isinstance(error.code, int):
+            exit_code = error.code
+        else:
+            print(error.code, file=sys.stderr)
+            exit_code = 1
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+        os._exit(exit_code & 0xFF)
+
+
+def serve(socket_path, config):
+    preload(config.get("preload_modules", DEFAULT_PRELOAD_MODULES), config.get("preload_paths", []))
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(64)
+    listener.setblocking(False)
+
+    # SIGCHLD wakes up the selector, so finished tools are reported without polling
+    wakeup_read, wakeup_write = socket.socketpair()
+    wakeup_read.setblocking(False)
+    wakeup_write.setblocking(False)
+    signal.set_wakeup_fd(wakeup_write.fileno())
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    selector.register(wakeup_read, selectors.EVENT_READ)
+    children = {}  # pid -> connection
+
+    print("ready", flush=True)
+    while True:
+        for key, _ in selector.select():
+            if key.fileobj is listener:
+                try:
+                    connection, _ = listener.accept()
+                except BlockingIOError:
+                    continue
+                connection.setblocking(True)
+                try:
+                    request = json.loads(connection.makefile("rb").readline())
+                except (OSError, ValueError):
+                    connection.close()
+                    continue
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    run_child(connection, request["script"], config,
+                              [listener, wakeup_read, wakeup_write, *children.values()])
+                children[pid] = connection
+            else:
+                try:
+                    while wakeup_read.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                while children:
+                    try:
+                        pid, status = os.waitpid(-1, os.WNOHANG)
+                    except ChildProcessError:
+                        break
+                    if pid == 0:
+                        break
+                    connection = children.pop(pid, None)
+                    if connection is None:
+                        continue
+                    exit_code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+                    try:
+                        connection.sendall(EXIT_MARKER + f"{exit_code}\n".encode())
+                    except OSError:
+                        # The client gave up on the tool
+                        pass
+                    connection.close()
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1], json.loads(sys.argv[2]))
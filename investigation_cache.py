@@ -0,0 +1,122 @@
+import json
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from NoteBook import NotebookSystem
+from query_parser import QueryWindow
+
+# Bump when the entry layout changes, older files are ignored
+CACHE_VERSION = 1
+
+# Answer fields of the reasoner's JSON for each target parsed from a query (QueryWindow.targets)
+TARGET_FIELDS = {
+    "time": "root cause occurrence datetime",
+    "component": "root cause component",
+    "reason": "root cause reason",
+}
+
+
+@dataclass
+class InvestigationEntry:
+    """Outcome of the planning and investigation stages for one failure window"""
+    dataset: str
+    system: Optional[str]
+    start: int
+    end: int
+    query: str
+    diagnosis_plan: str
+    investigation_results: List[Dict]
+    coder_notebook: Dict[str, Dict[str, str]] = field(default_factory=dict)
+    explorer_notebook: Dict[str, Dict[str, str]] = field(default_factory=dict)
+    created: float = field(default_factory=time.time)
+
+    @property
+    def key(self) -> Tuple[str, Optional[str], int, int]:
+        return (self.dataset, self.system, self.start, self.end)
+
+    def restore_notebooks(self, coder_notebook: NotebookSystem, explorer_notebook: NotebookSystem) -> None:
+        """Load the saved notebook contents into a workflow's notebooks"""
+        for notebook, saved in ((coder_notebook, self.coder_notebook), (explorer_notebook, self.explorer_notebook)):
+            notebook.tasks.update(saved.get("tasks", {}))
+            notebook.notebook.update(saved.get("responses", {}))
+
+
+def snapshot_notebook(notebook: NotebookSystem) -> Dict[str, Dict[str, str]]:
+    return {"tasks": dict(notebook.tasks), "responses": dict(notebook.notebook)}
+
+
+def format_targets(targets: List[str]) -> str:
+    """Answer fields asked for by a query, all of them if the query names none"""
+    fields = [TARGET_FIELDS[target] for target in targets if target in TARGET_FIELDS]
+    return ", ".join(fields or TARGET_FIELDS.values())
+
+
+class InvestigationCache:
+    """
+    Investigation results of failure windows, shared by the queries about the same incident
+
+    The OpenRCA task types ask for the time, the component and/or the reason of the same
+    failure. Planning, investigation and tool generation depend only on the failure window,
+    so a later query about a window that has already been investigated goes straight to the
+    reasoning stage. Entries are kept in memory and, if a directory is given, as one JSON
+    file per window so that later runs can reuse them.
+
+    Args:
+        directory: Directory of the cache files, None to keep entries in memory only
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory
+        self._entries: Dict[Tuple[str, Optional[str], int, int], InvestigationEntry] = {}
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: Tuple[str, Optional[str], int, int]) -> str:
+        dataset, system, start, end = key
+        name = "_".join(str(part) for part in (dataset, system or "all", start, end))
+        return os.path.join(self.directory, f"{name}.json")
+
+    def get(self, window: Optional[QueryWindow]) -> Optional[InvestigationEntry]:
+        """
+        Investigation of a failure window
+
+        Args:
+            window: Parsed window of the query
+
+        Returns:
+            InvestigationEntry, or None if the window has not been investigated
+        """
+        if window is None:
+            return None
+        key = window.incident_key
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None or not self.directory:
+                return entry
+            try:
+                with open(self._path(key), encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                return None
+            if data.pop("version", None) != CACHE_VERSION:
+                return None
+            entry = self._entries[key] = InvestigationEntry(**data)
+            return entry
+
+    def put(self, entry: InvestigationEntry) -> None:
+        """Store the investigation of a window, replacing an earlier one"""
+        with self._lock:
+            self._entries[entry.key] = entry
+            if not self.directory:
+                return
+            path = self._path(entry.key)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"version": CACHE_VERSION, **asdict(entry)}, f, ensure_ascii=False)
+            os.replace(path + ".tmp", path)
+
+    def __len__(self) -> int:
+        return len(self._entries)
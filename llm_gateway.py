@@ -0,0 +1,353 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from typing import Any, AsyncGenerator, Mapping, Optional, Sequence, Union
+
+import openai
+from autogen_core import CancellationToken
+from autogen_core.models import (
+    ChatCompletionClient,
+    CreateResult,
+    LLMMessage,
+    ModelCapabilities,
+    ModelInfo,
+    RequestUsage,
+)
+from autogen_core.tools import Tool, ToolSchema
+from pydantic import BaseModel
+
+# Lower value is served first when the gateway is saturated.
+# The reasoner decides the final answer, so it never waits behind explorers.
+AGENT_PRIORITIES = {
+    "reasoner": 0,
+    "investigator": 1,
+    "planner": 1,
+    "metric_coder": 2,
+    "log_coder": 2,
+    "trace_coder": 2,
+    "metric_explorer": 3,
+    "log_explorer": 3,
+    "trace_explorer": 3,
+}
+DEFAULT_PRIORITY = 3
+
+# Errors worth retrying: rate limits, timeouts, dropped connections and 5xx
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+class TokenBucket:
+    """Continuously refilled bucket holding at most `per_minute` units"""
+
+    def __init__(self, per_minute: Optional[float]):
+        self.capacity = per_minute
+        self.level = per_minute or 0.0
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self.capacity:
+            self.level = min(self.capacity, self.level + (now - self._updated) * self.capacity / 60.0)
+        self._updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds to wait until `amount` units are available (0 if available now)"""
+        if not self.capacity:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60.0 / self.capacity
+
+    def consume(self, amount: float) -> None:
+        if not self.capacity:
+            return
+        self._refill()
+        # May go negative when the real usage exceeds the estimate
+        self.level -= amount
+
+
+class LLMGateway:
+    """
+    Shared gateway in front of a model client
+
+    All agents using the same underlying client go through one gateway, which caps the
+    number of in-flight requests, keeps requests and tokens per minute under the provider
+    quota, retries transient failures with jittered exponential backoff (honouring
+    `Retry-After` on 429s) and admits waiting requests by agent priority.
+
+    Args:
+        client: The underlying model client
+        max_concurrency: Maximum number of in-flight requests
+        requests_per_minute: Request quota, None for unlimited
+        tokens_per_minute: Token quota (prompt + completion), None for unlimited
+        max_retries: Maximum retries per request on retryable errors
+        base_delay: Initial backoff delay in seconds
+        max_delay: Maximum backoff delay in seconds
+        stream_usage: Ask the provider to report token usage at the end of streamed responses
+    """
+
+    def __init__(
+        self,
+        client: ChatCompletionClient,
+        max_concurrency: int = 8,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        max_retries: int = 6,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        stream_usage: bool = True,
+    ):
+        self.client = client
+        self.stream_usage = stream_usage
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._paused_until = 0.0
+        self._active = 0
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._condition: Optional[asyncio.Condition] = None
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "failures": 0}
+
+    def for_agent(self, agent_name: str, priority: Optional[int] = None) -> "GatewayClient":
+        """Return a model client view that sends requests on behalf of `agent_name`"""
+        if priority is None:
+            priority = AGENT_PRIORITIES.get(agent_name, DEFAULT_PRIORITY)
+        return GatewayClient(self, agent_name, priority)
+
+    def _get_condition(self) -> asyncio.Condition:
+        # Created lazily so the gateway can be built at import time, outside a running loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def estimate_tokens(self, messages: Sequence[LLMMessage]) -> int:
+        """Tokens of messages for the gateway's model, about 4 characters per token if it cannot count them"""
+        try:
+            return self.client.count_tokens(messages)
+        except Exception:
+            return sum(len(str(getattr(m, "content", ""))) for m in messages) // 4
+
+    def _admission_delay(self, tokens: int) -> float:
+        return max(
+            self._paused_until - time.monotonic(),
+            self._requests.delay(1),
+            self._tokens.delay(tokens),
+            0.0,
+        )
+
+    async def _acquire(self, priority: int, tokens: int) -> None:
+        condition = self._get_condition()
+        entry = (priority, next(self._sequence))
+        async with condition:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    if self._waiting[0] == entry and self._active < self.max_concurrency:
+                        delay = self._admission_delay(tokens)
+                        if delay <= 0:
+                            heapq.heappop(self._waiting)
+                            self._active += 1
+                            self._requests.consume(1)
+                            self._tokens.consume(tokens)
+                            condition.notify_all()
+                            return
+                        try:
+                            await asyncio.wait_for(condition.wait(), timeout=delay)
+                        except asyncio.TimeoutError:
+                            pass
+                    else:
+                        await condition.wait()
+            except BaseException:
+                if entry in self._waiting:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    condition.notify_all()
+                raise
+
+    async def _release(self, estimated_tokens: int, usage: Optional[RequestUsage]) -> None:
+        condition = self._get_condition()
+        async with condition:
+            self._active -= 1
+            if usage is not None:
+                # Settle the difference between the estimate and the real usage
+                self._tokens.consume(usage.prompt_tokens + usage.completion_tokens - estimated_tokens)
+            condition.notify_all()
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        # Full jitter spreads retries of concurrent diagnoses apart
+        delay = random.uniform(0, delay)
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None) or {}
+        retry_after = headers.get("retry-after") if hasattr(headers, "get") else None
+        if retry_after:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        return delay
+
+    async def create(
+        self,
+        agent_name: str,
+        priority: int,
+        messages: Sequence[LLMMessage],
+        **kwargs: Any,
+    ) -> CreateResult:
+        estimated_tokens = self.estimate_tokens(messages)
+        attempt = 0
+        while True:
+            await self._acquire(priority, estimated_tokens)
+            usage = None
+            try:
+                self.stats["requests"] += 1
+                result = await self.client.create(messages, **kwargs)
+                usage = result.usage
+                return result
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries:
+                    self.stats["failures"] += 1
+                    raise
+                delay = self._retry_delay(e, attempt)
+                if isinstance(e, openai.RateLimitError):
+                    self.stats["rate_limited"] += 1
+                    # Hold back every caller, the quota is shared
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self.stats["retries"] += 1
+                attempt += 1
+                print(f"[LLM Gateway] {agent_name} request failed ({type(e).__name__}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+            finally:
+                await self._release(estimated_tokens, usage)
+            await asyncio.sleep(delay)
+
+    async def create_stream(
+        self,
+        agent_name: str,
+        priority: int,
+        messages: Sequence[LLMMessage],
+        **kwargs: Any,
+    ) -> AsyncGenerator[Union[str, CreateResult], None]:
+        estimated_tokens = self.estimate_tokens(messages)
+        if self.stream_usage:
+            extra_create_args = dict(kwargs.get("extra_create_args") or {})
+            extra_create_args.setdefault("stream_options", {"include_usage": True})
+            kwargs["extra_create_args"] = extra_create_args
+        attempt = 0
+        while True:
+            await self._acquire(priority, estimated_tokens)
+            usage = None
+            started = False
+            try:
+                self.stats["requests"] += 1
+                async for chunk in self.client.create_stream(messages, **kwargs):
+                    started = True
+                    if isinstance(chunk, CreateResult):
+                        usage = chunk.usage
+                    yield chunk
+                return
+            except RETRYABLE_ERRORS as e:
+                # Chunks already handed to the caller cannot be taken back
+                if started or attempt >= self.max_retries:
+                    self.stats["failures"] += 1
+                    raise
+                delay = self._retry_delay(e, attempt)
+                if isinstance(e, openai.RateLimitError):
+                    self.stats["rate_limited"] += 1
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self.stats["retries"] += 1
+                attempt += 1
+                print(f"[LLM Gateway] {agent_name} stream failed ({type(e).__name__}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+            finally:
+                await self._release(estimated_tokens, usage)
+            await asyncio.sleep(delay)
+
+
+class GatewayClient(ChatCompletionClient):
+    """Per-agent view of an LLMGateway, usable wherever a ChatCompletionClient is expected"""
+
+    def __init__(self, gateway: LLMGateway, agent_name: str, priority: int):
+        self._gateway = gateway
+        self._agent_name = agent_name
+        self._priority = priority
+
+    @property
+    def gateway(self) -> LLMGateway:
+        return self._gateway
+
+    async def create(
+        self,
+        messages: Sequence[LLMMessage],
+        *,
+        tools: Sequence[Tool | ToolSchema] = [],
+        tool_choice: Any = "auto",
+        json_output: Optional[bool | type[BaseModel]] = None,
+        extra_create_args: Mapping[str, Any] = {},
+        cancellation_token: Optional[CancellationToken] = None,
+    ) -> CreateResult:
+        return await self._gateway.create(
+            self._agent_name,
+            self._priority,
+            messages,
+            tools=tools,
+            tool_choice=tool_choice,
+            json_output=json_output,
+            extra_create_args=extra_create_args,
+            cancellation_token=cancellation_token,
+        )
+
+    def create_stream(
+        self,
+        messages: Sequence[LLMMessage],
+        *,
+        tools: Sequence[Tool | ToolSchema] = [],
+        tool_choice: Any = "auto",
+        json_output: Optional[bool | type[BaseModel]] = None,
+        extra_create_args: Mapping[str, Any] = {},
+        cancellation_token: Optional[CancellationToken] = None,
+    ) -> AsyncGenerator[Union[str, CreateResult], None]:
+        return self._gateway.create_stream(
+            self._agent_name,
+            self._priority,
+            messages,
+            tools=tools,
+            tool_choice=tool_choice,
+            json_output=json_output,
+            extra_create_args=extra_create_args,
+            cancellation_token=cancellation_token,
+        )
+
+    async def close(self) -> None:
+        # The underlying client is shared with other agents and closed by its owner
+        pass
+
+    def actual_usage(self) -> RequestUsage:
+        return self._gateway.client.actual_usage()
+
+    def total_usage(self) -> RequestUsage:
+        return self._gateway.client.total_usage()
+
+    def count_tokens(self, messages: Sequence[LLMMessage], *, tools: Sequence[Tool | ToolSchema] = []) -> int:
+        return self._gateway.client.count_tokens(messages, tools=tools)
+
+    def remaining_tokens(self, messages: Sequence[LLMMessage], *, tools: Sequence[Tool | ToolSchema] = []) -> int:
+        return self._gateway.client.remaining_tokens(messages, tools=tools)
+
+    @property
+    def capabilities(self) -> ModelCapabilities:  # type: ignore
+        return self._gateway.client.capabilities
+
+    @property
+    def model_info(self) -> ModelInfo:
+        return self._gateway.client.model_info
@@ -0,0 +1,489 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import resource
+import shutil
+import signal
+import sys
+import tempfile
+from hashlib import sha256
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Set, Tuple, Union
+
+from autogen_core import CancellationToken
+from autogen_core.code_executor import CodeBlock, CodeExecutor
+
+import fork_server
+from autogen_ext.code_executors._common import (
+    CommandLineCodeResult,
+    get_file_name_from_content,
+    lang_to_cmd,
+    silence_pip,
+)
+
+# Runs a Python tool after installing the sandbox audit hook, written into the work_dir so that
+# the tool sees the work_dir as its script directory, like in the Docker container
+BOOTSTRAP_FILE = "_sandbox_bootstrap.py"
+SANDBOX_ENV = "CODEGENRCA_SANDBOX"
+
+# Copy of fork_server.py in the work_dir, see ForkServerCodeExecutor
+FORK_SERVER_FILE = "_fork_server.py"
+# Seconds the fork server may take to import pandas and map the preloaded files
+FORK_SERVER_START_TIMEOUT = 60
+
+BOOTSTRAP = '''import builtins
+import json
+import os
+import sys
+import types
+
+
+def install_sandbox(config):
+    read_only = tuple(os.path.join(os.path.realpath(path), "") for path in config.get("read_only_paths", []))
+    allow_network = config.get("allow_network", True)
+    write_flags = os.O_WRONLY | os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_APPEND
+
+    def protected(path):
+        if isinstance(path, int):
+            return False
+        path = os.path.realpath(os.fsdecode(path))
+        return any(os.path.join(path, "").startswith(prefix) for prefix in read_only)
+
+    def hook(event, args):
+        if event == "open":
+            path, mode, flags = args
+            writes = any(c in mode for c in "wax+") if isinstance(mode, str) else bool((flags or 0) & write_flags)
+            if writes and path is not None and protected(path):
+                raise PermissionError(f"Sandbox: {os.fsdecode(path)} is read-only")
+        elif event in ("os.remove", "os.rmdir", "os.truncate", "os.chmod", "os.chown", "os.utime", "shutil.rmtree"):
+            if args and protected(args[0]):
+                raise PermissionError(f"Sandbox: {os.fsdecode(args[0])} is read-only")
+        elif event in ("os.rename", "os.link", "os.symlink"):
+            if any(protected(path) for path in args[:2] if path is not None):
+                raise PermissionError("Sandbox: the dataset is read-only")
+        elif event in ("socket.connect", "socket.bind", "socket.sendto") and not allow_network:
+            if args[0].family != getattr(__import__("socket"), "AF_UNIX", None):
+                raise PermissionError("Sandbox: network access is disabled")
+
+    sys.addaudithook(hook)
+
+
+def run_script(path):
+    """Run a tool as __main__, exits with 1 and a traceback starting in the tool if it fails"""
+    main = types.ModuleType("__main__")
+    main.__file__ = path
+    main.__builtins__ = builtins
+    # A fresh __main__ module so classes of the tool can be pickled
+    sys.modules["__main__"] = main
+    sys.argv = [path]
+    with open(path, encoding="utf-8") as source:
+        code = compile(source.read(), path, "exec")
+    try:
+        exec(code, main.__dict__)
+    except SystemExit:
+        raise
+    except BaseException as error:
+        import traceback
+        # Drop the bootstrap frame so the traceback starts in the tool
+        traceback.print_exception(type(error), error, error.__traceback__.tb_next)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    install_sandbox(json.loads(os.environ.get("%(env)s", "{}")))
+    run_script(sys.argv[1])
+''' % {"env": SANDBOX_ENV}
+
+
+def _exit_status(output: str, exit_code: int) -> Tuple[str, int]:
+    """Report a process killed by a signal (negative exit code) like a shell does"""
+    if exit_code < 0:
+        output += f"\nProcess was killed by signal {signal.Signals(-exit_code).name}, it may have exceeded its memory or CPU time limit"
+        exit_code = 128 - exit_code
+    return output, exit_code
+
+
+class SandboxedLocalCodeExecutor(CodeExecutor):
+    """
+    Executes code blocks in local subprocesses instead of a Docker container
+
+    Meant for trusted batch runs where container startup and Docker API round-trips per
+    execution dominate the run time of short tools. Code blocks are written to the work_dir
+    and run there, the same way DockerCommandLineCodeExecutor runs them in /workspace, so
+    relative dataset paths and the telemetry package work unchanged.
+
+    Each process runs in its own session with resource limits (address space, CPU time,
+    file size, no core dumps). Python tools additionally run behind an audit hook that
+    rejects writes to the read-only paths and, unless allowed, network connections. This
+    guards against mistakes of generated code, it is not a security boundary like a container.
+
+    Args:
+        work_dir: Directory the code is written to and run in
+        timeout: Seconds a code block may run before it is killed
+        read_only_paths: Paths, relative to work_dir, tools must not modify (e.g. the dataset)
+        allow_network: Allow Python tools to open network connections
+        memory_limit_mb: Address space limit of a process, None for no limit
+        cpu_time_limit: CPU seconds limit of a process, by default twice the timeout
+        file_size_limit_mb: Largest file a process may write, None for no limit
+        max_concurrency: Code blocks run at the same time, by default the number of CPUs
+        delete_tmp_files: Delete the code files after execution
+    """
+
+    def __init__(
+        self,
+        work_dir: Union[Path, str] = "coding",
+        *,
+        timeout: int = 60,
+        read_only_paths: Sequence[str] = ("dataset",),
+        allow_network: bool = True,
+        memory_limit_mb: Optional[int] = 8192,
+        cpu_time_limit: Optional[int] = None,
+        file_size_limit_mb: Optional[int] = 1024,
+        max_concurrency: Optional[int] = None,
+        delete_tmp_files: bool = False,
+    ):
+        if timeout < 1:
+            raise ValueError("Timeout must be greater than or equal to 1.")
+        self._work_dir = Path(work_dir)
+        self._timeout = timeout
+        self._read_only_paths = [str((self._work_dir / path).resolve()) for path in read_only_paths]
+        self._allow_network = allow_network
+        self._memory_limit_mb = memory_limit_mb
+        self._cpu_time_limit = cpu_time_limit if cpu_time_limit is not None else 2 * timeout
+        self._file_size_limit_mb = file_size_limit_mb
+        self._max_concurrency = max_concurrency or os.cpu_count() or 1
+        self._delete_tmp_files = delete_tmp_files
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._processes: Set[asyncio.subprocess.Process] = set()
+        self._running = False
+
+    @property
+    def timeout(self) -> int:
+        """The timeout for code execution."""
+        return self._timeout
+
+    @property
+    def work_dir(self) -> Path:
+        return self._work_dir
+
+    def _sandbox_config(self) -> Dict[str, object]:
+        """Configuration of the audit hook installed by the bootstrap"""
+        return {"read_only_paths": self._read_only_paths, "allow_network": self._allow_network}
+
+    def _environment(self) -> Dict[str, str]:
+        env = dict(os.environ)
+        env[SANDBOX_ENV] = json.dumps(self._sandbox_config())
+        env["PYTHONUNBUFFERED"] = "1"
+        return env
+
+    def _resource_limits(self) -> Dict[str, int]:
+        """Soft resource limits of a code process, by resource module constant name"""
+        limits = {"RLIMIT_CORE": 0, "RLIMIT_CPU": self._cpu_time_limit}
+        if self._memory_limit_mb is not None:
+            limits["RLIMIT_AS"] = self._memory_limit_mb * 1024 * 1024
+        if self._file_size_limit_mb is not None:
+            limits["RLIMIT_FSIZE"] = self._file_size_limit_mb * 1024 * 1024
+        return limits
+
+    def _limit_resources(self) -> None:
+        """Runs in the child process before exec"""
+        for name, value in self._resource_limits().items():
+            limit = getattr(resource, name)
+            soft, hard = resource.getrlimit(limit)
+            if hard != resource.RLIM_INFINITY:
+                value = min(value, hard)
+            resource.setrlimit(limit, (value, hard))
+
+    @staticmethod
+    def _kill(process: asyncio.subprocess.Process) -> None:
+        """Kill the process and everything it started"""
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def _command(self, lang: str, filename: str) -> List[str]:
+        if lang in ["python", "py"]:
+            return [sys.executable, BOOTSTRAP_FILE, filename]
+        return [lang_to_cmd(lang), filename]
+
+    async def _run_file(self, lang: str, filename: str, cancellation_token: CancellationToken) -> Tuple[str, int]:
+        """Run a code file of the work_dir, returns its output and exit code"""
+        return await self._execute_command(self._command(lang, filename), cancellation_token)
+
+    async def _execute_command(self, command: List[str], cancellation_token: CancellationToken) -> Tuple[str, int]:
+        if not self._running:
+            raise ValueError("Executor is not running. Must first be started with either start or a context manager.")
+
+        async with self._semaphore:
+            return await self._run_process(command, cancellation_token)
+
+    async def _run_process(self, command: List[str], cancellation_token: CancellationToken) -> Tuple[str, int]:
+        """Run a command in a new process, the caller holds a slot of the semaphore"""
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            cwd=self._work_dir,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            env=self._environment(),
+            start_new_session=True,
+            preexec_fn=self._limit_resources,
+        )
+        self._processes.add(process)
+        exec_task = asyncio.ensure_future(process.communicate())
+        cancellation_token.link_future(exec_task)
+        try:
+            async with asyncio.timeout(self._timeout):
+                stdout, _ = await exec_task
+        except TimeoutError:
+            self._kill(process)
+            await process.wait()
+            # Same exit code and message as the timeout command in the container
+            return "\n Timeout", 124
+        except asyncio.CancelledError:
+            self._kill(process)
+            await process.wait()
+            if asyncio.current_task().cancelling():
+                raise
+            return "Code execution was cancelled.", 1
+        finally:
+            self._processes.discard(process)
+
+        return _exit_status(stdout.decode("utf-8", errors="replace"), process.returncode)
+
+    async def execute_code_blocks(
+        self, code_blocks: List[CodeBlock], cancellation_token: CancellationToken
+    ) -> CommandLineCodeResult:
+        """Execute the code blocks and return the result.
+
+        Args:
+            code_blocks (List[CodeBlock]): The code blocks to execute.
+
+        Returns:
+            CommandlineCodeResult: The result of the code execution."""
+        if len(code_blocks) == 0:
+            raise ValueError("No code blocks to execute.")
+
+        outputs: List[str] = []
+        files: List[Path] = []
+        last_exit_code = 0
+        try:
+            for code_block in code_blocks:
+                lang = code_block.language.lower()
+                code = silence_pip(code_block.code, lang)
+
+                # Check if there is a filename comment
+                try:
+                    filename = get_file_name_from_content(code, self.work_dir)
+                except ValueError:
+                    outputs.append("Filename is not in the workspace")
+                    last_exit_code = 1
+                    break
+
+                if not filename:
+                    filename = f"tmp_code_{sha256(code.encode()).hexdigest()}.{lang}"
+
+                code_path = self.work_dir / filename
+                with code_path.open("w", encoding="utf-8") as fout:
+                    fout.write(code)
+                files.append(code_path)
+
+                output, exit_code = await self._run_file(lang, filename, cancellation_token)
+                outputs.append(output)
+                last_exit_code = exit_code
+                if exit_code != 0:
+                    break
+        finally:
+            if self._delete_tmp_files:
+                for file in files:
+                    try:
+                        file.unlink()
+                    except (OSError, FileNotFoundError):
+                        pass
+
+        code_file = str(files[0]) if files else None
+        return CommandLineCodeResult(exit_code=last_exit_code, output="".join(outputs), code_file=code_file)
+
+    async def restart(self) -> None:
+        """Kill all running code blocks."""
+        for process in list(self._processes):
+            self._kill(process)
+
+    async def start(self) -> None:
+        self._work_dir.mkdir(exist_ok=True, parents=True)
+        (self._work_dir / BOOTSTRAP_FILE).write_text(BOOTSTRAP, encoding="utf-8")
+        self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        self._running = True
+        logging.debug(f"Local executor started in {self._work_dir.resolve()}")
+
+    async def stop(self) -> None:
+        """Stop the code executor, killing running code blocks."""
+        if not self._running:
+            return
+        await self.restart()
+        self._running = False
+
+
+class ForkServerCodeExecutor(SandboxedLocalCodeExecutor):
+    """
+    Executes Python code blocks in children forked from a preloaded server process
+
+    The server (fork_server.py) imports pandas, numpy and the telemetry loader once and
+    optionally maps files of the dataset into memory. Every Python code block then runs in a
+    copy-on-write child with its own session, resource limits and sandbox hook, so tools stay
+    isolated from each other without paying for interpreter startup and imports on every
+    run. Other languages, and Python if the server cannot be started, run in new processes
+    like in SandboxedLocalCodeExecutor.
+
+    Args:
+        work_dir: Directory the code is written to and run in
+        preload_modules: Modules the server imports, by default numpy, pandas and the telemetry loader
+        preload_paths: Files or directories, relative to work_dir, the server maps into memory
+        **kwargs: Sandbox and limit settings of SandboxedLocalCodeExecutor
+    """
+
+    def __init__(
+        self,
+        work_dir: Union[Path, str] = "coding",
+        *,
+        preload_modules: Optional[Sequence[str]] = None,
+        preload_paths: Sequence[str] = (),
+        **kwargs,
+    ):
+        super().__init__(work_dir, **kwargs)
+        self._preload_modules = list(preload_modules) if preload_modules is not None else None
+        self._preload_paths = [str((self._work_dir / path).resolve()) for path in preload_paths]
+        self._server: Optional[asyncio.subprocess.Process] = None
+        self._socket_dir: Optional[str] = None
+        self._tool_pids: Set[int] = set()
+
+    @property
+    def socket_path(self) -> str:
+        return os.path.join(self._socket_dir, "fork.sock")
+
+    async def _start_server(self) -> None:
+        await self._stop_server()
+        shutil.copyfile(fork_server.__file__, self._work_dir / FORK_SERVER_FILE)
+        # Unix socket paths are limited to about 100 characters, so not in the work_dir
+        self._socket_dir = tempfile.mkdtemp(prefix="codegenrca-fork-")
+        config = {
+            "sandbox": self._sandbox_config(),
+            "rlimits": self._resource_limits(),
+            "preload_paths": self._preload_paths,
+        }
+        if self._preload_modules is not None:
+            config["preload_modules"] = self._preload_modules
+        self._server = await asyncio.create_subprocess_exec(
+            sys.executable, FORK_SERVER_FILE, self.socket_path, json.dumps(config),
+            cwd=self._work_dir,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            env=self._environment(),
+            start_new_session=True,
+        )
+        try:
+            ready = await asyncio.wait_for(self._server.stdout.readline(), FORK_SERVER_START_TIMEOUT)
+        except BaseException:
+            await self._stop_server()
+            raise
+        if ready.strip() != b"ready":
+            await self._stop_server()
+            raise RuntimeError("Fork server exited before it was ready")
+
+    async def _stop_server(self) -> None:
+        if self._server is not None:
+            self._kill(self._server)
+            await self._server.wait()
+            self._server = None
+        if self._socket_dir is not None:
+            shutil.rmtree(self._socket_dir, ignore_errors=True)
+            self._socket_dir = None
+
+    async def _ensure_server(self) -> bool:
+        """Start the server if it is not running, False if it cannot be started"""
+        if self._server is not None and self._server.returncode is None:
+            return True
+        try:
+            await self._start_server()
+            return True
+        except (OSError, RuntimeError, TimeoutError) as e:
+            print(f"[Executor] Fork server unavailable, running tools in new processes: {e}")
+            return False
+
+    async def _read_result(self, reader: asyncio.StreamReader, pids: List[int]) -> Tuple[str, int]:
+        first = await reader.readline()
+        if first.strip().isdigit():
+            # Known before the tool's output, so a tool that runs too long can be killed
+            pids.append(int(first))
+            self._tool_pids.add(pids[0])
+            data = await reader.read()
+        else:
+            data = first + await reader.read()
+        end = data.rfind(fork_server.EXIT_MARKER)
+        if end < 0:
+            return data.decode("utf-8", errors="replace") + "\nFork server stopped during execution", 1
+        exit_code = int(data[end + len(fork_server.EXIT_MARKER):])
+        return _exit_status(data[:end].decode("utf-8", errors="replace"), exit_code)
+
+    def _kill_tool(self, pids: List[int]) -> None:
+        for pid in pids:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    async def _run_file(self, lang: str, filename: str, cancellation_token: CancellationToken) -> Tuple[str, int]:
+        if lang not in ["python", "py"] or not await self._ensure_server():
+            return await super()._run_file(lang, filename, cancellation_token)
+
+        async with self._semaphore:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.socket_path)
+            except OSError as e:
+                print(f"[Executor] Could not reach the fork server, running {filename} in a new process: {e}")
+                # This run already holds a slot of the semaphore
+                return await self._run_process(self._command(lang, filename), cancellation_token)
+            pids: List[int] = []
+            try:
+                writer.write(json.dumps({"script": filename}).encode() + b"\n")
+                await writer.drain()
+                exec_task = asyncio.ensure_future(self._read_result(reader, pids))
+                cancellation_token.link_future(exec_task)
+                async with asyncio.timeout(self._timeout):
+                    return await exec_task
+            except TimeoutError:
+                if pids:
+                    self._kill_tool(pids)
+                else:
+                    # The server did not even start the tool, restart it with the next run
+                    print(f"[Executor] Fork server did not start {filename} in time, stopping it")
+                    await self._stop_server()
+                # Same exit code and message as the timeout command in the container
+                return "\n Timeout", 124
+            except asyncio.CancelledError:
+                self._kill_tool(pids)
+                if asyncio.current_task().cancelling():
+                    raise
+                return "Code execution was cancelled.", 1
+            finally:
+                self._tool_pids.difference_update(pids)
+                writer.close()
+
+    async def restart(self) -> None:
+        """Kill all running code blocks."""
+        await super().restart()
+        self._kill_tool(list(self._tool_pids))
+
+    async def start(self) -> None:
+        await super().start()
+        await self._ensure_server()
+
+    async def stop(self) -> None:
+        """Stop the code executor and its fork server, killing running code blocks."""
+        if not self._running:
+            return
+        await super().stop()
+        await self._stop_server()
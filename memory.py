@@ -1,7 +1,21 @@
+import asyncio
+import hashlib
 import json
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from autogen_core.memory import ListMemory, MemoryContent, MemoryMimeType
-import asyncio
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from autogen_core import CancellationToken
+from autogen_core.memory import Memory, MemoryContent, MemoryMimeType, MemoryQueryResult, UpdateContextResult
+from autogen_core.model_context import ChatCompletionContext
+from autogen_core.models import SystemMessage, UserMessage
+
 
 def load_metadata():
     metadata_path = Path(__file__).parent / "memory.json"
@@ -10,84 +24,322 @@ def load_metadata():
 
 METADATA = load_metadata()
 
-planer_memory = ListMemory()
-investigator_memory = ListMemory()
-log_explorer_memory = ListMemory()
-metric_explorer_memory = ListMemory()
-trace_explorer_memory = ListMemory()
-coder_memory = ListMemory()
-reasoner_memory = ListMemory()
+# Past diagnoses and entries added at runtime, one JSON object per line
+MEMORY_STORE_PATH = os.environ.get("CODEGENRCA_MEMORY_STORE", str(Path(__file__).parent / "memory_store.jsonl"))
+
+# Past diagnoses injected into an agent's context per model call
+DEFAULT_TOP_K = 5
+
+# memory.json describes the Bank system (the Tomcat, IG and MG schemas and its topology)
+METADATA_DATASET = "Bank"
+
+# Sections of memory.json read by each agent
+AGENT_SECTIONS = {
+    "planner": ["planer"],
+    "investigator": ["investigator"],
+    "metric_explorer": ["metric"],
+    "log_explorer": ["log"],
+    "trace_explorer": ["trace"],
+    "reasoner": ["reasoner"],
+    "coder": ["coder"],
+}
+
+# Keys of memory.json that hold heuristic rules rather than data descriptions
+RULE_KEYS = {"advice", "anomaly_threshold", "metric_priority", "system_topology_priority"}
+
+# Agents that see the outcome of past diagnoses
+DIAGNOSIS_AGENTS = ["planner", "investigator", "reasoner"]
+
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+SUBTOKEN_PATTERN = re.compile(r"[a-z]+|[0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-case words, with mixed tokens also split into letters and digits (tomcat01 -> tomcat, 01)"""
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        parts = SUBTOKEN_PATTERN.findall(token)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+
+@dataclass
+class MemoryEntry:
+    """One retrievable piece of long-term memory"""
+    agent: str
+    kind: str  # "metadata", "rule" or "diagnosis"
+    text: str
+    source: str = ""
+    created: float = field(default_factory=time.time)
+    dataset: str = ""  # Dataset the entry is about, "" for every dataset
+    window: str = ""  # Diagnosis window of a past diagnosis
+
+    @property
+    def id(self) -> str:
+        return hashlib.sha1(f"{self.agent}\0{self.kind}\0{self.text}".encode()).hexdigest()
+
+
+@dataclass
+class MemoryScope:
+    """
+    Diagnosis the memories of a workflow's agents serve, set by the workflow per query
+
+    Entries of other datasets are left out, and so are past diagnoses of the same window, so a
+    re-run never gets its own earlier answer back.
+    """
+    dataset: Optional[str] = None
+    window: Optional[str] = None
+
+    def admits(self, entry: MemoryEntry) -> bool:
+        if entry.dataset and entry.dataset != self.dataset:
+            return False
+        return not (entry.kind == "diagnosis" and self.window is not None and entry.window == self.window)
+
 
+class MemoryStore:
+    """
+    Long-term memory of all agents
 
-async def add_planer_memory():
-    content = json.dumps(METADATA["planer"], ensure_ascii=False)
-    await planer_memory.add(
-        MemoryContent(
-            content=content,
-            mime_type=MemoryMimeType.TEXT,
-        )
-    )
+    Entries come from memory.json (data descriptions and heuristic rules, split per key) and
+    from past diagnoses, which are appended to a JSON lines file. Adding an entry that is
+    already stored does nothing, so loading is idempotent however often a workflow is created.
 
+    Args:
+        path: JSON lines file of the persistent entries, None to keep them in memory only
+    """
 
-async def add_investigator_memory():
-    content = json.dumps(METADATA["investigator"], ensure_ascii=False)
-    await investigator_memory.add(
-        MemoryContent(
-            content=content,
-            mime_type=MemoryMimeType.TEXT,
-        )
-    )
+    def __init__(self, path: Optional[str] = MEMORY_STORE_PATH):
+        self.path = path
+        self._entries: Dict[str, MemoryEntry] = {}
+        self._terms: Dict[str, Counter] = {}
+        self._lock = threading.Lock()
+        # Per agent document frequencies and average length, rebuilt after changes
+        self._stats: Dict[str, Tuple[Dict[str, int], float]] = {}
 
+    def add(self, entry: MemoryEntry, persist: bool = False) -> bool:
+        """
+        Add an entry unless it is already stored
 
-async def add_log_explorer_memory():
-    content = json.dumps(METADATA["log"], ensure_ascii=False)
-    await log_explorer_memory.add(
-        MemoryContent(
-            content=content,
-            mime_type=MemoryMimeType.TEXT,
-        )
-    )
+        Args:
+            entry: Entry to add
+            persist: Append the entry to the store file
 
+        Returns:
+            bool: True if the entry was new
+        """
+        with self._lock:
+            if entry.id in self._entries:
+                return False
+            self._entries[entry.id] = entry
+            self._terms[entry.id] = Counter(tokenize(entry.text))
+            self._stats.pop(entry.agent, None)
+            if persist and self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(asdict(entry), ensure_ascii=False) + "\n")
+            return True
 
-async def add_metric_explorer_memory():
-    content = json.dumps(METADATA["metric"], ensure_ascii=False)
-    await metric_explorer_memory.add(
-        MemoryContent(
-            content=content,
-            mime_type=MemoryMimeType.TEXT,
-        )
-    )
+    def remove(self, agent: str, kind: Optional[str] = None) -> None:
+        """Remove the entries of an agent, only those of one kind if given"""
+        with self._lock:
+            for entry_id in [i for i, e in self._entries.items() if e.agent == agent and (kind is None or e.kind == kind)]:
+                del self._entries[entry_id]
+                del self._terms[entry_id]
+            self._stats.pop(agent, None)
 
+    def load_file(self) -> int:
+        """Load the persistent entries, returns the number of new entries"""
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        added = 0
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    added += self.add(MemoryEntry(**json.loads(line)))
+                except (TypeError, ValueError):
+                    continue
+        return added
 
-async def add_trace_explorer_memory():
-    content = json.dumps(METADATA["trace"], ensure_ascii=False)
-    await trace_explorer_memory.add(
-        MemoryContent(
-            content=content,
-            mime_type=MemoryMimeType.TEXT,
-        )
-    )
+    def entries(self, agent: str) -> List[MemoryEntry]:
+        return [entry for entry in self._entries.values() if entry.agent == agent]
 
+    def _agent_stats(self, agent: str) -> Tuple[Dict[str, int], float]:
+        stats = self._stats.get(agent)
+        if stats is None:
+            document_frequency: Counter = Counter()
+            lengths = []
+            for entry_id, entry in self._entries.items():
+                if entry.agent == agent:
+                    document_frequency.update(self._terms[entry_id].keys())
+                    lengths.append(sum(self._terms[entry_id].values()))
+            stats = self._stats[agent] = (document_frequency, sum(lengths) / len(lengths) if lengths else 0.0)
+        return stats
 
+    def search(self, agent: str, query: str, top_k: int = DEFAULT_TOP_K,
+               scope: Optional[MemoryScope] = None) -> List[Tuple[MemoryEntry, float]]:
+        """
+        Memory of an agent for a query
 
+        The data descriptions and rules of the agent are small and always returned. Past
+        diagnoses are ranked with BM25, those that share no term with the query are left out.
 
-async def add_reasoner_memory():
-    content = json.dumps(METADATA["reasoner"], ensure_ascii=False)
-    await reasoner_memory.add(
-        MemoryContent(
-            content=content,
-            mime_type=MemoryMimeType.TEXT,
-        )
-    )
+        Args:
+            agent: Agent name, see AGENT_SECTIONS
+            query: Text to match, usually the message the agent is answering
+            top_k: Maximum number of past diagnoses
+            scope: Dataset and window of the current diagnosis, None for every entry
 
+        Returns:
+            List of (entry, BM25 score): the metadata and rules in stored order (score 0),
+            then the past diagnoses, best first
+        """
+        with self._lock:
+            document_frequency, average_length = self._agent_stats(agent)
+            candidates = [(i, e) for i, e in self._entries.items() if e.agent == agent]
+            fixed = [(entry, 0.0) for _, entry in candidates
+                     if entry.kind != "diagnosis" and (scope is None or scope.admits(entry))]
+            query_terms = set(tokenize(query))
+            scored = []
+            for entry_id, entry in candidates:
+                if entry.kind != "diagnosis" or (scope is not None and not scope.admits(entry)):
+                    continue
+                terms = self._terms[entry_id]
+                length = sum(terms.values())
+                score = 0.0
+                for term in query_terms & terms.keys():
+                    idf = math.log(1 + (len(candidates) - document_frequency[term] + 0.5) / (document_frequency[term] + 0.5))
+                    tf = terms[term]
+                    score += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / (average_length or 1)))
+                if score > 0:
+                    scored.append((entry, score))
+            scored.sort(key=lambda item: (-item[1], -item[0].created))
+            return fixed + scored[:top_k]
+
+
+def metadata_entries(agent: str, sections: Iterable[str], metadata: Dict[str, Any] = METADATA,
+                     dataset: str = METADATA_DATASET) -> List[MemoryEntry]:
+    """Split the memory.json sections of an agent into one entry per key, all about one dataset"""
+    entries = []
+
+    def walk(value: Any, path: List[str]) -> None:
+        if isinstance(value, dict):
+            if all(isinstance(v, str) and key not in RULE_KEYS for key, v in value.items()):
+                # Field descriptions stay together
+                text = "; ".join(f"{key}: {description}" for key, description in value.items())
+                entries.append(MemoryEntry(agent, "metadata", f"{' '.join(path)}: {text}", source="memory.json",
+                                           dataset=dataset))
+                return
+            for key, child in value.items():
+                walk(child, path + [key])
+            return
+        if isinstance(value, list):
+            text = ", ".join(str(item) for item in value)
+        else:
+            text = str(value)
+        kind = "rule" if path[-1] in RULE_KEYS else "metadata"
+        entries.append(MemoryEntry(agent, kind, f"{' '.join(path)}: {text}", source="memory.json", dataset=dataset))
+
+    for section in sections:
+        if section in metadata:
+            walk(metadata[section], [section])
+    return entries
+
+
+class RetrievalMemory(Memory):
+    """
+    Memory of one agent, injects its data descriptions and rules and the past diagnoses most
+    relevant to the current request
+
+    Before each model call the last user message of the agent's context is used as the
+    query, and the entries are added as a system message.
+
+    Args:
+        agent: Agent name, see AGENT_SECTIONS
+        store: Shared store of all agents
+        top_k: Past diagnoses injected per model call
+        scope: Dataset and window of the workflow's current diagnosis, None for every entry
+    """
+
+    def __init__(self, agent: str, store: MemoryStore, top_k: int = DEFAULT_TOP_K, scope: Optional[MemoryScope] = None):
+        self.agent = agent
+        self.store = store
+        self.top_k = top_k
+        self.scope = scope
+
+    async def update_context(self, model_context: ChatCompletionContext) -> UpdateContextResult:
+        messages = await model_context.get_messages()
+        query = next((m.content for m in reversed(messages) if isinstance(m, UserMessage) and isinstance(m.content, str)), "")
+        result = await self.query(query)
+        if result.results:
+            memory_strings = [f"{i}. {memory.content}" for i, memory in enumerate(result.results, 1)]
+            memory_context = "\nRelevant memory content:\n" + "\n".join(memory_strings) + "\n"
+            await model_context.add_message(SystemMessage(content=memory_context))
+        return UpdateContextResult(memories=result)
+
+    async def query(self, query: str | MemoryContent, cancellation_token: CancellationToken | None = None, **kwargs: Any) -> MemoryQueryResult:
+        text = query.content if isinstance(query, MemoryContent) else query
+        hits = self.store.search(self.agent, str(text), kwargs.get("top_k", self.top_k), self.scope)
+        return MemoryQueryResult(results=[
+            MemoryContent(content=entry.text, mime_type=MemoryMimeType.TEXT,
+                          metadata={"kind": entry.kind, "source": entry.source, "score": round(score, 3)})
+            for entry, score in hits
+        ])
+
+    async def add(self, content: MemoryContent, cancellation_token: CancellationToken | None = None) -> None:
+        kind = (content.metadata or {}).get("kind", "rule")
+        self.store.add(MemoryEntry(self.agent, kind, str(content.content), source="runtime"), persist=True)
+
+    async def clear(self) -> None:
+        self.store.remove(self.agent)
+
+    async def close(self) -> None:
+        pass
+
+
+memory_store = MemoryStore()
+
+
+def agent_memories(scope: Optional[MemoryScope] = None) -> Dict[str, RetrievalMemory]:
+    """Memories of one workflow's agents, sharing the process-wide store, by agent name"""
+    return {agent: RetrievalMemory(agent, memory_store, scope=scope) for agent in AGENT_SECTIONS}
+
+_loaded = False
+_load_lock = asyncio.Lock()
 
 
 async def load_memory():
-    await add_planer_memory()
-    await add_investigator_memory()
-    await add_log_explorer_memory()
-    await add_metric_explorer_memory()
-    await add_trace_explorer_memory()
-    await add_reasoner_memory()
+    """Load memory.json and the stored past diagnoses once per process"""
+    global _loaded
+    async with _load_lock:
+        if _loaded:
+            return
+        for agent, sections in AGENT_SECTIONS.items():
+            for entry in metadata_entries(agent, sections):
+                memory_store.add(entry)
+        memory_store.load_file()
+        _loaded = True
+
+
+def record_diagnosis(query: str, answer: str, window: Optional[str] = None, dataset: Optional[str] = None) -> None:
+    """
+    Remember the outcome of a diagnosis for the planner, investigator and reasoner of later ones
 
+    Answers are not verified, so workflows only record them when asked to (record_memory),
+    and a diagnosis of the same window never retrieves them (see MemoryScope).
 
+    Args:
+        query: The user's RCA query
+        answer: Root cause answer of the diagnosis (the reasoner's JSON)
+        window: Description of the diagnosis window
+        dataset: Dataset of the query
+    """
+    header = " ".join(part for part in (dataset, window) if part)
+    text = f"past diagnosis {header}: query: {query} answer: {answer}"
+    for agent in DIAGNOSIS_AGENTS:
+        memory_store.add(MemoryEntry(agent, "diagnosis", text, source="diagnosis", dataset=dataset or "",
+                                     window=window or ""), persist=True)
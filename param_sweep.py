@@ -0,0 +1,325 @@
+import ast
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from autogen_core.code_executor import CodeBlock
+
+# Tools expose their tunable thresholds through a module-level dict, e.g.
+#
+#   TUNABLE_PARAMETERS = {
+#       "SLOPE_THRESHOLD": {"range": [5.0, 40.0], "stricter": "higher"},
+#       "FINAL_FILTER_X": {"values": [0.2, 0.3, 0.4, 0.6], "stricter": "higher"},
+#   }
+#
+# "stricter" tells in which direction the parameter reduces the number of
+# detected anomaly events. The parameter itself must be assigned a numeric
+# literal somewhere in the code (`NAME = 15.0` or `self.NAME = 15.0`).
+TUNABLE_PARAMETERS_NAME = "TUNABLE_PARAMETERS"
+
+
+@dataclass
+class TunableParameter:
+    name: str
+    default: float
+    stricter: str = "higher"
+    low: Optional[float] = None
+    high: Optional[float] = None
+    values: List[float] = field(default_factory=list)
+    is_int: bool = False
+
+    def stricter_end(self) -> float:
+        """Value at the strict end of the declared range"""
+        if self.values:
+            return max(self.values) if self.stricter == "higher" else min(self.values)
+        return self.high if self.stricter == "higher" else self.low
+
+    def looser_end(self) -> float:
+        """Value at the loose end of the declared range"""
+        if self.values:
+            return min(self.values) if self.stricter == "higher" else max(self.values)
+        return self.low if self.stricter == "higher" else self.high
+
+    def cast(self, value: float) -> float:
+        if self.is_int:
+            return int(round(value))
+        return round(float(value), 6)
+
+
+@dataclass
+class SweepResult:
+    success: bool
+    values: Dict[str, float]
+    code: str
+    output: str = ""
+    event_count: int = 0
+    evaluations: int = 0
+    history: List[Tuple[Dict[str, float], int]] = field(default_factory=list)
+    code_blocks: List[CodeBlock] = field(default_factory=list)
+
+    def summary(self) -> str:
+        """Short text summary of the tried settings, used in refine messages"""
+        tried = "; ".join(
+            f"{', '.join(f'{k}={v}' for k, v in values.items())} -> {count} events"
+            for values, count in self.history
+        )
+        return f"{len(self.history)} settings tried: {tried}" if tried else "no settings tried"
+
+
+def _literal_number(node: ast.AST) -> Optional[float]:
+    """Return the numeric value of a literal node (supports unary minus)"""
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return node.value
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        value = _literal_number(node.operand)
+        return -value if value is not None else None
+    return None
+
+
+def _assigned_name(target: ast.AST) -> Optional[str]:
+    if isinstance(target, ast.Name):
+        return target.id
+    if isinstance(target, ast.Attribute):
+        return target.attr
+    return None
+
+
+def _find_assignments(tree: ast.AST) -> Dict[str, List[ast.AST]]:
+    """Map parameter names to the literal value nodes assigned to them"""
+    assignments: Dict[str, List[ast.AST]] = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign):
+            targets, value = node.targets, node.value
+        elif isinstance(node, ast.AnnAssign) and node.value is not None:
+            targets, value = [node.target], node.value
+        else:
+            continue
+        if _literal_number(value) is None:
+            continue
+        for target in targets:
+            name = _assigned_name(target)
+            if name:
+                assignments.setdefault(name, []).append(value)
+    return assignments
+
+
+def extract_tunable_parameters(code: str) -> Dict[str, TunableParameter]:
+    """
+    Extract the tunable parameters declared by a generated tool
+
+    Args:
+        code: Python source of the tool
+
+    Returns:
+        dict: Parameter name -> TunableParameter, in declaration order. Empty if the
+        tool declares nothing or the declaration cannot be evaluated statically.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return {}
+
+    declaration = None
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign) and any(
+            _assigned_name(target) == TUNABLE_PARAMETERS_NAME for target in node.targets
+        ):
+            declaration = node.value
+            break
+    if declaration is None:
+        return {}
+
+    try:
+        spec = ast.literal_eval(declaration)
+    except (ValueError, SyntaxError):
+        return {}
+    if not isinstance(spec, dict):
+        return {}
+
+    assignments = _find_assignments(tree)
+    parameters: Dict[str, TunableParameter] = {}
+    for name, options in spec.items():
+        if name not in assignments or not isinstance(options, dict):
+            continue
+        default = _literal_number(assignments[name][0])
+        stricter = str(options.get("stricter", "higher")).lower()
+        if stricter not in ("higher", "lower"):
+            stricter = "higher"
+        param = TunableParameter(
+            name=name,
+            default=default,
+            stricter=stricter,
+            is_int=isinstance(default, int),
+        )
+        values = options.get("values")
+        value_range = options.get("range")
+        if isinstance(values, (list, tuple)) and values:
+            param.values = [v for v in values if isinstance(v, (int, float))]
+        elif isinstance(value_range, (list, tuple)) and len(value_range) == 2:
+            param.low, param.high = sorted(float(v) for v in value_range)
+        else:
+            continue
+        if not param.values and param.low is None:
+            continue
+        parameters[name] = param
+    return parameters
+
+
+def apply_parameter_values(code: str, values: Dict[str, float]) -> str:
+    """
+    Rewrite the literal assignments of the given parameters in the code
+
+    Args:
+        code: Python source of the tool
+        values: Parameter name -> new value
+
+    Returns:
+        str: The rewritten source, the TUNABLE_PARAMETERS declaration itself is kept as-is
+    """
+    tree = ast.parse(code)
+    assignments = _find_assignments(tree)
+    lines = code.split("\n")
+    edits = []
+    for name, value in values.items():
+        for node in assignments.get(name, []):
+            edits.append((node.lineno, node.col_offset, node.end_lineno, node.end_col_offset, repr(value)))
+
+    # Apply edits from the end of the file so earlier offsets stay valid
+    for lineno, col, end_lineno, end_col, text in sorted(edits, reverse=True):
+        if lineno != end_lineno:
+            continue
+        line = lines[lineno - 1]
+        # ast offsets are in utf-8 bytes
+        encoded = line.encode("utf-8")
+        lines[lineno - 1] = (encoded[:col] + text.encode("utf-8") + encoded[end_col:]).decode("utf-8")
+    return "\n".join(lines)
+
+
+async def sweep_parameters(
+    code: str,
+    run: Callable[[str], Awaitable[Tuple[str, int]]],
+    count_events: Callable[[str], int],
+    min_count: int,
+    max_count: int,
+    max_evaluations: int = 8,
+    bisection_steps: int = 3,
+    baseline: Optional[Tuple[int, str]] = None,
+) -> Optional[SweepResult]:
+    """
+    Search the declared tunable parameters until the event count falls within bounds
+
+    Parameters are tried in declaration order. Each one is first moved to the strict
+    (or loose) end of its range; if that overshoots the bounds, the value is bisected
+    between its current setting and that end. If the end itself is still not enough,
+    the parameter is kept there and the next parameter is tried on top of it.
+
+    Args:
+        code: Python source of the tool
+        run: Coroutine executing a source and returning (output, exit_code)
+        count_events: Function returning the number of anomaly events in an output
+        min_count: Minimum acceptable event count
+        max_count: Maximum acceptable event count
+        max_evaluations: Maximum number of executions of the tool
+        bisection_steps: Maximum bisection steps per parameter
+        baseline: (event count, output) of the tool at its default values if it has
+            already been run, so that run is not repeated
+
+    Returns:
+        SweepResult or None if the tool declares no tunable parameters
+    """
+    parameters = extract_tunable_parameters(code)
+    if not parameters:
+        return None
+
+    current = {name: param.default for name, param in parameters.items()}
+    result = SweepResult(success=False, values=dict(current), code=code)
+    cache: Dict[Tuple[Tuple[str, float], ...], Tuple[int, str]] = {}
+
+    def record(values: Dict[str, float], source: str, count: int, output: str) -> Tuple[int, str]:
+        cache[tuple(sorted(values.items()))] = (count, output)
+        result.history.append((dict(values), count))
+        if min_count <= count <= max_count:
+            result.success = True
+            result.values = dict(values)
+            result.code = source
+            result.output = output
+            result.event_count = count
+        return count, output
+
+    async def evaluate(values: Dict[str, float]) -> Optional[Tuple[int, str]]:
+        key = tuple(sorted(values.items()))
+        if key in cache:
+            return cache[key]
+        if result.evaluations >= max_evaluations:
+            return None
+        result.evaluations += 1
+        source = apply_parameter_values(code, values)
+        output, exit_code = await run(source)
+        # A crashing setting is treated as unusable in both directions
+        count = count_events(output) if exit_code == 0 else -1
+        return record(values, source, count, output)
+
+    if baseline is not None:
+        baseline = record(current, code, *baseline)
+    else:
+        baseline = await evaluate(current)
+    if baseline is None or result.success:
+        return result
+    too_many = baseline[0] > max_count
+
+    for name, param in parameters.items():
+        target = param.stricter_end() if too_many else param.looser_end()
+        start = current[name]
+        if param.cast(target) == param.cast(start):
+            continue
+
+        trial = dict(current, **{name: param.cast(target)})
+        outcome = await evaluate(trial)
+        if outcome is None:
+            break
+        if result.success:
+            return result
+        count = outcome[0]
+        still_too_many = count > max_count
+        if count >= 0 and still_too_many == too_many:
+            # Even the end of the range is not enough, keep it and move on
+            current = trial
+            continue
+
+        # Overshot: search between the current setting and the end of the range
+        if param.values:
+            moving_up = target > start
+            candidates = sorted(
+                (v for v in param.values if _between(v, start, target)),
+                reverse=not moving_up,
+            )
+            for value in candidates:
+                outcome = await evaluate(dict(current, **{name: param.cast(value)}))
+                if outcome is None or result.success:
+                    return result
+        else:
+            near, far = start, target
+            for _ in range(bisection_steps):
+                middle = param.cast((near + far) / 2)
+                if middle in (param.cast(near), param.cast(far)):
+                    break
+                outcome = await evaluate(dict(current, **{name: middle}))
+                if outcome is None or result.success:
+                    return result
+                if outcome[0] >= 0 and (outcome[0] > max_count) == too_many:
+                    near = middle
+                else:
+                    far = middle
+
+    return result
+
+
+def _between(value: float, start: float, end: float) -> bool:
+    low, high = sorted((start, end))
+    return low < value <= high or low <= value < high
+
+
+def swap_code_block(code_blocks: List[CodeBlock], index: int, code: str) -> List[CodeBlock]:
+    """Return a copy of code_blocks where the block at index carries the new code"""
+    swapped = list(code_blocks)
+    swapped[index] = CodeBlock(code=code, language=code_blocks[index].language)
+    return swapped
@@ -110,12 +110,47 @@ please analyze the root cause and give suggestions.
 """
 
 
+cached_reasoning_msg_template = """
+<user query>
+{user_query}
+</user query>
+<failure information>
+{queried_issue}
+</failure information>
+<diagnosis plan>
+{diagnosis_plan}
+</diagnosis plan>
+investigation results: {diagnosis_events}
+
+The failure window of this query has already been investigated for another question about the same incident (earlier query: {cached_query}), the plan and investigation results above come from that investigation.
+This query asks for: {targets}. Analyze the root cause with respect to these elements only and omit the other fields in the JSON.
+"""
 
 
 
 
 
 
+
+
+speculative_scan_tasks = {
+    "metric_explorer": "Detect metric anomalies of all components within {window}, following the metric investigation workflow.",
+    "log_explorer": "Detect log anomalies of all components within {window}, following the log investigation workflow.",
+    "trace_explorer": "Detect trace anomalies of all components within {window}, following the trace investigation workflow.",
+}
+
+
+speculative_result_prompt = """
+<precomputed window scan>
+A standard scan of this modality was already run while the plan was being made.
+Scan task: {scan_task}
+Scan results:
+{scan_result}
+</precomputed window scan>
+If these results already answer the investigate task, treat this scan as the suitable tool and summarize its results in the anomaly_event format. Otherwise, return "NEED_TOOL_GENERATION".
+"""
+
+
 explorer_task_prompt = """
 <investigate task>
 {task}
@@ -158,8 +193,95 @@ Note: If the tool's execution results based on this modality show no detected an
 """
 
 
+tunable_parameters_guide = """
+<tunable_parameters>
+Declare the detection thresholds of your tool in a module-level dictionary named TUNABLE_PARAMETERS, so that the Executor can tune them locally when the number of anomaly events is out of range.
+Each threshold must also be assigned a numeric literal in the code (e.g. `SLOPE_THRESHOLD = 15.0` or `self.SLOPE_THRESHOLD = 15.0`), and `stricter` tells which direction produces fewer anomaly events:
+```
+TUNABLE_PARAMETERS = {
+    "SLOPE_THRESHOLD": {"range": [5.0, 40.0], "stricter": "higher"},
+    "FINAL_FILTER_X": {"values": [0.1, 0.2, 0.3, 0.5], "stricter": "higher"},
+}
+```
+List the most influential threshold first.
+</tunable_parameters>
+"""
+
 
+diagnosis_window_prompt = """
+<diagnosis_window>
+The query has already been parsed, use these values instead of working them out from the query text:
+- Dataset: {dataset}
+- Time range: {window} (epoch seconds {start} to {end})
+- Extended time range for baselines: {extended_window} (epoch seconds {extended_start} to {extended_end})
+- Number of failures: {num_failures}
+- Telemetry directory: {telemetry_dir}
+</diagnosis_window>
+"""
 
 
+telemetry_catalog_prompt = """
+<telemetry_catalog>
+The files of the day have already been catalogued, do not write a tool just to list the available components, KPIs or services:
+{catalog}
+Values left out above are returned by `from telemetry.catalog import list_values; list_values(f"{{TELEMETRY_DIR}}/metric/metric_container.csv", "kpi_name")`.
+</telemetry_catalog>
+"""
 
 
+tool_window_prompt = """
+<diagnosis_window>
+The diagnosis window is {window}. Copy these constants to the top of your tool and use them for every file path and time filter, do not compute dates or timestamps yourself:
+```python
+{parameters}
+```
+The *_MS constants are the same times in milliseconds, for timestamp columns stored in milliseconds.
+Load telemetry with the window-aware loader, which only keeps the rows inside the window and handles millisecond timestamp columns itself:
+```python
+from telemetry.loader import load_window
+df = load_window(f"{{TELEMETRY_DIR}}/metric/metric_container.csv", WINDOW_START, WINDOW_END)
+baseline_df = load_window(f"{{TELEMETRY_DIR}}/metric/metric_container.csv", EXTENDED_WINDOW_START, WINDOW_START)
+```
+For large windows pass `compact=True`: identifiers (cmdb_id, kpi_name, log_name, service) come back as categories, measurements as float32 and a `minute` column holds the UTC+8 minute of each row (naive datetime, no timezone conversion needed). Group such frames with `groupby(..., observed=True)` and compare categories with plain strings as usual.
+Global thresholds of each component and KPI over the whole day are precomputed, use them instead of reading the whole day again:
+```python
+from telemetry.baselines import load_baselines
+stats = load_baselines(f"{{TELEMETRY_DIR}}/metric/metric_container.csv")  # indexed by (cmdb_id, kpi_name)
+df = df.join(stats[["median", "mad", "q95", "q99", "stable_low", "stable_high"]], on=["cmdb_id", "kpi_name"])
+```
+The statistics are count, mean, std, min, max, q01, q05, q25, q50, q75, q95, q99, median, mad (median absolute deviation) and stable_low/stable_high (median -/+ 3 scaled MADs). For wide files such as metric_app, cmdb_id holds the text key column (tc) and kpi_name the metric column.
+To get every KPI of a component from all metric files at once, use the day's long-format metric store instead of reading each metric file:
+```python
+from telemetry.metrics import load_metrics
+df = load_metrics(TELEMETRY_DIR, WINDOW_START, WINDOW_END, cmdb_id="node-1")  # columns timestamp, source, cmdb_id, kpi_name, value
+```
+source is the metric file of each row (e.g. metric_container, metric_service); wide files are melted to one row per KPI with the service as cmdb_id. cmdb_id, kpi_name and source also accept lists, leave them out to get the whole window.
+To scan the whole day or resample, start from the precomputed rollups (count, min, max, mean, sum per series and bucket) instead of the raw rows, and load raw rows only for the components and windows they single out:
+```python
+from telemetry.rollups import load_rollup, screen
+minutes = load_rollup(TELEMETRY_DIR, "metric", "1min", cmdb_id="node-1")  # "5min" and "1h" also exist
+spans = load_rollup(TELEMETRY_DIR, "trace/trace_span", "5min")  # per cmdb_id span count and duration statistics
+logs = load_rollup(TELEMETRY_DIR, "log/log_service", "1min")  # per cmdb_id and log_name row count
+candidates = screen(TELEMETRY_DIR, WINDOW_START, WINDOW_END)  # metric series ranked by deviation of their window means from the rest of the day
+```
+Span counts, error counts and latency quantiles per component and per call edge (caller = component of the parent span) are precomputed per minute, do not join parent and child spans yourself:
+```python
+from telemetry.traces import load_trace_rollup, trace_summary
+per_minute = load_trace_rollup(TELEMETRY_DIR, "components", EXTENDED_WINDOW_START, WINDOW_END)  # timestamp, cmdb_id, count, errors, mean, p50, p95, p99
+edges = trace_summary(TELEMETRY_DIR, WINDOW_START, WINDOW_END, "edges")  # caller, cmdb_id, count, errors, error_rate, mean, p50, p95, p99 over the window
+```
+Log messages are grouped into templates (numbers, ids and addresses replaced by <*>) once per day. Reason per template instead of matching message text with substrings or regexes:
+```python
+from telemetry.templates import load_log_window, load_template_counts, load_templates
+logs = load_log_window(f"{{TELEMETRY_DIR}}/log/log_service.csv", WINDOW_START, WINDOW_END)  # file columns plus template_id and template
+counts = load_template_counts(f"{{TELEMETRY_DIR}}/log/log_service.csv", EXTENDED_WINDOW_START, WINDOW_END)  # timestamp (minute), cmdb_id, template_id, count, template
+templates = load_templates(f"{{TELEMETRY_DIR}}/log/log_service.csv")  # template_id, template, size (rows of the day)
+```
+To find log rows by keyword, use the inverted index of the day instead of str.contains over the message column. Words match whole and case-insensitively, including the parts of compound words ("timeout" finds SocketTimeoutException); groups are error, warning, critical, memory and network:
+```python
+from telemetry.log_index import search_logs
+hits = search_logs(f"{{TELEMETRY_DIR}}/log/log_service.csv", start=WINDOW_START, end=WINDOW_END, groups=["error", "memory"])  # file columns plus row and matched
+hits = search_logs(f"{{TELEMETRY_DIR}}/log/log_service.csv", ["heap", "oom"], WINDOW_START, WINDOW_END, match="all")
+```
+</diagnosis_window>
+"""
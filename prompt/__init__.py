@@ -1,14 +1,40 @@
 import os
 import importlib
+from functools import lru_cache
 
-def get_prompt_module(prompt_type="bank"):
+DEFAULT_PROMPT_TYPE = "bank"
+
+# Names a dataset or system may be referred to by, mapped to the prompt module suffix
+PROMPT_TYPE_ALIASES = {
+    "bank": "bank",
+    "market": "market",
+    "market1": "market",
+    "market2": "market",
+    "cloudbed-1": "market",
+    "cloudbed-2": "market",
+    "tele": "tele",
+    "telecom": "tele",
+}
+
+
+def resolve_prompt_type(name=None):
     """
     Args:
-        prompt_type: [prompt_type] default is "bank"
-        
+        name: [name] dataset name, system name or prompt type, e.g. "Market", "cloudbed-2", "telecom"
+
     Returns:
-        module: [module] the corresponding prompt template module
+        str: [prompt_type] the prompt module suffix, DEFAULT_PROMPT_TYPE if name is None
     """
+    if not name:
+        return DEFAULT_PROMPT_TYPE
+    key = name.strip().lower()
+    if key not in PROMPT_TYPE_ALIASES:
+        raise ValueError(f"Unknown prompt type: {name}, expected one of {sorted(PROMPT_TYPE_ALIASES)}")
+    return PROMPT_TYPE_ALIASES[key]
+
+
+@lru_cache(maxsize=None)
+def _load_prompt_module(prompt_type):
     module_name = f"prompt.AgentPrompt_{prompt_type}"
     print("module_name",module_name)
     try:
@@ -16,4 +42,17 @@ def get_prompt_module(prompt_type="bank"):
     except ImportError:
         # if the import fails, use the default bank template
         print(f"Warning: Failed to import {module_name}, using default AgentPrompt_bank")
-        return importlib.import_module("prompt.AgentPrompt_bank")
\ No newline at end of file
+        return importlib.import_module("prompt.AgentPrompt_bank")
+
+
+def get_prompt_module(prompt_type="bank"):
+    """
+    Load a prompt module on first use, later calls return the cached module
+
+    Args:
+        prompt_type: [prompt_type] default is "bank", aliases such as "Market" or "telecom" are accepted
+
+    Returns:
+        module: [module] the corresponding prompt template module
+    """
+    return _load_prompt_module(resolve_prompt_type(prompt_type))
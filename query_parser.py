@@ -0,0 +1,200 @@
+import re
+from dataclasses import asdict, dataclass, field
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+# All OpenRCA datasets record their telemetry in UTC+8
+DATASET_TIMEZONE = timezone(timedelta(hours=8))
+
+# Margin around the query window used for baselines and late-arriving effects
+EXTENDED_WINDOW_MARGIN = 30 * 60
+
+# Each dataset covers a single year, so the year identifies it when the query does not
+DATASET_YEARS = {2020: "Telecom", 2021: "Bank", 2022: "Market"}
+
+# Prompt module names of the datasets, see prompt.get_prompt_module
+PROMPT_TYPES = {"Bank": "bank", "Market": "market", "Telecom": "tele"}
+
+MONTHS = {
+    name: index
+    for index, name in enumerate(
+        ["january", "february", "march", "april", "may", "june", "july",
+         "august", "september", "october", "november", "december"],
+        start=1,
+    )
+}
+
+NUMBER_WORDS = {
+    "a": 1, "an": 1, "one": 1, "single": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+}
+
+DATE_PATTERN = re.compile(
+    r"\b(" + "|".join(MONTHS) + r")\s+(\d{1,2})(?:st|nd|rd|th)?,?\s*(\d{4})",
+    re.IGNORECASE,
+)
+TIME_PATTERN = re.compile(r"\b(\d{1,2}):(\d{2})\b")
+SYSTEM_PATTERN = re.compile(r"\bcloudbed-?(\d)\b", re.IGNORECASE)
+FAILURE_COUNT_PATTERNS = [
+    re.compile(r"number of failures[^.]*?\bis\s+(\d+)", re.IGNORECASE),
+    re.compile(r"\b(\d+|a|an|one|single|two|three|four|five)\s+(?:\w+\s+)?failures?\b", re.IGNORECASE),
+]
+TARGET_PATTERNS = {
+    "time": re.compile(r"occurrence\s+(?:date)?time|occurrence time|datetime|time of the root cause|when the root cause", re.IGNORECASE),
+    "component": re.compile(r"\bcomponents?\b", re.IGNORECASE),
+    "reason": re.compile(r"\breasons?\b|\bwhy\b", re.IGNORECASE),
+}
+
+
+@dataclass
+class QueryWindow:
+    """Diagnosis window and context extracted from an OpenRCA query
+
+    All times are epoch seconds; the wall-clock times in the query are UTC+8.
+    """
+    dataset: str
+    system: Optional[str]
+    date: date
+    start: int
+    end: int
+    extended_start: int
+    extended_end: int
+    num_failures: Optional[int] = None
+    targets: List[str] = field(default_factory=list)
+
+    @property
+    def date_dir(self) -> str:
+        """Name of the telemetry date directory, e.g. 2021_03_04"""
+        return self.date.strftime("%Y_%m_%d")
+
+    @property
+    def telemetry_dir(self) -> str:
+        """Telemetry directory of the queried day, relative to the executor work_dir"""
+        if self.dataset == "Market":
+            return f"dataset/Market/{self.system or 'cloudbed-1'}/telemetry/{self.date_dir}"
+        return f"dataset/{self.dataset}/telemetry/{self.date_dir}"
+
+    @property
+    def incident_key(self) -> Tuple[str, Optional[str], int, int]:
+        """Identifies the failure window, queries with the same key ask about the same incident"""
+        return (self.dataset, self.system, self.start, self.end)
+
+    @property
+    def prompt_type(self) -> str:
+        return PROMPT_TYPES.get(self.dataset, "bank")
+
+    @staticmethod
+    def format_time(timestamp: int) -> str:
+        return datetime.fromtimestamp(timestamp, DATASET_TIMEZONE).strftime("%Y-%m-%d %H:%M:%S")
+
+    def describe(self) -> str:
+        """Short description of the window, e.g. "2021-03-04 18:00 to 18:30 (UTC+8)" """
+        start = datetime.fromtimestamp(self.start, DATASET_TIMEZONE)
+        end = datetime.fromtimestamp(self.end, DATASET_TIMEZONE)
+        return f"{start.strftime('%Y-%m-%d %H:%M')} to {end.strftime('%H:%M')} (UTC+8)"
+
+    def tool_parameters(self) -> Dict[str, object]:
+        """Constants handed to generated tools, so they never compute the window themselves"""
+        return {
+            "TELEMETRY_DIR": self.telemetry_dir,
+            "WINDOW_START": self.start,
+            "WINDOW_END": self.end,
+            "EXTENDED_WINDOW_START": self.extended_start,
+            "EXTENDED_WINDOW_END": self.extended_end,
+            "WINDOW_START_MS": self.start * 1000,
+            "WINDOW_END_MS": self.end * 1000,
+            "EXTENDED_WINDOW_START_MS": self.extended_start * 1000,
+            "EXTENDED_WINDOW_END_MS": self.extended_end * 1000,
+        }
+
+    def tool_parameters_code(self) -> str:
+        """Python assignments of the tool parameters, ready to paste into a tool"""
+        return "\n".join(f"{name} = {value!r}" for name, value in self.tool_parameters().items())
+
+    def to_dict(self) -> Dict[str, object]:
+        data = asdict(self)
+        data["date"] = self.date.isoformat()
+        return data
+
+
+def parse_query(query: str, dataset: Optional[str] = None, margin: int = EXTENDED_WINDOW_MARGIN) -> Optional[QueryWindow]:
+    """
+    Parse the diagnosis window of an OpenRCA query (see query/*_query.csv)
+
+    Args:
+        query: The user's RCA query
+        dataset: Dataset name (Bank/Market/Telecom) if known, otherwise inferred from the query
+        margin: Seconds added on both sides of the window for the extended window
+
+    Returns:
+        QueryWindow or None if the query does not contain a date and a time range
+    """
+    date_match = DATE_PATTERN.search(query)
+    if not date_match:
+        return None
+    month, day, year = date_match.groups()
+    query_date = date(int(year), MONTHS[month.lower()], int(day))
+
+    # Times are searched after the date so that e.g. a "14:57" in a preceding sentence is not used
+    times = TIME_PATTERN.findall(query, date_match.end()) or TIME_PATTERN.findall(query)
+    if len(times) < 2:
+        return None
+    day_start = datetime.combine(query_date, time(0, 0), DATASET_TIMEZONE)
+    start = day_start + timedelta(hours=int(times[0][0]), minutes=int(times[0][1]))
+    end = day_start + timedelta(hours=int(times[1][0]), minutes=int(times[1][1]))
+    if end <= start:
+        # A range such as 23:30 to 00:00 ends on the next day
+        end += timedelta(days=1)
+
+    system_match = SYSTEM_PATTERN.search(query)
+    system = f"cloudbed-{system_match.group(1)}" if system_match else None
+    if dataset is None:
+        dataset = "Market" if system else DATASET_YEARS.get(query_date.year, "Bank")
+
+    window = make_window(dataset, int(start.timestamp()), int(end.timestamp()), system=system, margin=margin)
+    window.num_failures = parse_failure_count(query)
+    window.targets = [target for target, pattern in TARGET_PATTERNS.items() if pattern.search(query)]
+    return window
+
+
+def make_window(dataset: str, start: int, end: int, system: Optional[str] = None, margin: int = EXTENDED_WINDOW_MARGIN) -> QueryWindow:
+    """
+    Build the diagnosis window for given start and end times
+
+    Args:
+        dataset: Dataset name (Bank/Market/Telecom)
+        start: Window start, epoch seconds
+        end: Window end, epoch seconds
+        system: Market system (cloudbed-1/cloudbed-2), None for the other datasets
+        margin: Seconds added on both sides of the window for the extended window
+
+    Returns:
+        QueryWindow of the day the window starts on
+    """
+    start_time = datetime.fromtimestamp(start, DATASET_TIMEZONE)
+    end_time = datetime.fromtimestamp(end, DATASET_TIMEZONE)
+    day_start = datetime.combine(start_time.date(), time(0, 0), DATASET_TIMEZONE)
+
+    # Telemetry is stored per day, the extended window stays within the queried day
+    day_end = day_start + timedelta(days=1)
+    extended_start = max(start_time - timedelta(seconds=margin), day_start)
+    extended_end = min(end_time + timedelta(seconds=margin), max(day_end, end_time))
+
+    return QueryWindow(
+        dataset=dataset,
+        system=system,
+        date=start_time.date(),
+        start=start,
+        end=end,
+        extended_start=int(extended_start.timestamp()),
+        extended_end=int(extended_end.timestamp()),
+    )
+
+
+def parse_failure_count(query: str) -> Optional[int]:
+    """Return the number of failures stated in a query, or None if it is not stated"""
+    for pattern in FAILURE_COUNT_PATTERNS:
+        match = pattern.search(query)
+        if match:
+            word = match.group(1).lower()
+            return int(word) if word.isdigit() else NUMBER_WORDS[word]
+    return None
@@ -0,0 +1,51 @@
+import os
+import shutil
+from typing import List
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def install(work_dir: str) -> str:
+    """
+    Copy the telemetry package into the code executor's work_dir, so generated tools can import it
+
+    Args:
+        work_dir: Work directory of the code executor (mounted as the tools' working directory)
+
+    Returns:
+        str: Path of the installed package
+    """
+    target = os.path.join(work_dir, "telemetry")
+    shutil.copytree(PACKAGE_DIR, target, dirs_exist_ok=True, ignore=shutil.ignore_patterns("__pycache__"))
+    return target
+
+
+def build_day(day_dir: str, force: bool = False) -> List[str]:
+    """
+    Build the derived data of a telemetry day in <day>/derived: the memory-mapped columnar
+    copies (telemetry.columnar), then the catalog of the day's files (telemetry.catalog), the
+    per component-KPI baselines (telemetry.baselines), the long-format store of all metric
+    files (telemetry.metrics), the 1min/5min/1h rollups of the metric, trace and log series
+    (telemetry.rollups), the per minute component and call edge rollups of the traces
+    (telemetry.traces), the log templates (telemetry.templates) and the inverted keyword index
+    of the log messages (telemetry.log_index), which are read from the columnar copies
+
+    Args:
+        day_dir: Telemetry directory of the day, e.g. coding/dataset/Bank/telemetry/2021_03_04
+        force: Rebuild data that is up to date
+
+    Returns:
+        List[str]: Paths of the derived files and directories
+    """
+    from . import baselines, catalog, columnar, log_index, metrics, rollups, templates, traces
+    built = columnar.build_day(day_dir, force=force)
+    built.append(catalog.build_catalog(day_dir, force=force))
+    built += baselines.build_day(day_dir, force=force)
+    store = metrics.build_store(day_dir, force=force)
+    if store is not None:
+        built.append(store)
+    built += rollups.build_day(day_dir, force=force)
+    built += traces.build_day(day_dir, force=force)
+    built += templates.build_day(day_dir, force=force)
+    built += log_index.build_day(day_dir, force=force)
+    return built
@@ -0,0 +1,12 @@
+import argparse
+
+from . import build_day
+
+parser = argparse.ArgumentParser(description="Build all derived data of telemetry days (columns, catalog, baselines, "
+                                             "metric store, rollups, trace rollups, log templates and log index)")
+parser.add_argument("day_dirs", nargs="+", help="Telemetry day directories, e.g. coding/dataset/Bank/telemetry/2021_03_04")
+parser.add_argument("--force", action="store_true", help="Rebuild data that is up to date")
+args = parser.parse_args()
+for day_dir in args.day_dirs:
+    for path in build_day(day_dir, force=args.force):
+        print(path)
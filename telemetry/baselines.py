@@ -0,0 +1,242 @@
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .columnar import DERIVED_DIR, TIME_COLUMNS, _source_stamp, open_table
+
+# Per day statistics of every component-KPI series, e.g.
+# dataset/Bank/telemetry/2021_03_04/derived/baselines/metric/metric_container.csv
+BASELINES_DIR = "baselines"
+FORMAT_VERSION = 1
+
+# Columns naming the KPI of a long-format metric file (one row per component, KPI and time)
+KPI_COLUMNS = ["kpi_name", "name"]
+VALUE_COLUMN = "value"
+
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+# A value is in the stable range if it is within STABLE_MAD_FACTOR scaled MADs of the median
+STABLE_MAD_FACTOR = 3.0
+# Scales the MAD to the standard deviation of normally distributed values
+MAD_SCALE = 1.4826
+
+# Columns of a baseline table, indexed by (cmdb_id, kpi_name)
+STAT_COLUMNS = (
+    ["count", "mean", "std", "min", "max"]
+    + [f"q{round(q * 100):02d}" for q in QUANTILES]
+    + ["median", "mad", "stable_low", "stable_high", "first_timestamp", "last_timestamp"]
+)
+
+_loaded: Dict[str, Tuple[Dict[str, int], pd.DataFrame]] = {}
+_load_lock = threading.Lock()
+
+
+def baselines_path(path: str) -> str:
+    """File of the baselines of a metric CSV (<day>/<modality>/<name>.csv)"""
+    path = os.path.abspath(path)
+    modality_dir, file_name = os.path.split(path)
+    day_dir, modality = os.path.split(modality_dir)
+    return os.path.join(day_dir, DERIVED_DIR, BASELINES_DIR, modality, file_name)
+
+
+def _meta_path(path: str) -> str:
+    return os.path.splitext(baselines_path(path))[0] + ".json"
+
+
+def is_fresh(path: str) -> bool:
+    """True if the baselines of a CSV exist and were computed from its current content"""
+    try:
+        with open(_meta_path(path), encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return meta.get("version") == FORMAT_VERSION and meta.get("source") == _source_stamp(path)
+
+
+def to_series(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Bring a metric table into long format: time column, cmdb_id, kpi_name and value
+
+    Long-format files (cmdb_id, kpi_name or name, value) are kept as they are. In wide files
+    such as metric_app (timestamp, rr, sr, cnt, mrt, tc) every numeric column is a KPI and the
+    first text column (tc) takes the place of cmdb_id.
+
+    Returns:
+        pd.DataFrame, empty if the table has no numeric series
+    """
+    time_column = next((column for column in TIME_COLUMNS if column in df.columns), None)
+    kpi_column = next((column for column in KPI_COLUMNS if column in df.columns), None)
+    if kpi_column is not None and VALUE_COLUMN in df.columns:
+        series = df[[c for c in (time_column, "cmdb_id", kpi_column, VALUE_COLUMN) if c is not None and c in df.columns]]
+        series = series.rename(columns={kpi_column: "kpi_name"})
+        if "cmdb_id" not in series.columns:
+            series = series.assign(cmdb_id="")
+    else:
+        keys = [c for c in df.columns if c != time_column and df[c].dtype.kind not in "biuf"]
+        values = [c for c in df.columns if c != time_column and df[c].dtype.kind in "biuf"]
+        if not values:
+            return pd.DataFrame(columns=["cmdb_id", "kpi_name", VALUE_COLUMN])
+        id_vars = [c for c in (time_column, keys[0] if keys else None) if c is not None]
+        series = df.melt(id_vars=id_vars, value_vars=values, var_name="kpi_name", value_name=VALUE_COLUMN)
+        series = series.rename(columns={keys[0]: "cmdb_id"}) if keys else series.assign(cmdb_id="")
+    if time_column is not None and time_column != "timestamp":
+        series = series.rename(columns={time_column: "timestamp"})
+    series = series.assign(value=pd.to_numeric(series[VALUE_COLUMN], errors="coerce"))
+    return series.dropna(subset=[VALUE_COLUMN])
+
+
+def compute_baselines(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Statistics of every component-KPI series of a whole day
+
+    Args:
+        df: Metric table of the day, in long or wide format (see to_series)
+
+    Returns:
+        pd.DataFrame indexed by (cmdb_id, kpi_name) with STAT_COLUMNS
+    """
+    series = to_series(df)
+    keys = ["cmdb_id", "kpi_name"]
+    if series.empty:
+        return pd.DataFrame(columns=STAT_COLUMNS, index=pd.MultiIndex.from_arrays([[], []], names=keys))
+    grouped = series.groupby(keys, sort=True)[VALUE_COLUMN]
+    stats = grouped.agg(["count", "mean", "std", "min", "max"])
+    quantiles = grouped.quantile(QUANTILES).unstack()
+    quantiles.columns = [f"q{round(q * 100):02d}" for q in quantiles.columns]
+    stats = stats.join(quantiles)
+    stats["median"] = stats["q50"]
+
+    # Median absolute deviation, aligned to the rows through the group median
+    medians = grouped.transform("median")
+    stats["mad"] = (series[VALUE_COLUMN] - medians).abs().groupby([series[k] for k in keys], sort=True).median()
+    spread = STABLE_MAD_FACTOR * MAD_SCALE * stats["mad"]
+    stats["stable_low"] = stats["median"] - spread
+    stats["stable_high"] = stats["median"] + spread
+
+    if "timestamp" in series.columns:
+        timestamps = series.groupby(keys, sort=True)["timestamp"]
+        stats["first_timestamp"] = timestamps.min()
+        stats["last_timestamp"] = timestamps.max()
+    else:
+        stats["first_timestamp"] = stats["last_timestamp"] = np.nan
+    stats["std"] = stats["std"].fillna(0.0)
+    return stats[STAT_COLUMNS]
+
+
+def _read_table(path: str) -> pd.DataFrame:
+    """Whole metric file, from its columnar copy if there is one"""
+    table = open_table(path)
+    return table.frame(copy=False) if table is not None else pd.read_csv(path)
+
+
+def build_baselines(path: str, force: bool = False) -> Optional[str]:
+    """
+    Compute and store the baselines of a metric CSV
+
+    Args:
+        path: Path of the CSV file
+        force: Recompute even if the stored baselines are up to date
+
+    Returns:
+        str: Path of the baseline table, None if the file has no numeric series
+    """
+    target = baselines_path(path)
+    if not force and is_fresh(path):
+        return target
+    stamp = _source_stamp(path)
+    stats = compute_baselines(_read_table(path))
+    if stats.empty:
+        return None
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    # Written under temporary names and renamed, so readers never see half a table
+    stats.to_csv(target + f".{os.getpid()}.tmp")
+    os.replace(target + f".{os.getpid()}.tmp", target)
+    meta_path = _meta_path(path)
+    with open(meta_path + f".{os.getpid()}.tmp", "w", encoding="utf-8") as f:
+        json.dump({"version": FORMAT_VERSION, "source": stamp, "series": len(stats)}, f)
+    os.replace(meta_path + f".{os.getpid()}.tmp", meta_path)
+    return target
+
+
+def build_day(day_dir: str, force: bool = False) -> List[str]:
+    """
+    Compute the baselines of every metric CSV of a day
+
+    Args:
+        day_dir: Telemetry directory of the day, e.g. coding/dataset/Bank/telemetry/2021_03_04
+        force: Recompute baselines that are up to date
+
+    Returns:
+        List[str]: Paths of the baseline tables
+    """
+    metric_dir = os.path.join(day_dir, "metric")
+    if not os.path.isdir(metric_dir):
+        return []
+    built = []
+    for name in sorted(os.listdir(metric_dir)):
+        if name.endswith(".csv"):
+            target = build_baselines(os.path.join(metric_dir, name), force=force)
+            if target is not None:
+                built.append(target)
+    return built
+
+
+def load_baselines(path: str) -> pd.DataFrame:
+    """
+    Whole-day statistics of every component-KPI series of a metric file
+
+    Use them as the global thresholds of a component and KPI, then load only the window
+    rows with load_window. If the baselines have not been precomputed, they are computed
+    from the whole file (and kept for the rest of the process).
+
+    Args:
+        path: Path of the metric CSV, e.g. f"{TELEMETRY_DIR}/metric/metric_container.csv"
+
+    Returns:
+        pd.DataFrame indexed by (cmdb_id, kpi_name) with count, mean, std, min, max,
+        q01 ... q99, median, mad, stable_low, stable_high, first_timestamp and last_timestamp
+    """
+    key = os.path.abspath(path)
+    stamp = _source_stamp(path)
+    with _load_lock:
+        loaded = _loaded.get(key)
+        if loaded is not None and loaded[0] == stamp:
+            return loaded[1]
+    if is_fresh(path):
+        stats = pd.read_csv(baselines_path(path), index_col=["cmdb_id", "kpi_name"],
+                            dtype={"cmdb_id": str, "kpi_name": str}, keep_default_na=False,
+                            na_values={column: [""] for column in STAT_COLUMNS})
+    else:
+        stats = compute_baselines(_read_table(path))
+    with _load_lock:
+        _loaded[key] = (stamp, stats)
+    return stats
+
+
+def get_baseline(path: str, cmdb_id: str, kpi_name: str) -> Optional[Dict[str, float]]:
+    """
+    Whole-day statistics of one component-KPI series, see load_baselines
+
+    Returns:
+        dict of the statistics, None if the series is not in the file
+    """
+    stats = load_baselines(path)
+    try:
+        return stats.loc[(cmdb_id, kpi_name)].to_dict()
+    except KeyError:
+        return None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Precompute the per component-KPI baselines of telemetry days")
+    parser.add_argument("day_dirs", nargs="+", help="Telemetry day directories, e.g. coding/dataset/Bank/telemetry/2021_03_04")
+    parser.add_argument("--force", action="store_true", help="Recompute baselines that are up to date")
+    args = parser.parse_args()
+    for day_dir in args.day_dirs:
+        for path in build_day(day_dir, force=args.force):
+            print(path)
@@ -0,0 +1,207 @@
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from .columnar import DERIVED_DIR, MILLISECOND_THRESHOLD, TIME_COLUMNS, _source_stamp, open_table
+
+# Catalog of a telemetry day, e.g. dataset/Bank/telemetry/2021_03_04/derived/catalog.json
+CATALOG_FILE = "catalog.json"
+FORMAT_VERSION = 1
+
+# Text columns with more distinct values (trace ids, log messages) are only counted
+MAX_CATALOG_VALUES = 2000
+# Values per column shown in a prompt, the rest are available through list_values
+MAX_PROMPT_VALUES = 400
+
+# All OpenRCA datasets record their telemetry in UTC+8
+DATASET_TIMEZONE = timezone(timedelta(hours=8))
+
+
+def catalog_path(day_dir: str) -> str:
+    return os.path.join(day_dir, DERIVED_DIR, CATALOG_FILE)
+
+
+def _telemetry_files(day_dir: str) -> List[str]:
+    """CSV files of a day, relative to the day directory (<modality>/<name>.csv)"""
+    files = []
+    for modality in sorted(os.listdir(day_dir)):
+        modality_dir = os.path.join(day_dir, modality)
+        if modality == DERIVED_DIR or not os.path.isdir(modality_dir):
+            continue
+        files += [f"{modality}/{name}" for name in sorted(os.listdir(modality_dir)) if name.endswith(".csv")]
+    return files
+
+
+def describe_file(path: str) -> Dict[str, object]:
+    """
+    Rows, time coverage and distinct values of the text columns of a telemetry CSV
+
+    Read from the columnar copy of the file if there is one, otherwise from the CSV.
+
+    Returns:
+        dict with rows, columns, time_column, start and end (epoch seconds), distinct (value
+        count per text column) and values (the values of text columns with at most
+        MAX_CATALOG_VALUES of them)
+    """
+    table = open_table(path)
+    if table is not None:
+        rows, columns, time_column = table.rows, table.columns, table.time_column
+        text_columns = [c["name"] for c in table.meta["columns"] if c["kind"] == "text"]
+        column_values = table.distinct
+        timestamps = table.column(time_column) if time_column is not None else None
+    else:
+        df = pd.read_csv(path)
+        rows, columns = len(df), list(df.columns)
+        time_column = next((column for column in TIME_COLUMNS if column in df.columns), None)
+        text_columns = [c for c in df.columns if df[c].dtype.kind not in "biuf"]
+        column_values = lambda name: df[name].dropna().unique()
+        timestamps = df[time_column].to_numpy() if time_column is not None else None
+
+    description = {"source": _source_stamp(path), "rows": rows, "columns": columns, "time_column": time_column,
+                   "start": None, "end": None, "distinct": {}, "values": {}}
+    if timestamps is not None and len(timestamps):
+        start, end = np.min(timestamps), np.max(timestamps)
+        scale = 1000 if start > MILLISECOND_THRESHOLD else 1
+        description["start"], description["end"] = int(start // scale), int(end // scale)
+    for name in text_columns:
+        values = column_values(name)
+        description["distinct"][name] = len(values)
+        if len(values) <= MAX_CATALOG_VALUES:
+            description["values"][name] = sorted(str(value) for value in values)
+    return description
+
+
+def _is_fresh(catalog: Optional[dict], day_dir: str) -> bool:
+    if catalog is None or catalog.get("version") != FORMAT_VERSION:
+        return False
+    files = _telemetry_files(day_dir)
+    if sorted(catalog["files"]) != sorted(files):
+        return False
+    return all(catalog["files"][name]["source"] == _source_stamp(os.path.join(day_dir, name)) for name in files)
+
+
+def read_catalog(day_dir: str) -> Optional[dict]:
+    """The stored catalog of a day, None if it has not been built or the files have changed"""
+    try:
+        with open(catalog_path(day_dir), encoding="utf-8") as f:
+            catalog = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return catalog if _is_fresh(catalog, day_dir) else None
+
+
+def compute_catalog(day_dir: str) -> dict:
+    return {
+        "version": FORMAT_VERSION,
+        "day": os.path.basename(os.path.normpath(day_dir)),
+        "files": {name: describe_file(os.path.join(day_dir, name)) for name in _telemetry_files(day_dir)},
+    }
+
+
+def build_catalog(day_dir: str, force: bool = False) -> str:
+    """
+    Build the catalog of a telemetry day: per file the rows, time coverage, columns and the
+    distinct components, KPIs and services
+
+    Args:
+        day_dir: Telemetry directory of the day, e.g. coding/dataset/Bank/telemetry/2021_03_04
+        force: Rebuild the catalog if it is up to date
+
+    Returns:
+        str: Path of the catalog
+    """
+    target = catalog_path(day_dir)
+    if not force and read_catalog(day_dir) is not None:
+        return target
+    catalog = compute_catalog(day_dir)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target + f".{os.getpid()}.tmp", "w", encoding="utf-8") as f:
+        json.dump(catalog, f, ensure_ascii=False)
+    os.replace(target + f".{os.getpid()}.tmp", target)
+    return target
+
+
+def load_catalog(day_dir: str) -> dict:
+    """
+    Catalog of a telemetry day, computed (without storing it) if it has not been built
+
+    Args:
+        day_dir: Telemetry directory of the day, e.g. TELEMETRY_DIR
+    """
+    return read_catalog(day_dir) or compute_catalog(day_dir)
+
+
+def list_values(path: str, column: str) -> List[str]:
+    """
+    Distinct values of a text column of a telemetry file, e.g. every kpi_name of a metric file
+
+    Args:
+        path: Path of the CSV file, e.g. f"{TELEMETRY_DIR}/metric/metric_container.csv"
+        column: Column name, e.g. "cmdb_id" or "kpi_name"
+
+    Returns:
+        List[str]: Sorted distinct values
+    """
+    modality_dir, file_name = os.path.split(os.path.abspath(path))
+    day_dir, modality = os.path.split(modality_dir)
+    catalog = read_catalog(day_dir)
+    if catalog is not None:
+        values = catalog["files"].get(f"{modality}/{file_name}", {}).get("values", {})
+        if column in values:
+            return values[column]
+    table = open_table(path)
+    if table is not None and column in table.columns:
+        text = any(c["name"] == column and c["kind"] == "text" for c in table.meta["columns"])
+        values = table.distinct(column) if text else pd.unique(table.column(column))
+        return sorted(str(value) for value in values if not pd.isna(value))
+    return sorted(str(value) for value in pd.read_csv(path, usecols=[column])[column].dropna().unique())
+
+
+def format_time(timestamp: Optional[int]) -> str:
+    if timestamp is None:
+        return "unknown"
+    return datetime.fromtimestamp(timestamp, DATASET_TIMEZONE).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def format_catalog(catalog: dict, modality: Optional[str] = None, max_values: int = MAX_PROMPT_VALUES) -> str:
+    """
+    Catalog of a day as text for a prompt
+
+    Args:
+        catalog: Catalog of the day, see load_catalog
+        modality: Only list the files of this modality (metric, log, trace), all files if None
+        max_values: Values listed per column
+    """
+    lines = []
+    for name, description in catalog["files"].items():
+        if modality is not None and not name.startswith(f"{modality}/"):
+            continue
+        lines.append(f"- {name}: {description['rows']} rows, {format_time(description['start'])} to "
+                     f"{format_time(description['end'])} (UTC+8), columns {', '.join(description['columns'])}")
+        for column, count in description["distinct"].items():
+            values = description["values"].get(column)
+            if values is None:
+                lines.append(f"  {column}: {count} distinct values")
+                continue
+            shown = ", ".join(values[:max_values])
+            more = f", ... ({count - max_values} more)" if count > max_values else ""
+            lines.append(f"  {column} ({count}): {shown}{more}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build and print the catalog of telemetry days")
+    parser.add_argument("day_dirs", nargs="+", help="Telemetry day directories, e.g. coding/dataset/Bank/telemetry/2021_03_04")
+    parser.add_argument("--force", action="store_true", help="Rebuild catalogs that are up to date")
+    parser.add_argument("--max-values", type=int, default=20, help="Values printed per column")
+    args = parser.parse_args()
+    for day_dir in args.day_dirs:
+        build_catalog(day_dir, force=args.force)
+        print(f"{day_dir}:")
+        print(format_catalog(read_catalog(day_dir), max_values=args.max_values))
@@ -0,0 +1,330 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+# Derived data of a telemetry day lives next to its modality directories, e.g.
+# dataset/Bank/telemetry/2021_03_04/derived/columns/metric/metric_container/
+DERIVED_DIR = "derived"
+COLUMNS_DIR = "columns"
+FORMAT_VERSION = 1
+
+# Timestamp columns used by the datasets, in order of preference (see loader.TIME_COLUMNS)
+TIME_COLUMNS = ["timestamp", "startTime"]
+MILLISECOND_THRESHOLD = 1e11
+
+# Tables opened by this process, so every tool of a fork server or a long-lived process
+# shares one mapping per file
+_open_tables: Dict[str, "ColumnarTable"] = {}
+_open_lock = threading.Lock()
+
+
+def columns_dir(path: str) -> str:
+    """Directory of the columnar copy of a telemetry CSV (<day>/<modality>/<name>.csv)"""
+    path = os.path.abspath(path)
+    modality_dir, file_name = os.path.split(path)
+    day_dir, modality = os.path.split(modality_dir)
+    return os.path.join(day_dir, DERIVED_DIR, COLUMNS_DIR, modality, os.path.splitext(file_name)[0])
+
+
+def _source_stamp(path: str) -> Dict[str, int]:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _read_meta(directory: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_fresh(path: str) -> bool:
+    """True if the columnar copy of a CSV exists and was built from its current content"""
+    meta = _read_meta(columns_dir(path))
+    return (meta is not None and meta.get("version") == FORMAT_VERSION
+            and meta.get("source") == _source_stamp(path))
+
+
+def write_table(df: pd.DataFrame, target: str, arrays: Optional[Dict[str, np.ndarray]] = None, **meta) -> None:
+    """
+    Write a DataFrame as a columnar table directory (see ColumnarTable)
+
+    Numeric columns are stored as they are, text columns as int32 codes into a list of
+    distinct values. The table is written to a temporary directory and renamed into place,
+    so concurrent builds of the same table (several diagnoses of one day) are safe.
+
+    Args:
+        df: Table to write
+        target: Directory of the table
+        arrays: Extra arrays stored with the table, read with ColumnarTable.array
+        **meta: Extra entries of meta.json, e.g. the stamp of the source file
+    """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=".build-", dir=os.path.dirname(target))
+    try:
+        columns = []
+        for index, name in enumerate(df.columns):
+            series = df[name]
+            if series.dtype.kind in "biuf":
+                np.save(os.path.join(staging, f"{index}.npy"), series.to_numpy())
+                columns.append({"name": name, "kind": "numeric", "dtype": str(series.dtype)})
+            else:
+                codes, values = pd.factorize(series, use_na_sentinel=True)
+                np.save(os.path.join(staging, f"{index}.codes.npy"), codes.astype(np.int32))
+                with open(os.path.join(staging, f"{index}.values.json"), "w", encoding="utf-8") as f:
+                    json.dump(values.tolist(), f)
+                columns.append({"name": name, "kind": "text", "dtype": str(series.dtype)})
+
+        time_column = next((column for column in TIME_COLUMNS if column in df.columns), None)
+        meta = {"version": FORMAT_VERSION, **meta, "rows": len(df), "columns": columns,
+                "time_column": time_column, "time_scale": 1, "sorted": True}
+        if time_column is not None and len(df):
+            timestamps = df[time_column].to_numpy()
+            meta["time_scale"] = 1000 if timestamps[0] > MILLISECOND_THRESHOLD else 1
+            if not (np.diff(timestamps) >= 0).all():
+                # Rows stay in file order, the order array finds the rows of a window
+                meta["sorted"] = False
+                np.save(os.path.join(staging, "order.npy"), np.argsort(timestamps, kind="stable").astype(np.int64))
+        with open(os.path.join(staging, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        for name, array in (arrays or {}).items():
+            np.save(os.path.join(staging, f"{name}.array.npy"), array)
+
+        if os.path.isdir(target):
+            shutil.rmtree(target, ignore_errors=True)
+        try:
+            os.rename(staging, target)
+        except OSError:
+            # Another process finished the same build first
+            if _read_meta(target) is None:
+                raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def build_columns(path: str, force: bool = False) -> str:
+    """
+    Convert a telemetry CSV into one memory-mappable .npy file per column
+
+    Args:
+        path: Path of the CSV file
+        force: Rebuild even if the columnar copy is up to date
+
+    Returns:
+        str: Directory of the columnar copy
+    """
+    target = columns_dir(path)
+    if not force and is_fresh(path):
+        return target
+    stamp = _source_stamp(path)
+    write_table(pd.read_csv(path), target, source=stamp)
+    return target
+
+
+def build_day(day_dir: str, force: bool = False) -> List[str]:
+    """
+    Build the columnar copies of every telemetry CSV of a day
+
+    Args:
+        day_dir: Telemetry directory of the day, e.g. coding/dataset/Bank/telemetry/2021_03_04
+        force: Rebuild copies that are up to date
+
+    Returns:
+        List[str]: Directories of the columnar copies
+    """
+    built = []
+    for modality in sorted(os.listdir(day_dir)):
+        modality_dir = os.path.join(day_dir, modality)
+        if modality == DERIVED_DIR or not os.path.isdir(modality_dir):
+            continue
+        for name in sorted(os.listdir(modality_dir)):
+            if name.endswith(".csv"):
+                built.append(build_columns(os.path.join(modality_dir, name), force=force))
+    return built
+
+
+class ColumnarTable:
+    """
+    Read-only, memory-mapped columns of a telemetry CSV
+
+    Every column is an np.load(mmap_mode="r") array, so the data lives once in the page
+    cache of the host and is shared by all processes and containers reading the same day.
+    Windows are found with a binary search on the timestamp column.
+
+    Args:
+        directory: Directory written by build_columns
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        meta = _read_meta(directory)
+        if meta is None:
+            raise FileNotFoundError(f"No columnar copy in {directory}")
+        self.meta = meta
+        self.rows: int = meta["rows"]
+        self.columns: List[str] = [column["name"] for column in meta["columns"]]
+        self.time_column: Optional[str] = meta["time_column"]
+        self.time_scale: int = meta["time_scale"]
+        self._index = {column["name"]: (i, column) for i, column in enumerate(meta["columns"])}
+        self._arrays: Dict[str, np.ndarray] = {}
+        self._values: Dict[str, np.ndarray] = {}
+        self._sorted: Dict[str, tuple] = {}
+        self._order = None if meta["sorted"] else np.load(os.path.join(directory, "order.npy"), mmap_mode="r")
+
+    def _array(self, name: str) -> np.ndarray:
+        """Mapped array of a column, int32 codes for text columns"""
+        if name not in self._arrays:
+            index, column = self._index[name]
+            suffix = "npy" if column["kind"] == "numeric" else "codes.npy"
+            self._arrays[name] = np.load(os.path.join(self.directory, f"{index}.{suffix}"), mmap_mode="r")
+        return self._arrays[name]
+
+    def _text_values(self, name: str) -> np.ndarray:
+        """Distinct values of a text column, followed by NaN for the missing value code -1"""
+        if name not in self._values:
+            index, _ = self._index[name]
+            with open(os.path.join(self.directory, f"{index}.values.json"), encoding="utf-8") as f:
+                values = json.load(f)
+            self._values[name] = np.array(values + [np.nan], dtype=object)
+        return self._values[name]
+
+    def distinct(self, name: str) -> np.ndarray:
+        """Distinct non-missing values of a text column, read without touching its rows"""
+        return self._text_values(name)[:-1]
+
+    def array(self, name: str) -> np.ndarray:
+        """Mapped extra array stored with the table (see write_table)"""
+        key = f"{name}.array"
+        if key not in self._arrays:
+            self._arrays[key] = np.load(os.path.join(self.directory, f"{key}.npy"), mmap_mode="r")
+        return self._arrays[key]
+
+    def isin(self, name: str, values: List[str], rows: Union[slice, np.ndarray, None] = None) -> np.ndarray:
+        """Mask of the rows whose text column is one of values, compared on the stored codes"""
+        codes = self._array(name)
+        if rows is not None:
+            codes = codes[rows]
+        wanted = np.flatnonzero(np.isin(self.distinct(name), list(values)))
+        return np.isin(codes, wanted)
+
+    def rows_between(self, start: int, end: int) -> Union[slice, np.ndarray]:
+        """
+        Rows whose timestamp falls within [start, end), in file order
+
+        Args:
+            start: Window start, epoch seconds
+            end: Window end, epoch seconds
+
+        Returns:
+            A slice if the file is sorted by time, otherwise an array of row numbers
+        """
+        if self.time_column is None:
+            raise ValueError(f"No timestamp column ({', '.join(TIME_COLUMNS)}) in {self.directory}")
+        timestamps = self._array(self.time_column)
+        if self._order is None:
+            lo, hi = np.searchsorted(timestamps, [start * self.time_scale, end * self.time_scale], side="left")
+            return slice(int(lo), int(hi))
+        lo, hi = np.searchsorted(timestamps[self._order], [start * self.time_scale, end * self.time_scale], side="left")
+        return np.sort(self._order[lo:hi])
+
+    def column(self, name: str, rows: Union[slice, np.ndarray, None] = None) -> np.ndarray:
+        """
+        Values of a column, a read-only view of the mapping for numeric columns and slices
+
+        Args:
+            name: Column name
+            rows: Rows to return, see rows_between, all rows if None
+        """
+        array = self._array(name)
+        if rows is not None:
+            array = array[rows]
+        if self._index[name][1]["kind"] == "text":
+            return self._text_values(name)[array]
+        return array
+
+    def categorical(self, name: str, rows: Union[slice, np.ndarray, None] = None) -> pd.Categorical:
+        """
+        Values of a text column as a categorical built from the stored codes, without decoding them
+
+        Categories are sorted, as with astype("category") on the decoded strings.
+        """
+        codes = self._array(name)
+        if rows is not None:
+            codes = codes[rows]
+        if name not in self._sorted:
+            categories = pd.Index(self.distinct(name), dtype=object)
+            sorter = categories.argsort()
+            # Stored code -> position in the sorted categories, the last slot keeps the missing code -1
+            rank = np.full(len(categories) + 1, -1, dtype=np.int32)
+            rank[sorter] = np.arange(len(categories), dtype=np.int32)
+            self._sorted[name] = (pd.CategoricalDtype(categories[sorter]), rank)
+        dtype, rank = self._sorted[name]
+        return pd.Categorical.from_codes(rank[np.asarray(codes)], dtype=dtype)
+
+    def frame(self, start: Optional[int] = None, end: Optional[int] = None,
+              usecols: Optional[List[str]] = None, copy: bool = True,
+              categories: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        DataFrame of the rows within [start, end), or of all rows
+
+        Args:
+            start: Window start, epoch seconds, None for the whole file
+            end: Window end, epoch seconds
+            usecols: Columns to return, in file order, all columns if None
+            copy: Copy numeric columns into a writable frame. With copy=False they stay
+                read-only views of the shared mapping (text columns are always decoded)
+            categories: Text columns to return as categoricals of the day's distinct values
+                instead of decoded strings
+
+        Returns:
+            pd.DataFrame with the dtypes pd.read_csv gives for the file
+        """
+        rows = None if start is None else self.rows_between(start, end)
+        if usecols is not None and set(usecols) - set(self.columns):
+            missing = sorted(set(usecols) - set(self.columns))
+            raise ValueError(f"Usecols do not match columns, columns expected but not found: {missing}")
+        names = self.columns if usecols is None else [name for name in self.columns if name in usecols]
+        categories = set(categories or ()) & {c["name"] for c in self.meta["columns"] if c["kind"] == "text"}
+        data = {name: self.categorical(name, rows) if name in categories else self.column(name, rows) for name in names}
+        return pd.DataFrame(data, columns=names, copy=copy)
+
+
+def open_table(path: str) -> Optional[ColumnarTable]:
+    """
+    Open the columnar copy of a telemetry CSV
+
+    Args:
+        path: Path of the CSV file
+
+    Returns:
+        ColumnarTable, or None if there is no up to date columnar copy of the file
+    """
+    key = os.path.abspath(path)
+    with _open_lock:
+        table = _open_tables.get(key)
+        if table is not None and table.meta["source"] == _source_stamp(path):
+            return table
+        if not is_fresh(path):
+            _open_tables.pop(key, None)
+            return None
+        table = _open_tables[key] = ColumnarTable(columns_dir(path))
+        return table
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build memory-mapped columnar copies of telemetry days")
+    parser.add_argument("day_dirs", nargs="+", help="Telemetry day directories, e.g. coding/dataset/Bank/telemetry/2021_03_04")
+    parser.add_argument("--force", action="store_true", help="Rebuild copies that are up to date")
+    args = parser.parse_args()
+    for day_dir in args.day_dirs:
+        for directory in build_day(day_dir, force=args.force):
+            print(directory)
@@ -0,0 +1,86 @@
+from typing import List, Optional
+
+import pandas as pd
+
+from .columnar import open_table
+from .schema import compact_frame, schema_for
+
+# Timestamp columns used by the datasets, in order of preference
+TIME_COLUMNS = ["timestamp", "startTime"]
+
+# Epoch values above this are milliseconds (1e11 seconds is in the year 5138)
+MILLISECOND_THRESHOLD = 1e11
+
+
+def detect_time_column(path: str) -> str:
+    """Return the name of the timestamp column of a telemetry CSV"""
+    columns = pd.read_csv(path, nrows=0).columns
+    for column in TIME_COLUMNS:
+        if column in columns:
+            return column
+    raise ValueError(f"No timestamp column ({', '.join(TIME_COLUMNS)}) in {path}")
+
+
+def load_window(
+    path: str,
+    start: int,
+    end: int,
+    time_column: Optional[str] = None,
+    usecols: Optional[List[str]] = None,
+    chunksize: int = 500_000,
+    compact: bool = False,
+) -> pd.DataFrame:
+    """
+    Load the rows of a telemetry CSV whose timestamp falls within [start, end)
+
+    The file is read in chunks and filtered while reading, so only the rows inside the
+    window are ever held in memory. Millisecond timestamp columns (traces, Telecom) are
+    detected and compared with the window automatically. If the day has an up to date
+    columnar copy (see telemetry.columnar), the window is cut from its shared memory-mapped
+    columns instead of parsing the CSV.
+
+    Args:
+        path: Path of the CSV file
+        start: Window start, epoch seconds (e.g. WINDOW_START)
+        end: Window end, epoch seconds (e.g. WINDOW_END)
+        time_column: Timestamp column, detected if None
+        usecols: Columns to load, all columns if None (the timestamp column is always loaded)
+        chunksize: Rows per chunk
+        compact: Return compact dtypes (see telemetry.schema): identifiers as categories,
+            measurements as float32, counters downcast, plus a "minute" column with the UTC+8
+            minute of each row. Group categories with groupby(..., observed=True)
+
+    Returns:
+        pd.DataFrame: The rows within the window, in file order
+    """
+    table = open_table(path)
+    if table is not None and table.time_column is not None and time_column in (None, table.time_column):
+        if usecols is not None and table.time_column not in usecols:
+            usecols = list(usecols) + [table.time_column]
+        if not compact:
+            return table.frame(start, end, usecols=usecols)
+        # Identifiers are built from the stored codes, they are never decoded to strings
+        schema = schema_for(path)
+        df = table.frame(start, end, usecols=usecols, categories=schema.get("category") if schema else None)
+        return compact_frame(df, schema=schema)
+
+    if time_column is None:
+        time_column = detect_time_column(path)
+    if usecols is not None and time_column not in usecols:
+        usecols = list(usecols) + [time_column]
+
+    scale = None
+    frames = []
+    for chunk in pd.read_csv(path, usecols=usecols, chunksize=chunksize):
+        if chunk.empty:
+            continue
+        if scale is None:
+            scale = 1000 if chunk[time_column].iloc[0] > MILLISECOND_THRESHOLD else 1
+        timestamps = chunk[time_column]
+        frames.append(chunk[(timestamps >= start * scale) & (timestamps < end * scale)])
+
+    if not frames:
+        df = pd.read_csv(path, usecols=usecols, nrows=0)
+    else:
+        df = pd.concat(frames, ignore_index=True)
+    return compact_frame(df, path) if compact else df
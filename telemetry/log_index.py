@@ -0,0 +1,330 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from .columnar import DERIVED_DIR, MILLISECOND_THRESHOLD, TIME_COLUMNS, _source_stamp, open_table
+
+# Inverted index of the messages of a log file, e.g.
+# dataset/Bank/telemetry/2021_03_04/derived/log_index/log/log_service/ holds terms.json (sorted
+# terms), offsets.npy (postings of term i are entries offsets[i]:offsets[i + 1]) and the
+# postings: rows.npy (row of the file) and timestamps.npy (epoch seconds), sorted by time per term
+LOG_INDEX_DIR = "log_index"
+LOG_INDEX_VERSION = 1
+MESSAGE_COLUMNS = ["value", "message"]
+
+# Words of the event classes explorers look for, expanded by search_logs(groups=...)
+KEYWORD_GROUPS: Dict[str, List[str]] = {
+    "error": ["error", "errors", "exception", "fail", "failed", "failure", "fatal", "refused", "denied"],
+    "warning": ["warn", "warning", "deprecated", "retry", "retrying"],
+    "critical": ["critical", "fatal", "panic", "emergency", "crash", "crashed", "killed"],
+    "memory": ["memory", "oom", "outofmemoryerror", "heap", "gc", "swap", "alloc", "allocation"],
+    "network": ["network", "connection", "connect", "timeout", "timed", "refused", "reset", "unreachable",
+                "socket", "broken", "pipe", "dns", "host"],
+}
+
+WORD_PATTERN = re.compile(r"[A-Za-z][A-Za-z0-9_]*")
+CAMEL_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+# Longer words (hashes, encoded payloads) are not indexed
+MAX_TERM_LENGTH = 40
+
+_loaded: Dict[str, Tuple[Dict[str, int], "LogIndex"]] = {}
+_load_lock = threading.Lock()
+
+
+def index_terms(message: str) -> List[str]:
+    """
+    Lower-case terms of a log message: every word that starts with a letter, plus the parts of
+    compound words (OutOfMemoryError -> outofmemoryerror, out, of, memory, error; java.net.
+    SocketTimeoutException -> java, net, sockettimeoutexception, socket, timeout, exception)
+    """
+    terms = set()
+    for word in WORD_PATTERN.findall(message):
+        if len(word) > MAX_TERM_LENGTH:
+            continue
+        terms.add(word.lower())
+        for part in CAMEL_PATTERN.findall(word.replace("_", " ")):
+            if part[0].isalpha():
+                terms.add(part.lower())
+    return sorted(terms)
+
+
+def index_dir(path: str) -> str:
+    """Directory of the index of a log CSV (<day>/<modality>/<name>.csv)"""
+    path = os.path.abspath(path)
+    modality_dir, file_name = os.path.split(path)
+    day_dir, modality = os.path.split(modality_dir)
+    return os.path.join(day_dir, DERIVED_DIR, LOG_INDEX_DIR, modality, os.path.splitext(file_name)[0])
+
+
+def _read_meta(path: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(index_dir(path), "meta.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_fresh(path: str) -> bool:
+    """True if the index of a log CSV exists and was built from its current content"""
+    meta = _read_meta(path)
+    return meta is not None and meta.get("version") == LOG_INDEX_VERSION and meta.get("source") == _source_stamp(path)
+
+
+def _read_messages(path: str) -> Tuple[pd.Series, np.ndarray]:
+    """Message and timestamp (epoch seconds) of every row, from the columnar copy if there is one"""
+    table = open_table(path)
+    columns = table.columns if table is not None else list(pd.read_csv(path, nrows=0).columns)
+    message_column = next((column for column in MESSAGE_COLUMNS if column in columns), None)
+    time_column = next((column for column in TIME_COLUMNS if column in columns), None)
+    if message_column is None or time_column is None:
+        raise ValueError(f"{path} has no message ({', '.join(MESSAGE_COLUMNS)}) or timestamp column")
+    usecols = [time_column, message_column]
+    df = table.frame(usecols=usecols, copy=False) if table is not None else pd.read_csv(path, usecols=usecols)
+    timestamps = df[time_column].to_numpy().astype(np.int64)
+    if len(timestamps) and timestamps[0] > MILLISECOND_THRESHOLD:
+        timestamps = timestamps // 1000
+    return df[message_column], timestamps
+
+
+def compute_index(path: str) -> Tuple[List[str], Dict[str, np.ndarray]]:
+    """
+    Inverted index of a log CSV, each distinct message is tokenized once
+
+    Returns:
+        Sorted terms and the arrays offsets, rows and timestamps (see LOG_INDEX_DIR)
+    """
+    messages, timestamps = _read_messages(path)
+    codes, uniques = pd.factorize(messages.astype(str), use_na_sentinel=False)
+
+    # (term, distinct message) pairs
+    vocabulary: Dict[str, int] = {}
+    pair_terms, pair_messages = [], []
+    for message_id, message in enumerate(uniques):
+        for term in index_terms(message):
+            pair_terms.append(vocabulary.setdefault(term, len(vocabulary)))
+            pair_messages.append(message_id)
+    pair_terms = np.array(pair_terms, dtype=np.int64)
+    pair_messages = np.array(pair_messages, dtype=np.int64)
+
+    # Expand every pair to the rows of its message
+    rows_by_message = np.argsort(codes, kind="stable")
+    message_offsets = np.searchsorted(codes[rows_by_message], np.arange(len(uniques) + 1), side="left")
+    starts = message_offsets[pair_messages]
+    lengths = message_offsets[pair_messages + 1] - starts
+    entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    rows = rows_by_message[entries]
+    term_ids = np.repeat(pair_terms, lengths)
+
+    # Terms in sorted order, postings of each term by time
+    terms = sorted(vocabulary, key=vocabulary.get)
+    order = np.argsort(np.array(terms, dtype=object), kind="stable")
+    rank = np.empty(len(terms), dtype=np.int64)
+    rank[order] = np.arange(len(terms))
+    term_ids = rank[term_ids]
+    posting_order = np.lexsort((rows, timestamps[rows], term_ids))
+    term_ids, rows = term_ids[posting_order], rows[posting_order]
+    arrays = {
+        "offsets": np.searchsorted(term_ids, np.arange(len(terms) + 1), side="left").astype(np.int64),
+        "rows": rows.astype(np.int64),
+        "timestamps": timestamps[rows].astype(np.int64),
+    }
+    return [terms[i] for i in order], arrays
+
+
+def build_index(path: str, force: bool = False) -> str:
+    """
+    Build the inverted index of a log CSV
+
+    Args:
+        path: Path of the log CSV, e.g. coding/dataset/Bank/telemetry/2021_03_04/log/log_service.csv
+        force: Rebuild the index if it is up to date
+
+    Returns:
+        str: Directory of the index
+    """
+    target = index_dir(path)
+    if not force and is_fresh(path):
+        return target
+    stamp = _source_stamp(path)
+    terms, arrays = compute_index(path)
+
+    # Written next to the target and renamed, so readers never see half an index
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=".build-", dir=os.path.dirname(target))
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(staging, f"{name}.npy"), array)
+        with open(os.path.join(staging, "terms.json"), "w", encoding="utf-8") as f:
+            json.dump(terms, f, ensure_ascii=False)
+        with open(os.path.join(staging, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"version": LOG_INDEX_VERSION, "source": stamp, "terms": len(terms),
+                       "postings": int(len(arrays["rows"]))}, f)
+        if os.path.isdir(target):
+            shutil.rmtree(target, ignore_errors=True)
+        try:
+            os.rename(staging, target)
+        except OSError:
+            # Another process finished the same build first
+            if _read_meta(path) is None:
+                raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return target
+
+
+def build_day(day_dir: str, force: bool = False) -> List[str]:
+    """Build the index of every log file of a day"""
+    log_dir = os.path.join(day_dir, "log")
+    if not os.path.isdir(log_dir):
+        return []
+    return [build_index(os.path.join(log_dir, name), force=force)
+            for name in sorted(os.listdir(log_dir)) if name.endswith(".csv")]
+
+
+class LogIndex:
+    """
+    Inverted index of a log CSV, stored (memory-mapped) or computed in memory
+
+    Args:
+        terms: Sorted terms
+        arrays: offsets, rows and timestamps, see LOG_INDEX_DIR
+    """
+
+    def __init__(self, terms: List[str], arrays: Dict[str, np.ndarray]):
+        self.terms = {term: i for i, term in enumerate(terms)}
+        self.offsets = arrays["offsets"]
+        self.rows = arrays["rows"]
+        self.timestamps = arrays["timestamps"]
+
+    @classmethod
+    def open(cls, directory: str) -> "LogIndex":
+        with open(os.path.join(directory, "terms.json"), encoding="utf-8") as f:
+            terms = json.load(f)
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+                  for name in ("offsets", "rows", "timestamps")}
+        return cls(terms, arrays)
+
+    def postings(self, term: str, start: Optional[int] = None, end: Optional[int] = None) -> np.ndarray:
+        """Sorted rows whose message contains a term, only those within [start, end) if given"""
+        term_id = self.terms.get(term.lower())
+        if term_id is None:
+            return np.empty(0, dtype=np.int64)
+        lo, hi = int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+        if start is not None:
+            first, last = np.searchsorted(self.timestamps[lo:hi], [start, end], side="left")
+            lo, hi = lo + int(first), lo + int(last)
+        return np.sort(self.rows[lo:hi])
+
+    def search(self, terms: Iterable[str], start: Optional[int] = None, end: Optional[int] = None,
+               match: str = "any") -> np.ndarray:
+        """
+        Sorted rows whose message contains any (match="any") or all (match="all") of the terms
+        """
+        result = None
+        for term in terms:
+            rows = self.postings(term, start, end)
+            if result is None:
+                result = rows
+            elif match == "all":
+                result = np.intersect1d(result, rows, assume_unique=True)
+            else:
+                result = np.union1d(result, rows)
+        return np.empty(0, dtype=np.int64) if result is None else result
+
+
+def load_index(path: str) -> LogIndex:
+    """
+    Inverted index of a log CSV, computed (and kept for the rest of the process) if it has not been built
+
+    Args:
+        path: Path of the log CSV, e.g. f"{TELEMETRY_DIR}/log/log_service.csv"
+    """
+    key = os.path.abspath(path)
+    stamp = _source_stamp(path)
+    with _load_lock:
+        loaded = _loaded.get(key)
+        if loaded is not None and loaded[0] == stamp:
+            return loaded[1]
+    index = LogIndex.open(index_dir(path)) if is_fresh(path) else LogIndex(*compute_index(path))
+    with _load_lock:
+        _loaded[key] = (stamp, index)
+    return index
+
+
+def query_terms(query: Union[str, List[str], None] = None, groups: Union[str, List[str], None] = None) -> List[str]:
+    """Terms of a search: the words of the query (split like the messages) and the words of KEYWORD_GROUPS"""
+    terms = []
+    for text in [query] if isinstance(query, str) else (query or []):
+        terms += index_terms(text) if not text.isalpha() else [text.lower()]
+    for group in [groups] if isinstance(groups, str) else (groups or []):
+        if group not in KEYWORD_GROUPS:
+            raise ValueError(f"Unknown keyword group {group!r}, expected one of {', '.join(KEYWORD_GROUPS)}")
+        terms += KEYWORD_GROUPS[group]
+    return list(dict.fromkeys(terms))
+
+
+def search_logs(path: str, query: Union[str, List[str], None] = None, start: Optional[int] = None,
+                end: Optional[int] = None, groups: Union[str, List[str], None] = None, match: str = "any",
+                usecols: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Rows of a log CSV whose message contains the given words, found through the inverted index
+
+    Words are matched whole and case-insensitively: "timeout" finds "SocketTimeoutException"
+    and "read timeout", but not "timeouts". Use it instead of str.contains over the message column.
+
+    Args:
+        path: Path of the log CSV, e.g. f"{TELEMETRY_DIR}/log/log_service.csv"
+        query: Word or words to find, e.g. "timeout" or ["oom", "heap"]
+        start: Window start, epoch seconds (e.g. WINDOW_START), the whole day if None
+        end: Window end, epoch seconds (e.g. WINDOW_END)
+        groups: Event classes of KEYWORD_GROUPS to find, e.g. ["error", "memory"]
+        match: "any" for rows with at least one of the words, "all" for rows with every word
+            of query (groups always match any of their words)
+        usecols: Columns to return, all columns if None
+
+    Returns:
+        pd.DataFrame: The matching rows in file order, plus row (the row number in the file)
+        and matched (the searched words in the message)
+    """
+    index = load_index(path)
+    words = query_terms(query)
+    group_words = query_terms(groups=groups)
+    rows = index.search(words, start, end, match) if words else None
+    if group_words:
+        group_rows = index.search(group_words, start, end, "any")
+        rows = group_rows if rows is None else (np.intersect1d(rows, group_rows) if match == "all"
+                                                else np.union1d(rows, group_rows))
+    rows = np.empty(0, dtype=np.int64) if rows is None else rows
+
+    table = open_table(path)
+    if table is not None:
+        names = table.columns if usecols is None else [name for name in table.columns if name in usecols]
+        df = pd.DataFrame({name: table.column(name, rows) for name in names}, columns=names)
+    else:
+        df = pd.read_csv(path, usecols=usecols).iloc[rows].reset_index(drop=True)
+
+    # Which of the searched words each row contains, from the postings of the found rows only
+    matched = np.full(len(rows), "", dtype=object)
+    for term in dict.fromkeys(words + group_words):
+        hits = np.isin(rows, index.postings(term, start, end), assume_unique=True)
+        matched[hits] = matched[hits] + ", " + term
+    return df.assign(row=rows, matched=[labels[2:] for labels in matched])
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the inverted keyword index of the log files of telemetry days")
+    parser.add_argument("day_dirs", nargs="+", help="Telemetry day directories, e.g. coding/dataset/Bank/telemetry/2021_03_04")
+    parser.add_argument("--force", action="store_true", help="Rebuild indexes that are up to date")
+    args = parser.parse_args()
+    for day_dir in args.day_dirs:
+        for directory in build_day(day_dir, force=args.force):
+            print(directory)
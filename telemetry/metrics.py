@@ -0,0 +1,287 @@
+import os
+import threading
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from .baselines import _read_table, to_series
+from .columnar import (DERIVED_DIR, MILLISECOND_THRESHOLD, ColumnarTable, _read_meta, _source_stamp,
+                       write_table)
+from .loader import load_window
+from .schema import compact_frame
+
+# All metric files of a day in one long-format table, e.g.
+# dataset/Market/cloudbed-1/telemetry/2022_03_20/derived/metrics/
+METRICS_DIR = "metrics"
+STORE_VERSION = 1
+
+# Columns of the store. source is the metric file a row comes from (metric_container,
+# metric_service, ...), timestamps are epoch seconds for every dataset
+STORE_COLUMNS = ["timestamp", "source", "cmdb_id", "kpi_name", "value"]
+STORE_SCHEMA = {"category": ["source", "cmdb_id", "kpi_name"], "float32": ["value"]}
+
+_open_stores: Dict[str, "ComponentTable"] = {}
+_open_lock = threading.Lock()
+
+
+def store_dir(day_dir: str) -> str:
+    return os.path.join(os.path.abspath(day_dir), DERIVED_DIR, METRICS_DIR)
+
+
+def metric_files(day_dir: str) -> List[str]:
+    """Metric CSVs of a day, relative to the day directory (metric/<name>.csv)"""
+    metric_dir = os.path.join(day_dir, "metric")
+    if not os.path.isdir(metric_dir):
+        return []
+    return [f"metric/{name}" for name in sorted(os.listdir(metric_dir)) if name.endswith(".csv")]
+
+
+def _source_stamps(day_dir: str) -> Dict[str, Dict[str, int]]:
+    return {name: _source_stamp(os.path.join(day_dir, name)) for name in metric_files(day_dir)}
+
+
+def is_fresh(day_dir: str) -> bool:
+    """True if the metric store of a day exists and was built from the current metric files"""
+    meta = _read_meta(store_dir(day_dir))
+    return (meta is not None and meta.get("store_version") == STORE_VERSION
+            and meta.get("sources") == _source_stamps(day_dir))
+
+
+def normalize(df: pd.DataFrame, source: str) -> pd.DataFrame:
+    """
+    Bring a metric table into the long format of the store
+
+    Wide files (metric_service, metric_app) get one row per KPI column, with the service
+    as cmdb_id (see baselines.to_series). Millisecond timestamps (Telecom) become seconds.
+
+    Args:
+        df: Rows of a metric file
+        source: Name of the file without extension, e.g. "metric_service"
+
+    Returns:
+        pd.DataFrame with STORE_COLUMNS
+    """
+    series = to_series(df)
+    if "timestamp" not in series.columns:
+        return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in
+                             zip(STORE_COLUMNS, ["int64", object, object, object, "float64"])})
+    timestamps = series["timestamp"].to_numpy().astype(np.int64)
+    if len(timestamps) and timestamps[0] > MILLISECOND_THRESHOLD:
+        timestamps = timestamps // 1000
+    return pd.DataFrame({
+        "timestamp": timestamps,
+        "source": source,
+        "cmdb_id": series["cmdb_id"].astype(str).to_numpy(),
+        "kpi_name": series["kpi_name"].astype(str).to_numpy(),
+        "value": series["value"].to_numpy(dtype=np.float64),
+    })
+
+
+def day_frame(day_dir: str) -> pd.DataFrame:
+    """All metric files of a day in the long format of the store, in file order"""
+    frames = [normalize(_read_table(os.path.join(day_dir, name)), os.path.splitext(os.path.basename(name))[0])
+              for name in metric_files(day_dir)]
+    return pd.concat(frames, ignore_index=True) if frames else normalize(pd.DataFrame(), "")
+
+
+def write_component_table(df: pd.DataFrame, target: str, arrays: Optional[Dict[str, np.ndarray]] = None,
+                          **meta) -> None:
+    """
+    Write a table with a cmdb_id and a timestamp column ordered by component and time, with
+    the row range of every component in meta.json (see ComponentTable)
+
+    Args:
+        df: Table to write
+        target: Directory of the table
+        arrays: Extra arrays stored with the table, their rows must already be in component
+            and time order
+        **meta: Extra entries of meta.json
+    """
+    df = df.sort_values(["cmdb_id", "timestamp"], kind="stable", ignore_index=True)
+    components = {}
+    cmdb_ids = df["cmdb_id"].to_numpy()
+    if len(cmdb_ids):
+        starts = np.flatnonzero(np.r_[True, cmdb_ids[1:] != cmdb_ids[:-1]])
+        ends = np.r_[starts[1:], len(cmdb_ids)]
+        components = {str(cmdb_ids[lo]): [int(lo), int(hi)] for lo, hi in zip(starts, ends)}
+    write_table(df, target, arrays=arrays, components=components, **meta)
+
+
+def build_store(day_dir: str, force: bool = False) -> Optional[str]:
+    """
+    Normalize every metric file of a day into one long-format columnar table
+
+    Rows are ordered by component and time, and meta.json records the row range of every
+    component, so the KPIs of one component are found without scanning the others.
+
+    Args:
+        day_dir: Telemetry directory of the day, e.g. coding/dataset/Market/cloudbed-1/telemetry/2022_03_20
+        force: Rebuild the store if it is up to date
+
+    Returns:
+        str: Directory of the store, None if the day has no metric files
+    """
+    target = store_dir(day_dir)
+    if not force and is_fresh(day_dir):
+        return target
+    stamps = _source_stamps(day_dir)
+    if not stamps:
+        return None
+    write_component_table(day_frame(day_dir), target, store_version=STORE_VERSION, sources=stamps)
+    return target
+
+
+class ComponentTable:
+    """
+    Memory-mapped table indexed by component, such as the metric store of a day (see
+    build_store) or a rollup table (see telemetry.rollups)
+
+    Args:
+        directory: Directory written by write_component_table
+    """
+
+    def __init__(self, directory: str):
+        self.table = ColumnarTable(directory)
+        self.components: Dict[str, List[int]] = self.table.meta["components"]
+        self.text_columns = [c["name"] for c in self.table.meta["columns"] if c["kind"] == "text"]
+
+    def sources(self) -> List[str]:
+        return sorted(str(value) for value in self.table.distinct("source"))
+
+    def _component_rows(self, cmdb_ids: List[str], start: Optional[int], end: Optional[int]) -> np.ndarray:
+        timestamps = self.table._array("timestamp")
+        rows = []
+        # Table order (component, then time) whatever the order of the ids, like the CSV fallback
+        for cmdb_id in sorted(set(cmdb_ids)):
+            if cmdb_id not in self.components:
+                continue
+            lo, hi = self.components[cmdb_id]
+            if start is not None:
+                # Rows of a component are sorted by time
+                first, last = np.searchsorted(timestamps[lo:hi], [start, end], side="left")
+                lo, hi = lo + int(first), lo + int(last)
+            rows.append(np.arange(lo, hi, dtype=np.int64))
+        return np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+
+    def rows(self, start: Optional[int] = None, end: Optional[int] = None,
+             cmdb_id: Union[str, List[str], None] = None,
+             **filters: Union[str, List[str], None]) -> Union[slice, np.ndarray]:
+        """
+        Row numbers within [start, end), or all rows, in table order
+
+        Args:
+            filters: Text column -> value or values to keep, e.g. kpi_name="rr"
+        """
+        if cmdb_id is not None:
+            rows = self._component_rows([cmdb_id] if isinstance(cmdb_id, str) else list(cmdb_id), start, end)
+        elif start is not None:
+            rows = self.table.rows_between(start, end)
+        else:
+            rows = np.arange(self.table.rows, dtype=np.int64)
+        for name, values in filters.items():
+            if values is not None:
+                rows = np.arange(self.table.rows)[rows] if isinstance(rows, slice) else rows
+                rows = rows[self.table.isin(name, [values] if isinstance(values, str) else values, rows)]
+        return rows
+
+    def frame(self, start: Optional[int] = None, end: Optional[int] = None,
+              cmdb_id: Union[str, List[str], None] = None, compact: bool = False,
+              **filters: Union[str, List[str], None]) -> pd.DataFrame:
+        """
+        Rows within [start, end), or all rows, see load_metrics
+
+        Args:
+            filters: Text column -> value or values to keep, e.g. kpi_name="rr"
+
+        Returns:
+            pd.DataFrame ordered by component and time
+        """
+        rows = self.rows(start, end, cmdb_id, **filters)
+        categories = self.text_columns if compact else []
+        data = {name: self.table.categorical(name, rows) if name in categories else self.table.column(name, rows)
+                for name in self.table.columns}
+        df = pd.DataFrame(data, columns=self.table.columns)
+        if not compact:
+            return df
+        floats = [name for name in self.table.columns if df[name].dtype.kind == "f"]
+        return compact_frame(df, schema={"category": self.text_columns, "float32": floats})
+
+
+def open_store(day_dir: str) -> Optional[ComponentTable]:
+    """
+    Open the metric store of a day
+
+    Returns:
+        ComponentTable, or None if the store has not been built or the metric files have changed
+    """
+    key = store_dir(day_dir)
+    with _open_lock:
+        store = _open_stores.get(key)
+        if store is not None and store.table.meta["sources"] == _source_stamps(day_dir):
+            return store
+        if not is_fresh(day_dir):
+            _open_stores.pop(key, None)
+            return None
+        store = _open_stores[key] = ComponentTable(key)
+        return store
+
+
+def load_metrics(day_dir: str, start: int, end: int, cmdb_id: Union[str, List[str], None] = None,
+                 kpi_name: Union[str, List[str], None] = None, source: Union[str, List[str], None] = None,
+                 compact: bool = False) -> pd.DataFrame:
+    """
+    All metric rows of a day within [start, end), from every metric file in one long format
+
+    One call replaces reading metric_container, metric_mesh, metric_node, metric_runtime and
+    metric_service separately: wide files are melted to one row per KPI (the service becomes
+    cmdb_id) and the source column names the file of each row. If the day's store has not
+    been built, the window is read from every metric file instead.
+
+    Args:
+        day_dir: Telemetry directory of the day, e.g. TELEMETRY_DIR
+        start: Window start, epoch seconds (e.g. WINDOW_START)
+        end: Window end, epoch seconds (e.g. WINDOW_END)
+        cmdb_id: Only the rows of this component (or these components)
+        kpi_name: Only the rows of this KPI (or these KPIs)
+        source: Only the rows of this metric file (or these files), e.g. "metric_mesh"
+        compact: Return source, cmdb_id and kpi_name as categories, value as float32 and add
+            the UTC+8 "minute" column (see telemetry.schema)
+
+    Returns:
+        pd.DataFrame with timestamp (epoch seconds), source, cmdb_id, kpi_name and value,
+        ordered by component and time
+    """
+    store = open_store(day_dir)
+    if store is not None:
+        return store.frame(start, end, cmdb_id=cmdb_id, kpi_name=kpi_name, source=source, compact=compact)
+
+    frames = []
+    for name in metric_files(day_dir):
+        stem = os.path.splitext(os.path.basename(name))[0]
+        if source is not None and stem not in ([source] if isinstance(source, str) else source):
+            continue
+        path = os.path.join(day_dir, name)
+        # Telecom files count in milliseconds, load_window detects them
+        frames.append(normalize(load_window(path, start, end), stem))
+    df = pd.concat(frames, ignore_index=True) if frames else normalize(pd.DataFrame(), "")
+    for column, values in (("cmdb_id", cmdb_id), ("kpi_name", kpi_name)):
+        if values is not None:
+            df = df[df[column].isin([values] if isinstance(values, str) else values)]
+    df = df.sort_values(["cmdb_id", "timestamp"], kind="stable", ignore_index=True)
+    return compact_frame(df, schema=STORE_SCHEMA) if compact else df
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the long-format metric store of telemetry days")
+    parser.add_argument("day_dirs", nargs="+", help="Telemetry day directories, e.g. coding/dataset/Market/cloudbed-1/telemetry/2022_03_20")
+    parser.add_argument("--force", action="store_true", help="Rebuild stores that are up to date")
+    args = parser.parse_args()
+    for day_dir in args.day_dirs:
+        directory = build_store(day_dir, force=args.force)
+        if directory is not None:
+            store = open_store(day_dir)
+            print(f"{directory}: {store.table.rows} rows, {len(store.components)} components, "
+                  f"sources {', '.join(store.sources())}")
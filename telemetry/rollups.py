@@ -0,0 +1,300 @@
+import os
+import threading
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from .baselines import MAD_SCALE
+from .columnar import DERIVED_DIR, MILLISECOND_THRESHOLD, TIME_COLUMNS, _read_meta, _source_stamp, open_table
+from .metrics import ComponentTable, day_frame, metric_files, open_store, write_component_table
+from .schema import compact_frame
+
+# Per series aggregates of a day at several resolutions, e.g.
+# dataset/Bank/telemetry/2021_03_04/derived/rollups/5min/metric/ for the metric store and
+# dataset/Bank/telemetry/2021_03_04/derived/rollups/5min/trace/trace_span/ for a trace file
+ROLLUPS_DIR = "rollups"
+ROLLUP_VERSION = 1
+
+# Bucket length in seconds. Coarser rollups are merged from the first one
+RESOLUTIONS = {"1min": 60, "5min": 300, "1h": 3600}
+
+# Columns identifying a series. Metric rollups are made from the metric store, trace and log
+# rollups from each trace and log file
+SERIES_KEYS = {
+    "metric": ["source", "cmdb_id", "kpi_name"],
+    "trace": ["cmdb_id"],
+    "log": ["cmdb_id", "log_name"],
+}
+# Measured column of a series. Logs have none, only their rows are counted
+VALUE_COLUMNS = {
+    "metric": ["value"],
+    "trace": ["duration", "elapsedTime"],
+    "log": [],
+}
+AGGREGATES = ["count", "min", "max", "mean", "sum"]
+
+# Bucket means at least this many scaled MADs from the rest of the day count as deviating
+SCREEN_THRESHOLD = 3.0
+
+_open_rollups: Dict[str, ComponentTable] = {}
+_open_lock = threading.Lock()
+
+
+def rollup_dir(day_dir: str, name: str, resolution: str) -> str:
+    """Directory of a rollup, name is "metric" or "<modality>/<file name without .csv>" """
+    return os.path.join(os.path.abspath(day_dir), DERIVED_DIR, ROLLUPS_DIR, resolution, name)
+
+
+def rollup_names(day_dir: str) -> List[str]:
+    """Rollups of a day: "metric" for all metric files, then one per trace and log file"""
+    names = ["metric"] if metric_files(day_dir) else []
+    for modality in ("trace", "log"):
+        modality_dir = os.path.join(day_dir, modality)
+        if os.path.isdir(modality_dir):
+            names += [f"{modality}/{file[:-4]}" for file in sorted(os.listdir(modality_dir)) if file.endswith(".csv")]
+    return names
+
+
+def _inputs(day_dir: str, name: str) -> List[str]:
+    return metric_files(day_dir) if name == "metric" else [f"{name}.csv"]
+
+
+def _source_stamps(day_dir: str, name: str) -> Dict[str, Dict[str, int]]:
+    return {file: _source_stamp(os.path.join(day_dir, file)) for file in _inputs(day_dir, name)}
+
+
+def is_fresh(day_dir: str, name: str, resolution: str) -> bool:
+    """True if a rollup exists and was computed from the current content of its files"""
+    meta = _read_meta(rollup_dir(day_dir, name, resolution))
+    return (meta is not None and meta.get("rollup_version") == ROLLUP_VERSION
+            and meta.get("sources") == _source_stamps(day_dir, name))
+
+
+def _read_series(day_dir: str, name: str) -> pd.DataFrame:
+    """Rows of a rollup's files with timestamp (epoch seconds), the series keys and the value"""
+    if name == "metric":
+        store = open_store(day_dir)
+        return store.frame() if store is not None else day_frame(day_dir)
+
+    modality = name.split("/")[0]
+    path = os.path.join(day_dir, f"{name}.csv")
+    table = open_table(path)
+    columns = table.columns if table is not None else list(pd.read_csv(path, nrows=0).columns)
+    time_column = next((column for column in TIME_COLUMNS if column in columns), None)
+    if time_column is None:
+        raise ValueError(f"No timestamp column ({', '.join(TIME_COLUMNS)}) in {path}")
+    keys = [column for column in SERIES_KEYS[modality] if column in columns]
+    values = [column for column in VALUE_COLUMNS[modality] if column in columns][:1]
+    usecols = [time_column] + keys + values
+    df = table.frame(usecols=usecols, copy=False) if table is not None else pd.read_csv(path, usecols=usecols)
+
+    timestamps = df[time_column].to_numpy().astype(np.int64)
+    if len(timestamps) and timestamps[0] > MILLISECOND_THRESHOLD:
+        timestamps = timestamps // 1000
+    series = {"timestamp": timestamps}
+    series.update({key: df[key].astype(str).to_numpy() for key in keys})
+    if "cmdb_id" not in series:
+        series["cmdb_id"] = np.full(len(df), "", dtype=object)
+    if values:
+        series["value"] = pd.to_numeric(df[values[0]], errors="coerce").to_numpy(dtype=np.float64)
+    return pd.DataFrame(series)
+
+
+def compute_rollup(series: pd.DataFrame, seconds: int) -> pd.DataFrame:
+    """
+    Aggregate series into buckets
+
+    Args:
+        series: timestamp (epoch seconds), key columns and an optional value column
+        seconds: Bucket length
+
+    Returns:
+        pd.DataFrame with timestamp (bucket start), the key columns and count, plus min,
+        max, mean and sum of the values if there is a value column
+    """
+    keys = [column for column in series.columns if column not in ("timestamp", "value")]
+    buckets = series["timestamp"] // seconds * seconds
+    grouped = series.assign(timestamp=buckets).groupby(keys + ["timestamp"], sort=False)
+    if "value" not in series.columns:
+        return grouped.size().rename("count").reset_index()
+    return grouped["value"].agg(AGGREGATES).reset_index()
+
+
+def merge_rollup(rollup: pd.DataFrame, seconds: int) -> pd.DataFrame:
+    """Coarser buckets from a finer rollup, without touching the raw rows"""
+    keys = [column for column in rollup.columns if column not in ["timestamp"] + AGGREGATES]
+    buckets = rollup["timestamp"] // seconds * seconds
+    grouped = rollup.assign(timestamp=buckets).groupby(keys + ["timestamp"], sort=False)
+    if "sum" not in rollup.columns:
+        return grouped["count"].sum().reset_index()
+    merged = grouped.agg(count=("count", "sum"), min=("min", "min"), max=("max", "max"), sum=("sum", "sum"))
+    merged["mean"] = merged["sum"] / merged["count"]
+    return merged[AGGREGATES].reset_index()
+
+
+def compute_rollups(day_dir: str, name: str) -> Dict[str, pd.DataFrame]:
+    """Rollups of one name at every resolution, computed in memory"""
+    resolutions = sorted(RESOLUTIONS.items(), key=lambda item: item[1])
+    finest, seconds = resolutions[0]
+    rollups = {finest: compute_rollup(_read_series(day_dir, name), seconds)}
+    for resolution, seconds in resolutions[1:]:
+        rollups[resolution] = merge_rollup(rollups[finest], seconds)
+    return rollups
+
+
+def build_rollups(day_dir: str, name: str, force: bool = False) -> List[str]:
+    """
+    Compute and store the rollups of the metric store or of one trace or log file
+
+    Args:
+        day_dir: Telemetry directory of the day, e.g. coding/dataset/Bank/telemetry/2021_03_04
+        name: "metric" or "<modality>/<file name without .csv>", see rollup_names
+        force: Recompute rollups that are up to date
+
+    Returns:
+        List[str]: Directories of the rollups, one per resolution
+    """
+    targets = [rollup_dir(day_dir, name, resolution) for resolution in RESOLUTIONS]
+    if not force and all(is_fresh(day_dir, name, resolution) for resolution in RESOLUTIONS):
+        return targets
+    stamps = _source_stamps(day_dir, name)
+    for resolution, rollup in compute_rollups(day_dir, name).items():
+        write_component_table(rollup, rollup_dir(day_dir, name, resolution), rollup_version=ROLLUP_VERSION,
+                              sources=stamps, resolution=resolution, seconds=RESOLUTIONS[resolution])
+    return targets
+
+
+def build_day(day_dir: str, force: bool = False) -> List[str]:
+    """
+    Compute the rollups of the metrics and of every trace and log file of a day
+
+    Returns:
+        List[str]: Directories of the rollups
+    """
+    built = []
+    for name in rollup_names(day_dir):
+        built += build_rollups(day_dir, name, force=force)
+    return built
+
+
+def open_rollup(day_dir: str, name: str, resolution: str) -> Optional[ComponentTable]:
+    """
+    Open a stored rollup
+
+    Returns:
+        ComponentTable, or None if the rollup has not been built or its files have changed
+    """
+    key = rollup_dir(day_dir, name, resolution)
+    with _open_lock:
+        rollup = _open_rollups.get(key)
+        if rollup is not None and rollup.table.meta["sources"] == _source_stamps(day_dir, name):
+            return rollup
+        if not is_fresh(day_dir, name, resolution):
+            _open_rollups.pop(key, None)
+            return None
+        rollup = _open_rollups[key] = ComponentTable(key)
+        return rollup
+
+
+def load_rollup(day_dir: str, name: str = "metric", resolution: str = "1min", start: Optional[int] = None,
+                end: Optional[int] = None, cmdb_id: Union[str, List[str], None] = None, compact: bool = False,
+                **filters: Union[str, List[str], None]) -> pd.DataFrame:
+    """
+    Per bucket count, min, max, mean and sum of every series of a day
+
+    Use rollups to scan the whole day or to shortlist components, then load the raw rows of
+    the shortlisted components and windows only (load_metrics, load_window). If the rollup has
+    not been built, it is computed from the raw data.
+
+    Args:
+        day_dir: Telemetry directory of the day, e.g. TELEMETRY_DIR
+        name: "metric" for all metric files (series by source, cmdb_id, kpi_name), or a trace or
+            log file such as "trace/trace_span" (series by cmdb_id, durations aggregated) and
+            "log/log_service" (series by cmdb_id and log_name, rows counted)
+        resolution: Bucket length, one of RESOLUTIONS ("1min", "5min", "1h")
+        start: Only buckets starting within [start, end), epoch seconds, the whole day if None
+        end: Window end, epoch seconds
+        cmdb_id: Only the series of this component (or these components)
+        compact: Return the keys as categories and the aggregates as float32 (see telemetry.schema)
+        **filters: Key column -> value or values to keep, e.g. kpi_name="rr" or source="metric_mesh"
+
+    Returns:
+        pd.DataFrame with timestamp (bucket start, epoch seconds), the series keys and the
+        aggregates, ordered by component and time
+    """
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"Unknown resolution {resolution!r}, expected one of {', '.join(RESOLUTIONS)}")
+    rollup = open_rollup(day_dir, name, resolution)
+    if rollup is not None:
+        return rollup.frame(start, end, cmdb_id=cmdb_id, compact=compact, **filters)
+
+    df = compute_rollups(day_dir, name)[resolution]
+    if start is not None:
+        df = df[(df["timestamp"] >= start) & (df["timestamp"] < end)]
+    for column, values in dict(filters, cmdb_id=cmdb_id).items():
+        if values is not None:
+            df = df[df[column].isin([values] if isinstance(values, str) else values)]
+    df = df.sort_values(["cmdb_id", "timestamp"], kind="stable", ignore_index=True)
+    if not compact:
+        return df
+    keys = [column for column in df.columns if column not in ["timestamp"] + AGGREGATES]
+    floats = [column for column in AGGREGATES[1:] if column in df.columns]
+    return compact_frame(df, schema={"category": keys, "float32": floats})
+
+
+def screen(day_dir: str, start: int, end: int, resolution: str = "1min", name: str = "metric",
+           threshold: float = SCREEN_THRESHOLD) -> pd.DataFrame:
+    """
+    Rank the series of a day by how far their bucket means within a window deviate from
+    the rest of the day, using rollups only
+
+    Each series' bucket means outside the window give its median and MAD; the score is the
+    largest distance of a window bucket mean from that median, in scaled MADs. The MAD is at
+    least 1% of the compared values, so a flat series that moves scores at most 100.
+
+    Args:
+        day_dir: Telemetry directory of the day, e.g. TELEMETRY_DIR
+        start: Window start, epoch seconds (e.g. WINDOW_START)
+        end: Window end, epoch seconds (e.g. WINDOW_END)
+        resolution: Rollup resolution to compare
+        name: "metric", or a trace file such as "trace/trace_span"
+        threshold: Scores above this mark a series as deviating
+
+    Returns:
+        pd.DataFrame with the series keys, score, peak_timestamp (bucket of the largest
+        deviation), peak_mean, baseline_median and deviating, highest score first
+    """
+    rollup = load_rollup(day_dir, name, resolution)
+    if "mean" not in rollup.columns:
+        raise ValueError(f"The {name} rollup has no values to compare, only counts")
+    seconds = RESOLUTIONS[resolution]
+    keys = [column for column in rollup.columns if column not in ["timestamp"] + AGGREGATES]
+    inside = (rollup["timestamp"] > start - seconds) & (rollup["timestamp"] < end)
+
+    outside = rollup[~inside]
+    medians = outside.groupby(keys, sort=False)["mean"].transform("median")
+    baseline = outside.assign(baseline_median=medians, mad=(outside["mean"] - medians).abs())
+    baseline = baseline.groupby(keys, sort=False)[["baseline_median", "mad"]].median()
+
+    window = rollup[inside].join(baseline, on=keys, how="inner")
+    floor = 0.01 * np.maximum(window["baseline_median"].abs(), window["mean"].abs())
+    scale = np.maximum(MAD_SCALE * window["mad"], floor)
+    window = window.assign(score=(window["mean"] - window["baseline_median"]).abs() / scale.replace(0.0, np.inf))
+    peaks = window.loc[window.groupby(keys, sort=False)["score"].idxmax()]
+    result = peaks[keys + ["score", "timestamp", "mean", "baseline_median"]].rename(
+        columns={"timestamp": "peak_timestamp", "mean": "peak_mean"})
+    result["deviating"] = result["score"] > threshold
+    return result.sort_values("score", ascending=False, ignore_index=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Precompute the 1min/5min/1h rollups of telemetry days")
+    parser.add_argument("day_dirs", nargs="+", help="Telemetry day directories, e.g. coding/dataset/Bank/telemetry/2021_03_04")
+    parser.add_argument("--force", action="store_true", help="Recompute rollups that are up to date")
+    args = parser.parse_args()
+    for day_dir in args.day_dirs:
+        for directory in build_day(day_dir, force=args.force):
+            print(directory)
@@ -0,0 +1,140 @@
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from .columnar import MILLISECOND_THRESHOLD, TIME_COLUMNS
+
+# Compact dtypes of the telemetry files of each dataset, by file name:
+#   category: identifiers with few distinct values, stored as int codes into the distinct values
+#   float32:  measurements, about 7 significant digits are kept
+#   integer:  counters, downcast to the smallest integer type that holds all values
+# Timestamps keep their int64 type. Columns not listed (log messages, span and trace ids)
+# are left as they are.
+_METRIC_LONG = {"category": ["cmdb_id", "kpi_name"], "float32": ["value"]}
+_LOG = {"category": ["cmdb_id", "log_name"]}
+_TELECOM_METRIC = {"category": ["name", "bomc_id", "cmdb_id"], "float32": ["value"]}
+
+SCHEMAS: Dict[str, Dict[str, Dict[str, List[str]]]] = {
+    "Bank": {
+        "metric_app": {"category": ["tc"], "float32": ["rr", "sr", "mrt"], "integer": ["cnt"]},
+        "metric_container": {"category": ["cmdb_id", "kpi_name"], "float32": ["value", "normalized_value"]},
+        "trace_span": {"category": ["cmdb_id"], "float32": ["duration"]},
+        "log_service": _LOG,
+    },
+    "Market": {
+        "metric_container": _METRIC_LONG,
+        "metric_mesh": _METRIC_LONG,
+        "metric_node": _METRIC_LONG,
+        "metric_runtime": _METRIC_LONG,
+        "metric_service": {"category": ["service"], "float32": ["rr", "sr", "mrt"], "integer": ["count"]},
+        "trace_span": {"category": ["cmdb_id", "type", "operation_name"], "float32": ["duration"], "integer": ["status_code"]},
+        "log_proxy": _LOG,
+        "log_service": _LOG,
+    },
+    "Telecom": {
+        "metric_app": {"category": ["serviceName"], "float32": ["avg_time", "succee_rate"], "integer": ["num", "succee_num"]},
+        "metric_container": _TELECOM_METRIC,
+        "metric_middleware": _TELECOM_METRIC,
+        "metric_node": _TELECOM_METRIC,
+        "metric_service": _TELECOM_METRIC,
+        "trace_span": {"category": ["callType", "cmdb_id", "dsName", "serviceName", "success"], "float32": ["elapsedTime"]},
+    },
+}
+
+# Files without a schema: text columns with at most this share of distinct values become categories
+CATEGORY_RATIO = 0.5
+
+# Column holding the UTC+8 minute of each row, as a naive datetime
+MINUTE_COLUMN = "minute"
+LOCAL_OFFSET = 8 * 3600
+
+
+def dataset_of(path: str) -> Optional[str]:
+    """Dataset of a telemetry file, from the dataset/<name>/ part of its path"""
+    parts = os.path.abspath(path).split(os.sep)
+    for i, part in enumerate(parts[:-1]):
+        if part == "dataset" and parts[i + 1] in SCHEMAS:
+            return parts[i + 1]
+    return None
+
+
+def schema_for(path: str, dataset: Optional[str] = None) -> Optional[Dict[str, List[str]]]:
+    """
+    Compact dtypes of a telemetry file, None if the file is not described in SCHEMAS
+
+    Args:
+        path: Path of the CSV file
+        dataset: Bank, Market or Telecom, taken from the path if None
+    """
+    dataset = dataset or dataset_of(path)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return SCHEMAS.get(dataset, {}).get(stem)
+
+
+def infer_schema(df: pd.DataFrame) -> Dict[str, List[str]]:
+    """Compact dtypes for a file without a schema, from its loaded columns"""
+    schema = {"category": [], "float32": [], "integer": []}
+    for name in df.columns:
+        if name in TIME_COLUMNS:
+            continue
+        kind = df[name].dtype.kind
+        if kind == "f":
+            schema["float32"].append(name)
+        elif kind in "iu":
+            schema["integer"].append(name)
+        elif kind == "O" and len(df) and df[name].nunique() <= CATEGORY_RATIO * len(df):
+            schema["category"].append(name)
+    return schema
+
+
+def minute_buckets(timestamps: pd.Series) -> pd.Series:
+    """UTC+8 wall-clock minute of epoch timestamps in seconds or milliseconds, as naive datetimes"""
+    values = timestamps.to_numpy()
+    if len(values) and values[0] > MILLISECOND_THRESHOLD:
+        values = values // 1000
+    minutes = (values.astype(np.int64) + LOCAL_OFFSET) // 60 * 60
+    return pd.Series(minutes.astype("datetime64[s]"), index=timestamps.index, name=MINUTE_COLUMN)
+
+
+def compact_frame(df: pd.DataFrame, path: Optional[str] = None, dataset: Optional[str] = None,
+                  schema: Optional[Dict[str, List[str]]] = None, minutes: bool = True) -> pd.DataFrame:
+    """
+    Convert a telemetry frame to compact dtypes, see SCHEMAS
+
+    Identifiers become categories (only the values present in the frame), measurements
+    float32 and counters the smallest integer type. Group categories with
+    groupby(..., observed=True).
+
+    Args:
+        df: Frame loaded from a telemetry file
+        path: Path of the file, selects its schema
+        dataset: Bank, Market or Telecom, taken from the path if None
+        schema: Compact dtypes to use instead of the file's schema
+        minutes: Add MINUTE_COLUMN, the UTC+8 minute of each row
+
+    Returns:
+        pd.DataFrame with the same columns (plus MINUTE_COLUMN) and rows
+    """
+    if schema is None:
+        schema = (schema_for(path, dataset) if path is not None else None) or infer_schema(df)
+    columns = {}
+    for name in schema.get("category", []):
+        if name in df.columns:
+            column = df[name]
+            columns[name] = (column.cat.remove_unused_categories() if isinstance(column.dtype, pd.CategoricalDtype)
+                             else column.astype("category"))
+    for name in schema.get("float32", []):
+        if name in df.columns and df[name].dtype.kind in "iuf":
+            columns[name] = df[name].astype(np.float32)
+    for name in schema.get("integer", []):
+        if name in df.columns and df[name].dtype.kind in "iu":
+            columns[name] = pd.to_numeric(df[name], downcast="integer")
+    if columns:
+        df = df.assign(**columns)
+    if minutes:
+        time_column = next((column for column in TIME_COLUMNS if column in df.columns), None)
+        if time_column is not None:
+            df = df.assign(**{MINUTE_COLUMN: minute_buckets(df[time_column])})
+    return df
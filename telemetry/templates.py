@@ -0,0 +1,435 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from .columnar import DERIVED_DIR, MILLISECOND_THRESHOLD, TIME_COLUMNS, _source_stamp, is_fresh as columns_fresh, open_table
+from .loader import load_window
+from .metrics import ComponentTable, write_component_table
+
+# Log templates of a log file, e.g. dataset/Bank/telemetry/2021_03_04/derived/templates/log/log_service/
+# holds miner.json (the templates and the state of the miner), template_ids.npy (the template of
+# every row of the file) and counts/ (per minute, component and template row counts)
+TEMPLATES_DIR = "templates"
+TEMPLATES_VERSION = 1
+MESSAGE_COLUMNS = ["value", "message"]
+RESOLUTION = 60
+
+# Drain parameters: messages are grouped by token count, then by their first DRAIN_DEPTH - 2
+# tokens; within a group a message joins the most similar template if at least
+# DRAIN_SIMILARITY of their tokens are equal
+DRAIN_DEPTH = 4
+DRAIN_SIMILARITY = 0.4
+DRAIN_MAX_CHILDREN = 100
+WILDCARD = "<*>"
+
+# Variable parts replaced by WILDCARD before mining
+MASKS = [
+    re.compile(r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b"),
+    re.compile(r"\b\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?\b"),
+    re.compile(r"\b0[xX][0-9a-fA-F]+\b"),
+    re.compile(r"(?<![A-Za-z])[-+]?\d+(?:\.\d+)?(?![A-Za-z])"),
+]
+
+# Bytes before the processed offset whose hash tells an appended file from a rewritten one
+TAIL_BYTES = 4096
+
+# Templates mined in memory because they could not be stored (read-only dataset), per file
+_computed: Dict[str, Tuple[Dict[str, int], "DrainMiner", pd.DataFrame]] = {}
+_load_lock = threading.Lock()
+
+
+def tokenize(message: str) -> List[str]:
+    """Tokens of a log message with ids, addresses and numbers masked"""
+    for mask in MASKS:
+        message = mask.sub(WILDCARD, message)
+    return message.split()
+
+
+class DrainMiner:
+    """
+    Drain log template miner (He et al., ICWS 2017) with stable template ids
+
+    Templates only get more general as messages are added, and keep their id, so ids assigned
+    to earlier rows stay valid when the miner is reloaded and fed the rows appended to a file.
+
+    Args:
+        state: Templates and tree saved by to_state, a new miner if None
+    """
+
+    def __init__(self, state: Optional[dict] = None):
+        self.templates: List[List[str]] = []
+        self.sizes: List[int] = []
+        self.paths: List[List[str]] = []
+        self.tree: Dict[str, dict] = {}
+        for tokens, size, path in (state or {}).get("templates", []):
+            self._add_template(tokens, size, path)
+
+    def _add_template(self, tokens: List[str], size: int, path: List[str]) -> int:
+        template_id = len(self.templates)
+        self.templates.append(list(tokens))
+        self.sizes.append(size)
+        self.paths.append(list(path))
+        node = self.tree
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node.setdefault(path[-1], []).append(template_id)
+        return template_id
+
+    def _path(self, tokens: List[str]) -> List[str]:
+        """Keys of the tree levels for a message, the last level holds the candidate templates"""
+        path = [str(len(tokens))]
+        node = self.tree.get(path[0], {})
+        for token in tokens[:DRAIN_DEPTH - 2]:
+            key = WILDCARD if any(c.isdigit() for c in token) else token
+            if key not in node and len(node) >= DRAIN_MAX_CHILDREN:
+                key = WILDCARD
+            path.append(key)
+            node = node.get(key, {})
+        return path
+
+    def _candidates(self, path: List[str]) -> List[int]:
+        node = self.tree
+        for key in path:
+            if key not in node:
+                return []
+            node = node[key]
+        return node
+
+    def _best(self, tokens: List[str], candidates: List[int]) -> Optional[int]:
+        best, best_score = None, (-1.0, -1)
+        for template_id in candidates:
+            template = self.templates[template_id]
+            equal = sum(1 for a, b in zip(template, tokens) if a == b)
+            wildcards = template.count(WILDCARD)
+            score = (equal / len(tokens) if tokens else 1.0, wildcards)
+            if score > best_score:
+                best, best_score = template_id, score
+        return best if best_score[0] >= DRAIN_SIMILARITY else None
+
+    def add(self, message: str, count: int = 1) -> int:
+        """Add a message, returns the id of its template"""
+        tokens = tokenize(message)
+        path = self._path(tokens)
+        template_id = self._best(tokens, self._candidates(path))
+        if template_id is None:
+            return self._add_template(tokens, count, path)
+        template = self.templates[template_id]
+        for i, (a, b) in enumerate(zip(template, tokens)):
+            if a != b:
+                template[i] = WILDCARD
+        self.sizes[template_id] += count
+        return template_id
+
+    def match(self, message: str) -> int:
+        """Id of the template of a message without changing the templates, -1 if none fits"""
+        tokens = tokenize(message)
+        candidates = self._candidates(self._path(tokens))
+        for template_id in candidates:
+            template = self.templates[template_id]
+            if all(a == WILDCARD or a == b for a, b in zip(template, tokens)):
+                return template_id
+        best = self._best(tokens, candidates)
+        return -1 if best is None else best
+
+    def add_many(self, messages: pd.Series) -> np.ndarray:
+        """Template ids of many messages, each distinct message is mined once"""
+        codes, uniques = pd.factorize(messages.astype(str), use_na_sentinel=False)
+        counts = np.bincount(codes, minlength=len(uniques))
+        ids = np.array([self.add(message, int(count)) for message, count in zip(uniques, counts)], dtype=np.int32)
+        return ids[codes] if len(codes) else np.empty(0, dtype=np.int32)
+
+    def template(self, template_id: int) -> str:
+        return " ".join(self.templates[template_id]) if template_id >= 0 else ""
+
+    def template_texts(self, ids: np.ndarray) -> np.ndarray:
+        """Template of each id, "" for -1"""
+        texts = np.array([" ".join(tokens) for tokens in self.templates] + [""], dtype=object)
+        return texts[np.asarray(ids)]
+
+    def frame(self) -> pd.DataFrame:
+        """template_id, template and size (rows mined into it) of every template"""
+        return pd.DataFrame({"template_id": np.arange(len(self.templates), dtype=np.int32),
+                             "template": [" ".join(tokens) for tokens in self.templates],
+                             "size": np.array(self.sizes, dtype=np.int64)})
+
+    def to_state(self) -> dict:
+        return {"templates": [[tokens, size, path] for tokens, size, path in zip(self.templates, self.sizes, self.paths)]}
+
+
+def templates_dir(path: str) -> str:
+    """Directory of the templates of a log CSV (<day>/<modality>/<name>.csv)"""
+    path = os.path.abspath(path)
+    modality_dir, file_name = os.path.split(path)
+    day_dir, modality = os.path.split(modality_dir)
+    return os.path.join(day_dir, DERIVED_DIR, TEMPLATES_DIR, modality, os.path.splitext(file_name)[0])
+
+
+def _read_state(path: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(templates_dir(path), "miner.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _tail_hash(path: str, offset: int) -> str:
+    with open(path, "rb") as f:
+        f.seek(max(offset - TAIL_BYTES, 0))
+        return hashlib.sha1(f.read(min(offset, TAIL_BYTES))).hexdigest()
+
+
+def _status(path: str, state: Optional[dict]) -> str:
+    """"fresh", "appended" (only rows were added since the last run) or "stale" """
+    if state is None or state.get("version") != TEMPLATES_VERSION:
+        return "stale"
+    if state["source"] == _source_stamp(path):
+        return "fresh"
+    offset = state["offset"]
+    if os.path.getsize(path) > offset and state.get("ends_with_newline") and state.get("tail") == _tail_hash(path, offset):
+        return "appended"
+    return "stale"
+
+
+def is_fresh(path: str) -> bool:
+    """True if the templates of a log CSV exist and were mined from its current content"""
+    return _status(path, _read_state(path)) == "fresh"
+
+
+def _read_rows(path: str, state: Optional[dict]) -> Tuple[pd.DataFrame, int]:
+    """Rows not mined yet and the file size they end at: the appended rows, or the whole file"""
+    size = os.path.getsize(path)
+    if state is not None:
+        with open(path, "rb") as f:
+            f.seek(state["offset"])
+            return pd.read_csv(f, header=None, names=state["columns"]), size
+    table = open_table(path) if columns_fresh(path) else None
+    return (table.frame(copy=False) if table is not None else pd.read_csv(path)), size
+
+
+def _counts(df: pd.DataFrame, ids: np.ndarray) -> pd.DataFrame:
+    """Rows per minute, component and template"""
+    time_column = next(column for column in TIME_COLUMNS if column in df.columns)
+    timestamps = df[time_column].to_numpy().astype(np.int64)
+    if len(timestamps) and timestamps[0] > MILLISECOND_THRESHOLD:
+        timestamps = timestamps // 1000
+    rows = pd.DataFrame({
+        "timestamp": timestamps // RESOLUTION * RESOLUTION,
+        "cmdb_id": df["cmdb_id"].astype(str).to_numpy() if "cmdb_id" in df.columns else "",
+        "template_id": ids,
+    })
+    return rows.groupby(["cmdb_id", "timestamp", "template_id"], sort=True).size().rename("count").reset_index()
+
+
+def build_templates(path: str, force: bool = False) -> str:
+    """
+    Mine the log templates of a log CSV
+
+    If only rows were appended to the file since the last run, only those rows are mined: the
+    miner continues from its saved state, and the new template ids and counts are added to the
+    stored ones.
+
+    Args:
+        path: Path of the log CSV, e.g. coding/dataset/Bank/telemetry/2021_03_04/log/log_service.csv
+        force: Mine the whole file even if the templates are up to date
+
+    Returns:
+        str: Directory of the templates
+    """
+    target = templates_dir(path)
+    state = None if force else _read_state(path)
+    status = "stale" if force else _status(path, state)
+    if status == "fresh":
+        return target
+    if status == "stale":
+        state = None
+
+    df, size = _read_rows(path, state)
+    message_column = next((column for column in MESSAGE_COLUMNS if column in df.columns), None)
+    if message_column is None:
+        raise ValueError(f"No message column ({', '.join(MESSAGE_COLUMNS)}) in {path}")
+    miner = DrainMiner(state["miner"] if state is not None else None)
+    ids = miner.add_many(df[message_column])
+    counts = _counts(df, ids)
+    if state is not None:
+        ids = np.concatenate([np.load(os.path.join(target, "template_ids.npy")), ids])
+        previous = ComponentTable(os.path.join(target, "counts")).frame()
+        counts = pd.concat([previous, counts], ignore_index=True)
+        counts = counts.groupby(["cmdb_id", "timestamp", "template_id"], sort=True)["count"].sum().reset_index()
+
+    with open(path, "rb") as f:
+        f.seek(max(size - 1, 0))
+        ends_with_newline = f.read(1) == b"\n"
+    new_state = {
+        "version": TEMPLATES_VERSION,
+        "source": _source_stamp(path),
+        "offset": size,
+        "tail": _tail_hash(path, size),
+        "ends_with_newline": ends_with_newline,
+        "rows": int(len(ids)),
+        "columns": list(df.columns),
+        "miner": miner.to_state(),
+    }
+
+    # Written next to the target and renamed, so readers never see half an update
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=".build-", dir=os.path.dirname(target))
+    try:
+        np.save(os.path.join(staging, "template_ids.npy"), ids.astype(np.int32))
+        write_component_table(counts[["timestamp", "cmdb_id", "template_id", "count"]], os.path.join(staging, "counts"))
+        with open(os.path.join(staging, "miner.json"), "w", encoding="utf-8") as f:
+            json.dump(new_state, f, ensure_ascii=False)
+        if os.path.isdir(target):
+            shutil.rmtree(target, ignore_errors=True)
+        try:
+            os.rename(staging, target)
+        except OSError:
+            # Another process finished the same build first
+            if _read_state(path) is None:
+                raise
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return target
+
+
+def build_day(day_dir: str, force: bool = False) -> List[str]:
+    """Mine the templates of every log file of a day"""
+    log_dir = os.path.join(day_dir, "log")
+    if not os.path.isdir(log_dir):
+        return []
+    return [build_templates(os.path.join(log_dir, name), force=force)
+            for name in sorted(os.listdir(log_dir)) if name.endswith(".csv")]
+
+
+def _stored(path: str) -> bool:
+    """Mine the templates of a log CSV if they are not up to date, False if they cannot be stored"""
+    if is_fresh(path):
+        return True
+    try:
+        build_templates(path)
+    except OSError:
+        return False
+    return True
+
+
+def _computed_templates(path: str) -> Tuple["DrainMiner", pd.DataFrame]:
+    """Miner and counts of a log CSV mined in memory, kept for the rest of the process"""
+    key = os.path.abspath(path)
+    stamp = _source_stamp(path)
+    with _load_lock:
+        computed = _computed.get(key)
+    if computed is None or computed[0] != stamp:
+        df, _ = _read_rows(path, None)
+        miner = DrainMiner()
+        ids = miner.add_many(df[next(column for column in MESSAGE_COLUMNS if column in df.columns)])
+        computed = (stamp, miner, _counts(df, ids))
+        with _load_lock:
+            _computed[key] = computed
+    return computed[1], computed[2]
+
+
+def load_miner(path: str) -> DrainMiner:
+    """
+    Template miner of a log CSV, mined first if its templates are not up to date
+
+    Args:
+        path: Path of the log CSV, e.g. f"{TELEMETRY_DIR}/log/log_service.csv"
+    """
+    if _stored(path):
+        return DrainMiner(_read_state(path)["miner"])
+    return _computed_templates(path)[0]
+
+
+def load_templates(path: str) -> pd.DataFrame:
+    """
+    Log templates of a log CSV
+
+    Returns:
+        pd.DataFrame with template_id, template (variable parts as <*>) and size (rows of the
+        day with the template)
+    """
+    return load_miner(path).frame()
+
+
+def load_log_window(path: str, start: int, end: int, usecols: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Rows of a log CSV within [start, end), with the template_id and template of every row
+
+    Args:
+        path: Path of the log CSV, e.g. f"{TELEMETRY_DIR}/log/log_service.csv"
+        start: Window start, epoch seconds (e.g. WINDOW_START)
+        end: Window end, epoch seconds (e.g. WINDOW_END)
+        usecols: Columns to load, all columns if None (the message column is always loaded)
+
+    Returns:
+        pd.DataFrame: The rows within the window, in file order, plus template_id and template
+    """
+    miner = load_miner(path)
+    table = open_table(path)
+    if table is not None and table.time_column is not None and is_fresh(path) and _read_state(path)["rows"] == table.rows:
+        # The ids stored for the rows are used, no message is matched again
+        if usecols is not None and table.time_column not in usecols:
+            usecols = list(usecols) + [table.time_column]
+        df = table.frame(start, end, usecols=usecols)
+        ids = np.load(os.path.join(templates_dir(path), "template_ids.npy"), mmap_mode="r")[table.rows_between(start, end)]
+        return df.assign(template_id=np.asarray(ids), template=miner.template_texts(ids))
+
+    if usecols is not None:
+        columns = table.columns if table is not None else list(pd.read_csv(path, nrows=0).columns)
+        usecols = list(usecols) + [c for c in columns if c in MESSAGE_COLUMNS and c not in usecols][:1]
+    df = load_window(path, start, end, usecols=usecols)
+    message_column = next(column for column in MESSAGE_COLUMNS if column in df.columns)
+    codes, uniques = pd.factorize(df[message_column].astype(str), use_na_sentinel=False)
+    ids = np.array([miner.match(message) for message in uniques] + [-1], dtype=np.int32)[codes]
+    return df.assign(template_id=ids, template=miner.template_texts(ids))
+
+
+def load_template_counts(path: str, start: Optional[int] = None, end: Optional[int] = None,
+                         cmdb_id: Union[str, List[str], None] = None,
+                         template_id: Union[int, List[int], None] = None) -> pd.DataFrame:
+    """
+    Per minute row counts of every component and template of a log CSV
+
+    Args:
+        path: Path of the log CSV, e.g. f"{TELEMETRY_DIR}/log/log_service.csv"
+        start: Only minutes within [start, end), epoch seconds, the whole day if None
+        end: Window end, epoch seconds
+        cmdb_id: Only this component (or these components)
+        template_id: Only this template (or these templates)
+
+    Returns:
+        pd.DataFrame with timestamp (minute start), cmdb_id, template_id, count and template,
+        ordered by component and time
+    """
+    if _stored(path):
+        miner = DrainMiner(_read_state(path)["miner"])
+        counts = ComponentTable(os.path.join(templates_dir(path), "counts")).frame(start, end, cmdb_id=cmdb_id)
+    else:
+        miner, counts = _computed_templates(path)
+        if start is not None:
+            counts = counts[(counts["timestamp"] >= start) & (counts["timestamp"] < end)]
+        if cmdb_id is not None:
+            counts = counts[counts["cmdb_id"].isin([cmdb_id] if isinstance(cmdb_id, str) else cmdb_id)]
+        counts = counts[["timestamp", "cmdb_id", "template_id", "count"]]
+    if template_id is not None:
+        counts = counts[counts["template_id"].isin([template_id] if isinstance(template_id, int) else template_id)]
+    return counts.assign(template=miner.template_texts(counts["template_id"].to_numpy())).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Mine the log templates of telemetry days")
+    parser.add_argument("day_dirs", nargs="+", help="Telemetry day directories, e.g. coding/dataset/Bank/telemetry/2021_03_04")
+    parser.add_argument("--force", action="store_true", help="Mine files whose templates are up to date")
+    args = parser.parse_args()
+    for day_dir in args.day_dirs:
+        for directory in build_day(day_dir, force=args.force):
+            print(directory)
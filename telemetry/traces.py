@@ -0,0 +1,332 @@
+import os
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from .columnar import DERIVED_DIR, MILLISECOND_THRESHOLD, TIME_COLUMNS, _read_meta, _source_stamp, open_table
+from .metrics import ComponentTable, write_component_table
+
+# Per minute span counts, error counts and latency sketches of a trace file, per component and
+# per call edge, e.g. dataset/Market/cloudbed-1/telemetry/2022_03_20/derived/traces/trace_span/edges/
+TRACES_DIR = "traces"
+TRACES_VERSION = 1
+KINDS = ["components", "edges"]
+RESOLUTION = 60
+
+# Span columns of the datasets, in order of preference
+SPAN_ID_COLUMNS = ["span_id", "id"]
+PARENT_COLUMNS = ["parent_id", "parent_span", "pid"]
+DURATION_COLUMNS = ["duration", "elapsedTime"]
+# A span failed if its status_code (Market) is not one of these, or its success flag (Telecom)
+# is false. Bank spans carry no status and never count as errors
+OK_STATUS_CODES = {"0", "200", "ok"}
+
+# Latency sketch: durations fall into log-spaced bins of ratio SKETCH_GAMMA, so a quantile read
+# from the sketch is within about 5% of the true one. Durations up to 1 fall into bin 0
+SKETCH_GAMMA = 1.1
+SKETCH_BINS = 256
+DEFAULT_QUANTILES = (0.5, 0.95, 0.99)
+
+_open_rollups: Dict[str, ComponentTable] = {}
+_computed: Dict[str, Tuple[Dict[str, int], Dict[str, Tuple[pd.DataFrame, Dict[str, np.ndarray]]]]] = {}
+_open_lock = threading.Lock()
+
+
+def rollup_dir(day_dir: str, kind: str, file: str = "trace_span") -> str:
+    return os.path.join(os.path.abspath(day_dir), DERIVED_DIR, TRACES_DIR, file, kind)
+
+
+def _trace_path(day_dir: str, file: str) -> str:
+    return os.path.join(day_dir, "trace", f"{file}.csv")
+
+
+def trace_files(day_dir: str) -> List[str]:
+    """Trace files of a day, without the .csv extension"""
+    trace_dir = os.path.join(day_dir, "trace")
+    if not os.path.isdir(trace_dir):
+        return []
+    return [name[:-4] for name in sorted(os.listdir(trace_dir)) if name.endswith(".csv")]
+
+
+def is_fresh(day_dir: str, kind: str, file: str = "trace_span") -> bool:
+    """True if a trace rollup exists and was computed from the current trace file"""
+    meta = _read_meta(rollup_dir(day_dir, kind, file))
+    return (meta is not None and meta.get("traces_version") == TRACES_VERSION
+            and meta.get("source") == _source_stamp(_trace_path(day_dir, file)))
+
+
+def sketch_bins(durations: np.ndarray) -> np.ndarray:
+    """Sketch bin of each duration"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bins = np.ceil(np.log(np.maximum(durations, 1.0)) / np.log(SKETCH_GAMMA))
+    return np.clip(np.nan_to_num(bins), 0, SKETCH_BINS - 1).astype(np.uint8)
+
+
+def bin_values() -> np.ndarray:
+    """Duration a sketch bin stands for, the middle of its range"""
+    values = 2 * SKETCH_GAMMA ** np.arange(SKETCH_BINS) / (SKETCH_GAMMA + 1)
+    values[0] = 1.0
+    return values
+
+
+def _read_spans(path: str) -> pd.DataFrame:
+    """timestamp (epoch seconds), cmdb_id, span and parent ids, duration and error of every span"""
+    table = open_table(path)
+    columns = table.columns if table is not None else list(pd.read_csv(path, nrows=0).columns)
+
+    def first(candidates: List[str]) -> Optional[str]:
+        return next((column for column in candidates if column in columns), None)
+
+    time_column, span_column = first(TIME_COLUMNS), first(SPAN_ID_COLUMNS)
+    parent_column, duration_column = first(PARENT_COLUMNS), first(DURATION_COLUMNS)
+    if time_column is None or duration_column is None or "cmdb_id" not in columns:
+        raise ValueError(f"{path} is not a trace file with timestamp, cmdb_id and duration columns")
+    status_column = first(["status_code", "success"])
+    usecols = [c for c in (time_column, "cmdb_id", span_column, parent_column, duration_column, status_column) if c]
+    df = table.frame(usecols=usecols, copy=False) if table is not None else pd.read_csv(path, usecols=usecols)
+
+    timestamps = df[time_column].to_numpy().astype(np.int64)
+    if len(timestamps) and timestamps[0] > MILLISECOND_THRESHOLD:
+        timestamps = timestamps // 1000
+    if status_column == "success":
+        errors = ~df[status_column].astype(str).str.lower().isin(["true", "1"]).to_numpy()
+    elif status_column == "status_code":
+        errors = ~df[status_column].astype(str).str.lower().isin(OK_STATUS_CODES).to_numpy()
+    else:
+        errors = np.zeros(len(df), dtype=bool)
+    spans = pd.DataFrame({
+        "timestamp": timestamps // RESOLUTION * RESOLUTION,
+        "cmdb_id": df["cmdb_id"].astype(str).to_numpy(),
+        "duration": pd.to_numeric(df[duration_column], errors="coerce").to_numpy(dtype=np.float64),
+        "error": errors,
+    })
+    if span_column is not None and parent_column is not None:
+        spans["span_id"] = df[span_column].astype(str).to_numpy()
+        spans["parent_id"] = df[parent_column].astype(str).to_numpy()
+    return spans
+
+
+def _edges(spans: pd.DataFrame) -> pd.DataFrame:
+    """Spans with the component of their parent span as caller, spans without a parent are left out"""
+    if "parent_id" not in spans.columns:
+        return spans.iloc[:0].assign(caller=pd.Series(dtype=object))
+    parents = spans[["span_id", "cmdb_id"]].drop_duplicates("span_id").rename(
+        columns={"span_id": "parent_id", "cmdb_id": "caller"})
+    return spans.merge(parents, on="parent_id", how="inner", sort=False)
+
+
+def compute_rollup(spans: pd.DataFrame, keys: List[str]) -> Tuple[pd.DataFrame, Dict[str, np.ndarray]]:
+    """
+    Per minute aggregates and latency sketches of spans
+
+    Args:
+        spans: Spans with timestamp (minute), the key columns, duration and error
+        keys: Series columns besides cmdb_id, e.g. ["caller"]
+
+    Returns:
+        The aggregates (timestamp, cmdb_id, keys, count, errors, sum, min, max) ordered by
+        component and time, and the sketches as sparse rows: sketch_offsets (row i owns
+        entries offsets[i]:offsets[i + 1]), sketch_bins and sketch_counts
+    """
+    group_columns = ["cmdb_id", "timestamp"] + keys
+    grouped = spans.groupby(group_columns, sort=True)
+    rollup = grouped.agg(count=("duration", "size"), errors=("error", "sum"), sum=("duration", "sum"),
+                         min=("duration", "min"), max=("duration", "max")).reset_index()
+    rollup["errors"] = rollup["errors"].astype(np.int64)
+    rollup = rollup[["timestamp"] + ["cmdb_id"] + keys + ["count", "errors", "sum", "min", "max"]]
+
+    # One entry per (row, bin) with spans in it, in row order
+    groups = grouped.ngroup().to_numpy().astype(np.int64)
+    entries = groups * SKETCH_BINS + sketch_bins(spans["duration"].to_numpy())
+    entries, counts = np.unique(entries, return_counts=True)
+    offsets = np.searchsorted(entries // SKETCH_BINS, np.arange(len(rollup) + 1), side="left")
+    arrays = {
+        "sketch_offsets": offsets.astype(np.int64),
+        "sketch_bins": (entries % SKETCH_BINS).astype(np.uint8),
+        "sketch_counts": counts.astype(np.uint32),
+    }
+    return rollup, arrays
+
+
+def compute_rollups(day_dir: str, file: str = "trace_span") -> Dict[str, Tuple[pd.DataFrame, Dict[str, np.ndarray]]]:
+    """Component and edge rollups of a trace file, computed in memory"""
+    spans = _read_spans(_trace_path(day_dir, file))
+    return {"components": compute_rollup(spans, []), "edges": compute_rollup(_edges(spans), ["caller"])}
+
+
+def build_rollups(day_dir: str, file: str = "trace_span", force: bool = False) -> List[str]:
+    """
+    Compute and store the per minute component and edge rollups of a trace file
+
+    Args:
+        day_dir: Telemetry directory of the day, e.g. coding/dataset/Bank/telemetry/2021_03_04
+        file: Trace file name without .csv
+        force: Recompute rollups that are up to date
+
+    Returns:
+        List[str]: Directories of the component and edge rollups
+    """
+    targets = [rollup_dir(day_dir, kind, file) for kind in KINDS]
+    if not force and all(is_fresh(day_dir, kind, file) for kind in KINDS):
+        return targets
+    stamp = _source_stamp(_trace_path(day_dir, file))
+    for kind, (rollup, arrays) in compute_rollups(day_dir, file).items():
+        write_component_table(rollup, rollup_dir(day_dir, kind, file), arrays=arrays, traces_version=TRACES_VERSION,
+                              source=stamp, resolution=RESOLUTION, sketch_gamma=SKETCH_GAMMA)
+    return targets
+
+
+def build_day(day_dir: str, force: bool = False) -> List[str]:
+    """Compute the rollups of every trace file of a day"""
+    built = []
+    for file in trace_files(day_dir):
+        built += build_rollups(day_dir, file, force=force)
+    return built
+
+
+def open_rollup(day_dir: str, kind: str, file: str = "trace_span") -> Optional[ComponentTable]:
+    """
+    Open a stored trace rollup
+
+    Returns:
+        ComponentTable, or None if the rollup has not been built or the trace file has changed
+    """
+    key = rollup_dir(day_dir, kind, file)
+    with _open_lock:
+        rollup = _open_rollups.get(key)
+        if rollup is not None and rollup.table.meta["source"] == _source_stamp(_trace_path(day_dir, file)):
+            return rollup
+        if not is_fresh(day_dir, kind, file):
+            _open_rollups.pop(key, None)
+            return None
+        rollup = _open_rollups[key] = ComponentTable(key)
+        return rollup
+
+
+def _select(day_dir: str, kind: str, file: str, start: Optional[int], end: Optional[int],
+            cmdb_id: Union[str, List[str], None], caller: Union[str, List[str], None]
+            ) -> Tuple[pd.DataFrame, np.ndarray, Dict[str, np.ndarray]]:
+    """Rows of a rollup, their row numbers and the sketch arrays, computed if not stored"""
+    if kind not in KINDS:
+        raise ValueError(f"Unknown kind {kind!r}, expected one of {', '.join(KINDS)}")
+    filters = {"caller": caller} if kind == "edges" else {}
+    rollup = open_rollup(day_dir, kind, file)
+    if rollup is not None:
+        rows = rollup.rows(start, end, cmdb_id, **filters)
+        rows = np.arange(rollup.table.rows)[rows] if isinstance(rows, slice) else np.asarray(rows)
+        df = pd.DataFrame({name: rollup.table.column(name, rows) for name in rollup.table.columns})
+        arrays = {name: rollup.table.array(name) for name in ("sketch_offsets", "sketch_bins", "sketch_counts")}
+        return df, rows, arrays
+
+    path = os.path.abspath(_trace_path(day_dir, file))
+    stamp = _source_stamp(path)
+    with _open_lock:
+        computed = _computed.get(path)
+    if computed is None or computed[0] != stamp:
+        computed = (stamp, compute_rollups(day_dir, file))
+        with _open_lock:
+            _computed[path] = computed
+    df, arrays = computed[1][kind]
+    mask = np.ones(len(df), dtype=bool)
+    if start is not None:
+        mask &= ((df["timestamp"] >= start) & (df["timestamp"] < end)).to_numpy()
+    for column, values in dict(filters, cmdb_id=cmdb_id).items():
+        if values is not None:
+            mask &= df[column].isin([values] if isinstance(values, str) else values).to_numpy()
+    rows = np.flatnonzero(mask)
+    return df.iloc[rows].reset_index(drop=True), rows, arrays
+
+
+def _sketch_quantiles(arrays: Dict[str, np.ndarray], rows: np.ndarray, groups: np.ndarray, n_groups: int,
+                      quantiles: Sequence[float]) -> np.ndarray:
+    """Quantiles of the merged sketches of the rows of each group, shape (n_groups, len(quantiles))"""
+    offsets = arrays["sketch_offsets"]
+    starts, ends = offsets[rows], offsets[rows + 1]
+    lengths = ends - starts
+    # Entries of all selected rows: starts[i], starts[i] + 1, ... for every row
+    entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    histogram = np.zeros((n_groups, SKETCH_BINS), dtype=np.int64)
+    np.add.at(histogram, (np.repeat(groups, lengths), np.asarray(arrays["sketch_bins"])[entries]),
+              np.asarray(arrays["sketch_counts"])[entries])
+    cumulative = np.cumsum(histogram, axis=1)
+    totals = cumulative[:, -1:]
+    values = bin_values()
+    result = np.full((n_groups, len(quantiles)), np.nan)
+    for i, q in enumerate(quantiles):
+        # First bin whose cumulative count reaches the rank of the quantile
+        positions = (cumulative < np.maximum(np.ceil(q * totals), 1)).sum(axis=1)
+        result[:, i] = values[np.minimum(positions, SKETCH_BINS - 1)]
+    result[totals[:, 0] == 0] = np.nan
+    return result
+
+
+def _quantile_columns(quantiles: Sequence[float]) -> List[str]:
+    return [f"p{q * 100:g}".replace(".", "_") for q in quantiles]
+
+
+def load_trace_rollup(day_dir: str, kind: str = "components", start: Optional[int] = None, end: Optional[int] = None,
+                      cmdb_id: Union[str, List[str], None] = None, caller: Union[str, List[str], None] = None,
+                      quantiles: Sequence[float] = DEFAULT_QUANTILES, file: str = "trace_span") -> pd.DataFrame:
+    """
+    Per minute span count, error count and latency of each component or call edge
+
+    Args:
+        day_dir: Telemetry directory of the day, e.g. TELEMETRY_DIR
+        kind: "components" (series by cmdb_id) or "edges" (series by caller and cmdb_id, the
+            component of the parent span and of the span, so latency is measured at cmdb_id)
+        start: Only minutes within [start, end), epoch seconds, the whole day if None
+        end: Window end, epoch seconds
+        cmdb_id: Only this component (or these components), for edges the called one
+        caller: Only edges from this component (or these components)
+        quantiles: Latency quantiles to read from the sketches, e.g. (0.5, 0.99) gives p50 and p99
+        file: Trace file name without .csv
+
+    Returns:
+        pd.DataFrame with timestamp (minute start), cmdb_id, caller for edges, count, errors,
+        sum, min, max, mean and one column per quantile, in the duration unit of the file
+    """
+    df, rows, arrays = _select(day_dir, kind, file, start, end, cmdb_id, caller)
+    df["mean"] = df["sum"] / df["count"]
+    values = _sketch_quantiles(arrays, rows, np.arange(len(rows)), len(rows), quantiles)
+    for i, column in enumerate(_quantile_columns(quantiles)):
+        df[column] = np.clip(values[:, i], df["min"].to_numpy(), df["max"].to_numpy()) if len(df) else values[:, i]
+    return df
+
+
+def trace_summary(day_dir: str, start: Optional[int] = None, end: Optional[int] = None, kind: str = "components",
+                  cmdb_id: Union[str, List[str], None] = None, caller: Union[str, List[str], None] = None,
+                  quantiles: Sequence[float] = DEFAULT_QUANTILES, file: str = "trace_span") -> pd.DataFrame:
+    """
+    Span count, errors and latency of each component or call edge over a whole window,
+    merged from the per minute rollups (see load_trace_rollup for the arguments)
+
+    Returns:
+        pd.DataFrame with cmdb_id, caller for edges, count, errors, error_rate, mean, min, max
+        and one column per quantile, busiest series first
+    """
+    df, rows, arrays = _select(day_dir, kind, file, start, end, cmdb_id, caller)
+    keys = ["caller", "cmdb_id"] if kind == "edges" else ["cmdb_id"]
+    grouped = df.groupby(keys, sort=True)
+    summary = grouped.agg(count=("count", "sum"), errors=("errors", "sum"), sum=("sum", "sum"),
+                          min=("min", "min"), max=("max", "max")).reset_index()
+    summary["error_rate"] = summary["errors"] / summary["count"]
+    summary["mean"] = summary["sum"] / summary["count"]
+    values = _sketch_quantiles(arrays, rows, grouped.ngroup().to_numpy(), len(summary), quantiles)
+    for i, column in enumerate(_quantile_columns(quantiles)):
+        summary[column] = np.clip(values[:, i], summary["min"].to_numpy(), summary["max"].to_numpy())
+    summary = summary.drop(columns="sum")
+    return summary.sort_values("count", ascending=False, ignore_index=True)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Precompute the per minute component and call edge rollups of trace files")
+    parser.add_argument("day_dirs", nargs="+", help="Telemetry day directories, e.g. coding/dataset/Bank/telemetry/2021_03_04")
+    parser.add_argument("--force", action="store_true", help="Recompute rollups that are up to date")
+    args = parser.parse_args()
+    for day_dir in args.day_dirs:
+        for directory in build_day(day_dir, force=args.force):
+            print(directory)
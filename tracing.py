@@ -0,0 +1,363 @@
+import asyncio
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Span kinds recorded by the workflow, the coders and the executor
+SPAN_KINDS = ["diagnosis", "phase", "round", "llm", "tool", "exec", "tool_save", "refine", "event"]
+
+# OTLP span kinds: LLM calls and code executions call out of the process
+OTLP_CLIENT_KINDS = {"llm", "exec"}
+
+TRACE_FORMATS = ["chrome", "otlp"]
+
+# Innermost open span of the running task, spans started in it become its children
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+def usage_tokens(usage) -> Tuple[int, int]:
+    """
+    Read prompt and completion tokens from a models_usage / RequestUsage object
+
+    Args:
+        usage: Usage object of a model result or chat message, may be None
+
+    Returns:
+        (prompt_tokens, completion_tokens), zeros when the model did not report usage
+    """
+    if usage is None:
+        return 0, 0
+    return getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0
+
+
+def add_token_usage(token_usage: Dict[str, int], prompt_tokens: int, completion_tokens: int) -> None:
+    """Add tokens to a {"prompt", "completion", "total"} counter"""
+    token_usage["prompt"] += prompt_tokens
+    token_usage["completion"] += completion_tokens
+    token_usage["total"] += prompt_tokens + completion_tokens
+
+
+@dataclass
+class Span:
+    """One timed operation: an LLM call, a code execution, a tool save, a refine attempt, ..."""
+    name: str
+    kind: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    start_ns: int
+    end_ns: Optional[int] = None
+    outcome: str = "ok"
+    attributes: Dict[str, object] = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        """Seconds between start and end, up to now while the span is open"""
+        end_ns = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end_ns - self.start_ns) / 1e9
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+
+class Tracer:
+    """
+    Span recorder of one workflow
+
+    Every LLM call, code execution, tool save and refine attempt of a diagnosis is
+    recorded as a span with its start and end, tokens, output bytes and outcome. Spans of
+    one diagnosis share a trace id, so a batch of incidents can be told apart in a viewer.
+    The tracer also keeps the per-agent LLM call and token counters of the workflow.
+
+    Traces are written offline with export(), either as OpenTelemetry OTLP/JSON or as a
+    Chrome trace (chrome://tracing, Perfetto).
+
+    Args:
+        agents: Agent names the counters are created for up front, others are added on first use
+        service_name: service.name resource attribute of the OTLP export
+    """
+
+    def __init__(self, agents: Iterable[str] = (), service_name: str = "codegenrca"):
+        self.service_name = service_name
+        self.spans: List[Span] = []
+        self.llm_call_count: Dict[str, int] = {agent: 0 for agent in agents}
+        self.llm_call_count["total"] = 0
+        self.token_usage: Dict[str, Dict[str, int]] = {
+            agent: {"prompt": 0, "completion": 0, "total": 0} for agent in agents
+        }
+        self.token_usage["total"] = {"prompt": 0, "completion": 0, "total": 0}
+        self._open: Dict[str, Span] = {}
+        self._activations: Dict[str, Token] = {}
+        self._adopted: Optional[Span] = None
+        self._trace_id: Optional[str] = None
+
+    def _parent(self) -> Optional[Span]:
+        current = _current_span.get()
+        if current is not None and current.span_id in self._open:
+            return current
+        # Agent handlers run in runtime tasks, which do not see the caller's context
+        return self._adopted
+
+    def start_span(self, name: str, kind: str = "event", parent: Optional[Span] = None, root: bool = False,
+                   activate: bool = False, **attributes) -> Span:
+        """
+        Open a span, close it with finish(). Use span() where the operation is a block.
+
+        Args:
+            name: Span name, e.g. "planner" or "execute"
+            kind: One of SPAN_KINDS
+            parent: Parent span, defaults to the innermost open span of the running task
+            root: Start a span without parent, e.g. the root of a new trace
+            activate: Make spans started by the running task children of this span until it is finished
+            **attributes: Span attributes, e.g. agent="metric_coder"
+        """
+        if not root:
+            parent = parent or self._parent()
+        if parent is not None:
+            trace_id = parent.trace_id
+        else:
+            trace_id = self._trace_id or os.urandom(16).hex()
+        span = Span(
+            name=name,
+            kind=kind,
+            trace_id=trace_id,
+            span_id=os.urandom(8).hex(),
+            parent_id=parent.span_id if parent is not None else None,
+            start_ns=time.time_ns(),
+            attributes=dict(attributes),
+        )
+        self._open[span.span_id] = span
+        if activate:
+            self._activations[span.span_id] = _current_span.set(span)
+        return span
+
+    def finish(self, span: Span, outcome: Optional[str] = None) -> None:
+        """
+        Close a span opened with start_span()
+
+        If the span did not end well, spans still open below it, e.g. a round cut short by a
+        deadline, are closed with its outcome. Otherwise they keep running, e.g. a tool
+        generation started while an explorer was still streaming.
+        """
+        if span.span_id not in self._open:
+            return
+        if outcome is not None:
+            span.outcome = outcome
+        activation = self._activations.pop(span.span_id, None)
+        if activation is not None:
+            try:
+                _current_span.reset(activation)
+            except ValueError:
+                # Finished from another task, whose context never saw the span
+                pass
+        self._close(span)
+        if span.outcome == "ok":
+            return
+        closing = {span.span_id}
+        for child in sorted(self._open.values(), key=lambda child: child.start_ns):
+            if child.parent_id in closing:
+                closing.add(child.span_id)
+                self._activations.pop(child.span_id, None)
+                child.outcome = span.outcome
+                self._close(child)
+
+    def _close(self, span: Span) -> None:
+        del self._open[span.span_id]
+        span.end_ns = time.time_ns()
+        self.spans.append(span)
+
+    @contextmanager
+    def span(self, name: str, kind: str = "event", parent: Optional[Span] = None, root: bool = False, **attributes) -> Iterator[Span]:
+        """Record the enclosed block as a span, its outcome reflects how the block was left"""
+        span = self.start_span(name, kind, parent, root, **attributes)
+        reset = _current_span.set(span)
+        try:
+            yield span
+        except asyncio.CancelledError:
+            span.outcome = "cancelled"
+            raise
+        except TimeoutError:
+            span.outcome = "timeout"
+            raise
+        except Exception as e:
+            span.outcome = "error"
+            span.set(error=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            _current_span.reset(reset)
+            self.finish(span)
+
+    @contextmanager
+    def trace(self, name: str, **attributes) -> Iterator[Span]:
+        """Record the enclosed block as the root span of a new trace, e.g. one diagnosis"""
+        previous = self._trace_id
+        self._trace_id = os.urandom(16).hex()
+        try:
+            with self.span(name, "diagnosis", root=True, **attributes) as span:
+                yield span
+        finally:
+            self._trace_id = previous
+
+    @contextmanager
+    def adopt(self, span: Span) -> Iterator[None]:
+        """Make spans of agent handlers running in other tasks children of span"""
+        previous = self._adopted
+        self._adopted = span
+        try:
+            yield
+        finally:
+            self._adopted = previous
+
+    def event(self, name: str, **attributes) -> Span:
+        """Record an instantaneous event, e.g. a refine decision"""
+        span = self.start_span(name, "event", **attributes)
+        self.finish(span)
+        return span
+
+    def record_llm(self, span: Span, agent: str, usage, output: str = "") -> Tuple[int, int]:
+        """
+        Count an LLM call of an agent and attach its tokens and output size to span
+
+        Args:
+            span: Span of the call
+            agent: Agent name the call is counted for
+            usage: models_usage / RequestUsage of the reply, may be None
+            output: Reply text
+
+        Returns:
+            (prompt_tokens, completion_tokens) of the call
+        """
+        prompt_tokens, completion_tokens = usage_tokens(usage)
+        span.set(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            output_bytes=len(output.encode("utf-8")) if isinstance(output, str) else 0,
+        )
+        self.llm_call_count[agent] = self.llm_call_count.get(agent, 0) + 1
+        self.llm_call_count["total"] += 1
+        add_token_usage(self.token_usage.setdefault(agent, {"prompt": 0, "completion": 0, "total": 0}), prompt_tokens, completion_tokens)
+        add_token_usage(self.token_usage["total"], prompt_tokens, completion_tokens)
+        return prompt_tokens, completion_tokens
+
+    def tokens_used(self) -> int:
+        return self.token_usage["total"]["total"]
+
+    def summary(self, trace_id: Optional[str] = None) -> Dict[str, Dict[str, float]]:
+        """
+        Count, seconds and tokens per span kind
+
+        Args:
+            trace_id: Only count spans of this trace, all spans if None
+
+        Returns:
+            dict: {kind: {"count", "seconds", "tokens"}} for the kinds that were recorded
+        """
+        summary = defaultdict(lambda: {"count": 0, "seconds": 0.0, "tokens": 0})
+        for span in self.spans:
+            if trace_id is not None and span.trace_id != trace_id:
+                continue
+            entry = summary[span.kind]
+            entry["count"] += 1
+            entry["seconds"] += span.duration
+            entry["tokens"] += span.attributes.get("prompt_tokens", 0) + span.attributes.get("completion_tokens", 0)
+        return {
+            kind: {**summary[kind], "seconds": round(summary[kind]["seconds"], 2)}
+            for kind in SPAN_KINDS if kind in summary
+        }
+
+    def to_otlp(self) -> Dict[str, object]:
+        """Finished spans as an OTLP/JSON ExportTraceServiceRequest"""
+        spans = []
+        for span in self.spans:
+            otlp_span = {
+                "traceId": span.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 3 if span.kind in OTLP_CLIENT_KINDS else 1,
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns),
+                "attributes": _otlp_attributes({"codegenrca.kind": span.kind, "codegenrca.outcome": span.outcome, **span.attributes}),
+                "status": {"code": 1} if span.outcome in ("ok", "success") else {"code": 2, "message": span.outcome},
+            }
+            if span.parent_id:
+                otlp_span["parentSpanId"] = span.parent_id
+            spans.append(otlp_span)
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": _otlp_attributes({"service.name": self.service_name})},
+                "scopeSpans": [{"scope": {"name": "codegenrca.tracing"}, "spans": spans}],
+            }]
+        }
+
+    def to_chrome_trace(self) -> Dict[str, object]:
+        """Finished spans as Chrome trace events, one process per diagnosis and one thread per agent"""
+        events = []
+        pids: Dict[str, int] = {}
+        tids: Dict[Tuple[int, str], int] = {}
+        for span in sorted(self.spans, key=lambda span: span.start_ns):
+            if span.trace_id not in pids:
+                pids[span.trace_id] = pid = len(pids) + 1
+                events.append({"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": f"diagnosis {pid} ({span.trace_id[:8]})"}})
+            pid = pids[span.trace_id]
+            lane = str(span.attributes.get("agent") or ("workflow" if span.kind in ("diagnosis", "phase", "round") else span.kind))
+            if (pid, lane) not in tids:
+                tids[(pid, lane)] = tid = len(tids) + 1
+                events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": lane}})
+            event = {
+                "name": span.name,
+                "cat": span.kind,
+                "pid": pid,
+                "tid": tids[(pid, lane)],
+                "ts": span.start_ns / 1000,
+                "args": {"outcome": span.outcome, **span.attributes},
+            }
+            if span.kind == "event":
+                event.update(ph="i", s="t")
+            else:
+                event.update(ph="X", dur=(span.end_ns - span.start_ns) / 1000)
+            events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export(self, path: str, format: Optional[str] = None) -> str:
+        """
+        Write the finished spans to a file
+
+        Args:
+            path: Output file
+            format: "chrome" or "otlp", by default "otlp" for *.otlp.json files and "chrome" otherwise
+
+        Returns:
+            str: The path written
+        """
+        if format is None:
+            format = "otlp" if path.endswith(".otlp.json") else "chrome"
+        if format not in TRACE_FORMATS:
+            raise ValueError(f"Unknown trace format: {format}, expected one of {TRACE_FORMATS}")
+        data = self.to_otlp() if format == "otlp" else self.to_chrome_trace()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, default=str)
+        print(f"[Trace] Wrote {len(self.spans)} spans to {path} ({format})")
+        return path
+
+
+def _otlp_attributes(attributes: Dict[str, object]) -> List[Dict[str, object]]:
+    result = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            typed = {"boolValue": value}
+        elif isinstance(value, int):
+            typed = {"intValue": str(value)}
+        elif isinstance(value, float):
+            typed = {"doubleValue": value}
+        else:
+            typed = {"stringValue": str(value)}
+        result.append({"key": key, "value": typed})
+    return result
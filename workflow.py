@@ -1,46 +1,165 @@
-from typing import Dict, List, Optional
+from typing import Callable, Dict, List, Optional
+from contextlib import aclosing
+import asyncio
 from agents import *
-from autogen_agentchat.messages import TextMessage
+from autogen_agentchat.agents import AssistantAgent
+from autogen_agentchat.base import Response
+from autogen_agentchat.messages import TextMessage, ModelClientStreamingChunkEvent
+from autogen_core.models import AssistantMessage, RequestUsage, SystemMessage
 from autogen_core import CancellationToken, SingleThreadedAgentRuntime
 import pprint
 from autogen_core import AgentId
-from docker_code_executor import DockerCommandLineCodeExecutor
+from autogen_core.code_executor import CodeExecutor
+from local_code_executor import ForkServerCodeExecutor, SandboxedLocalCodeExecutor
 
 from coder import *
 import os
 import json
 from datetime import datetime, timedelta
 from code_utils import save_code_blocks, load_code_blocks, save_code_as_functions
+from query_parser import PROMPT_TYPES, QueryWindow, parse_query
+from budget import BudgetScheduler
+from tracing import Tracer
+from memory import MemoryScope, record_diagnosis
+from investigation_cache import InvestigationCache, InvestigationEntry, format_targets, snapshot_notebook
+import telemetry
+from telemetry import catalog as telemetry_catalog
 
 from coder import MetricCoder, LogCoder, TraceCoder, Coder
 
-from prompt import get_prompt_module
+from prompt import DEFAULT_PROMPT_TYPE, get_prompt_module, resolve_prompt_type
 from prompt.WorkflowPrompt import *
 
-prompt_module = get_prompt_module()
 
-background = getattr(prompt_module, "background", "")
-data_description = getattr(prompt_module, "data_description", {})
-diagnosis_plan = getattr(prompt_module, "diagnosis_plan", "")
 
 
 
 
+import re
 
 
-import re
+def parse_investigator_decision(text: str):
+    """
+    Parse the investigator's decision from a (possibly still streaming) reply
+
+    Args:
+        text: Reply text received so far
+
+    Returns:
+        "INVESTIGATION_COMPLETE", a dict with "explorer" and "task", or None if no decision is parseable yet
+    """
+    if "INVESTIGATION_COMPLETE" in text:
+        return "INVESTIGATION_COMPLETE"
+
+    # Scan every balanced {...} object, the decision may be wrapped in a markdown block
+    start = text.find("{")
+    while start != -1:
+        depth = 0
+        in_string = False
+        escaped = False
+        for i in range(start, len(text)):
+            char = text[i]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == "{":
+                depth += 1
+            elif char == "}":
+                depth -= 1
+                if depth == 0:
+                    try:
+                        candidate = json.loads(text[start:i + 1])
+                    except json.JSONDecodeError:
+                        break
+                    if isinstance(candidate, dict) and "explorer" in candidate and "task" in candidate:
+                        return candidate
+                    break
+        start = text.find("{", start + 1)
+    return None
+
+
+# Code executor backends, see DiagnosisWorkflow.create
+CODE_EXECUTORS = ["docker", "local", "forkserver"]
+DEFAULT_CODE_EXECUTOR = "docker"
+# Work directory of every code executor, holds the dataset and the telemetry package
+CODE_WORK_DIR = "coding"
+
+# One code executor per backend serves every workflow of the process, it is stopped
+# when the last workflow using it is cleaned up
+_code_executors = {}  # backend -> [executor, start task, users]
+
+
+def new_code_executor(backend: str) -> CodeExecutor:
+    """Create a code executor of the given backend, working in CODE_WORK_DIR"""
+    if backend == "docker":
+        # Docker is only needed, and imported, when it is used
+        from docker_code_executor import DockerCommandLineCodeExecutor
+        return DockerCommandLineCodeExecutor(work_dir=CODE_WORK_DIR,auto_remove=False,container_name='codegenrca')
+    if backend == "local":
+        return SandboxedLocalCodeExecutor(work_dir=CODE_WORK_DIR, read_only_paths=["dataset"])
+    if backend == "forkserver":
+        return ForkServerCodeExecutor(work_dir=CODE_WORK_DIR, read_only_paths=["dataset"])
+    raise ValueError(f"Unknown code executor {backend!r}, expected one of {CODE_EXECUTORS}")
+
+
+async def acquire_code_executor(backend: str = DEFAULT_CODE_EXECUTOR) -> CodeExecutor:
+    """Return the shared code executor of a backend, starting it on first use"""
+    if backend not in _code_executors:
+        executor = new_code_executor(backend)
+        # Make the telemetry loader available to tools
+        telemetry.install(CODE_WORK_DIR)
+        _code_executors[backend] = [executor, asyncio.ensure_future(executor.start()), 0]
+    shared = _code_executors[backend]
+    shared[2] += 1
+    try:
+        await asyncio.shield(shared[1])
+    except BaseException:
+        await release_code_executor(backend)
+        raise
+    return shared[0]
+
+
+async def release_code_executor(backend: str = DEFAULT_CODE_EXECUTOR) -> None:
+    """Release the shared code executor of a backend, stopping it when no workflow uses it anymore"""
+    shared = _code_executors.get(backend)
+    if shared is None:
+        return
+    shared[2] -= 1
+    if shared[2] > 0:
+        return
+    executor, ready, _ = _code_executors.pop(backend)
+    if ready.done() and not ready.cancelled() and ready.exception() is None:
+        await executor.stop()
+
+
+# Columnar builds of telemetry days started by this process, by day directory
+_columnar_builds: Dict[str, asyncio.Future] = {}
+
+
+def start_columnar_build(day_dir: str) -> asyncio.Future:
+    """Build the derived data of a telemetry day (see telemetry.build_day) in a thread, once per process"""
+    build = _columnar_builds.get(day_dir)
+    if build is None or (build.done() and (build.cancelled() or build.exception() is not None)):
+        build = _columnar_builds[day_dir] = asyncio.ensure_future(asyncio.to_thread(telemetry.build_day, day_dir))
+    return build
 
 
 class DiagnosisWorkflow:
     def __init__(self):
-        self.agents = {
-            "planner": planner_agent,
-            "investigator": investigator_agent,
-            "metric_explorer": metric_explorer,
-            "log_explorer": log_explorer,
-            "trace_explorer": trace_explorer,
-            "reasoner": reasoner_agent,
-        }
+        # Conversational agents, created once the prompt set of the diagnosis is known
+        self.agents = {}
+        
+        # Prompt set of the diagnosed dataset, see load_prompt_set
+        self.prompt_type = None
+        self.prompt_module = None
+        self.background = ""
+        self.data_description = {}
         
 
         self.model_client = model_client
@@ -52,12 +171,43 @@ class DiagnosisWorkflow:
         self.trace_coder = None
         
         self.executor_agent = None
-        self.docker_executor = None
+        # Shared code executor of the chosen backend, see acquire_code_executor
+        self.code_executor = None
+        self.code_executor_backend = DEFAULT_CODE_EXECUTOR
 
         
         self.explorer_notebook = NotebookSystem()
         self.coder_notebook = NotebookSystem()
         
+        # Diagnosis window parsed from the user query
+        self.query_window: Optional[QueryWindow] = None
+        
+        # Cancelled when the diagnosis misses its deadline or is cancelled, reaches every
+        # model call, the coders and the code executor of this diagnosis
+        self.cancellation_token = CancellationToken()
+        self.deadline: Optional[float] = None
+        self.speculation_task: Optional[asyncio.Task] = None
+        self.columnar_task: Optional[asyncio.Task] = None
+        
+        # Time and token budget, decides on further rounds, refine attempts and retries
+        self.budget = BudgetScheduler()
+        self.token_budget: Optional[int] = None
+        # Results of the running investigation, kept when it is cut short by the budget
+        self.investigation_results = []
+        # Investigations of earlier queries, reused for later queries about the same failure window
+        self.investigation_cache: Optional[InvestigationCache] = None
+        # Dataset and window the agents' long-term memory is restricted to, set per diagnosis
+        self.memory_scope = MemoryScope()
+        # Add the (unverified) answers to long-term memory for later diagnoses
+        self.record_memory = False
+        
+        # Speculative window scans started while the planner is thinking
+        self.speculative = False
+        self.speculative_results = {}
+        self._speculative_needed = set()
+        # The runtime and executor serve one tool generation at a time
+        self._tool_lock = asyncio.Lock()
+        
         self.timing = {
             "plan": None,
             "investigate": None,
@@ -66,144 +216,143 @@ class DiagnosisWorkflow:
             "total": None
         }
         
-        self.llm_call_count = {
-            "planner": 0,
-            "investigator": 0,
-            "metric_explorer": 0,
-            "log_explorer": 0,
-            "trace_explorer": 0,
-            "reasoner": 0,
-            "metric_coder": 0,
-            "log_coder": 0,
-            "trace_coder": 0,
-            "total": 0
-        }
-        
-        self.token_usage = {
-            "planner": {"prompt": 0, "completion": 0, "total": 0},
-            "investigator": {"prompt": 0, "completion": 0, "total": 0},
-            "metric_explorer": {"prompt": 0, "completion": 0, "total": 0},
-            "log_explorer": {"prompt": 0, "completion": 0, "total": 0},
-            "trace_explorer": {"prompt": 0, "completion": 0, "total": 0},
-            "reasoner": {"prompt": 0, "completion": 0, "total": 0},
-            "metric_coder": {"prompt": 0, "completion": 0, "total": 0},
-            "log_coder": {"prompt": 0, "completion": 0, "total": 0},
-            "trace_coder": {"prompt": 0, "completion": 0, "total": 0},
-            "total": {"prompt": 0, "completion": 0, "total": 0}
-        }
+        # Spans of every agent call, tool run and refine attempt, and the LLM call and token counters
+        self.tracer = Tracer(agents=[
+            "planner", "investigator", "metric_explorer", "log_explorer", "trace_explorer",
+            "reasoner", "metric_coder", "log_coder", "trace_coder",
+        ])
+        self.llm_call_count = self.tracer.llm_call_count
+        self.token_usage = self.tracer.token_usage
+        # Root span of the running diagnosis
+        self.trace_span = None
 
     @classmethod
-    async def create(cls):
-        """Asynchronous factory method to create and initialize DiagnosisWorkflow instance"""
+    async def create(cls, speculative: bool = False, prompt_type: Optional[str] = None, token_budget: Optional[int] = None, executor: str = DEFAULT_CODE_EXECUTOR, investigation_cache: Optional[InvestigationCache] = None, record_memory: bool = False):
+        """Asynchronous factory method to create and initialize DiagnosisWorkflow instance
+        
+        Args:
+            speculative: Start the standard per-modality window scans while the planner is thinking
+            prompt_type: Dataset of the diagnoses (e.g. "bank", "market", "telecom"). If None, it is
+                detected from the query of the first diagnosis
+            token_budget: Tokens a diagnosis may use before it is pushed to the reasoning stage,
+                None for no limit
+            executor: Code executor backend, "docker" runs tools in a container, "local" runs
+                them in sandboxed local subprocesses without Docker overhead and "forkserver" forks
+                them from a process with pandas already imported (both for trusted runs only)
+            investigation_cache: Investigations shared by the queries about the same failure window,
+                a cached window skips planning and investigation. None to investigate every query
+            record_memory: Add the answer of every diagnosis to the long-term memory of later ones.
+                Answers are not verified, so leave this off for benchmark runs
+        """
         workflow = cls()
+        workflow.speculative = speculative
+        workflow.token_budget = token_budget
+        workflow.investigation_cache = investigation_cache
+        workflow.record_memory = record_memory
         
         # Initialize memory
         from agents import initialize_memory
         await initialize_memory()
         
         # 1. Create and start executor first
-        workflow.docker_executor = DockerCommandLineCodeExecutor(work_dir="coding",auto_remove=False,container_name='codegenrca')
-        await workflow.docker_executor.start()
-        workflow.executor_agent = await Executor.register(
-            workflow.runtime, 
+        workflow.code_executor_backend = executor
+        workflow.code_executor = await acquire_code_executor(executor)
+        
+        # 2. Create agents, unless the dataset is only known from the query
+        if prompt_type is not None:
+            try:
+                await workflow.load_prompt_set(prompt_type)
+            except BaseException:
+                workflow.code_executor = None
+                await release_code_executor(executor)
+                raise
+        
+        # 3. Start runtime last
+        workflow.runtime.start()
+        
+        return workflow
+
+    async def load_prompt_set(self, prompt_type: str) -> None:
+        """
+        Bind the workflow to the prompt set of a dataset and create its agents
+
+        The prompt module is loaded on first use and cached, so workflows of different
+        datasets can run side by side in one process.
+
+        Args:
+            prompt_type: Dataset or prompt type, e.g. "bank", "Market", "cloudbed-1", "telecom"
+        """
+        prompt_type = resolve_prompt_type(prompt_type)
+        if self.prompt_module is not None:
+            if prompt_type != self.prompt_type:
+                print(f"[Prompt] Workflow already uses the {self.prompt_type} prompts, ignoring {prompt_type}")
+            return
+        
+        self.prompt_type = prompt_type
+        self.prompt_module = get_prompt_module(prompt_type)
+        self.background = getattr(self.prompt_module, "background", "")
+        self.data_description = getattr(self.prompt_module, "data_description", {})
+        print(f"[Prompt] Using the {prompt_type} prompt set")
+        
+        self.agents.update(create_agents(self.prompt_module, self.memory_scope))
+        
+        prompt_module = self.prompt_module
+        code_executor = self.code_executor
+        budget = self.budget
+        tracer = self.tracer
+        self.executor_agent = await Executor.register(
+            self.runtime, 
             "executor", 
-            lambda: Executor(workflow.docker_executor)
+            lambda: Executor(code_executor, prompt_module, budget, tracer)
         )
-        
-        # 2. Create coders
-        workflow.metric_coder = await MetricCoder.register(
-            workflow.runtime,
+        self.metric_coder = await MetricCoder.register(
+            self.runtime,
             "metric_coder",
             lambda: MetricCoder(
-                reason_model_client,
-                name="metric_coder"
+                reason_llm_gateway.for_agent("metric_coder"),
+                name="metric_coder",
+                prompt_module=prompt_module,
+                tracer=tracer
             ),
         )
-        workflow.log_coder = await LogCoder.register(
-            workflow.runtime,
+        self.log_coder = await LogCoder.register(
+            self.runtime,
             "log_coder",
             lambda: LogCoder(
-                reason_model_client,
-                name="log_coder"
+                reason_llm_gateway.for_agent("log_coder"),
+                name="log_coder",
+                prompt_module=prompt_module,
+                tracer=tracer
             ),
         )
-        workflow.trace_coder = await TraceCoder.register(
-            workflow.runtime,
+        self.trace_coder = await TraceCoder.register(
+            self.runtime,
             "trace_coder",
             lambda: TraceCoder(
-                reason_model_client,
-                name="trace_coder"
+                reason_llm_gateway.for_agent("trace_coder"),
+                name="trace_coder",
+                prompt_module=prompt_module,
+                tracer=tracer
             ),
         )
         
-        # 3. Update agents dictionary
-        workflow.agents.update({
-            "executor": workflow.executor_agent,
-            "metric_coder": workflow.metric_coder,
-            "log_coder": workflow.log_coder,
-            "trace_coder": workflow.trace_coder
+        self.agents.update({
+            "executor": self.executor_agent,
+            "metric_coder": self.metric_coder,
+            "log_coder": self.log_coder,
+            "trace_coder": self.trace_coder
         })
-        
-        # 4. Start runtime last
-        workflow.runtime.start()
-        
-        # 5. Check and update LLM call count after completion
-        if hasattr(MetricCoder, 'get_llm_call_count'):
-            workflow.llm_call_count["metric_coder"] = MetricCoder.get_llm_call_count()
-            workflow.llm_call_count["total"] += MetricCoder.get_llm_call_count()
-        
-        if hasattr(LogCoder, 'get_llm_call_count'):  
-            workflow.llm_call_count["log_coder"] = LogCoder.get_llm_call_count()
-            workflow.llm_call_count["total"] += LogCoder.get_llm_call_count()
-            
-        if hasattr(TraceCoder, 'get_llm_call_count'):
-            workflow.llm_call_count["trace_coder"] = TraceCoder.get_llm_call_count()
-            workflow.llm_call_count["total"] += TraceCoder.get_llm_call_count()
-        
-        return workflow
+
+    async def get_executor(self) -> Executor:
+        """Return this workflow's Executor agent instance"""
+        return await self.runtime.try_get_underlying_agent_instance(AgentId("executor", "default"), Executor)
 
     async def cleanup(self):
         """Clean up resources"""
-        if self.docker_executor:
-            await self.docker_executor.stop()
-            
-        # Update LLM call count statistics
-        self.llm_call_count["metric_coder"] = MetricCoder.get_llm_call_count()
-        self.llm_call_count["log_coder"] = LogCoder.get_llm_call_count()
-        self.llm_call_count["trace_coder"] = TraceCoder.get_llm_call_count()
-        self.llm_call_count["total"] = self.llm_call_count["metric_coder"] + self.llm_call_count["log_coder"] + self.llm_call_count["trace_coder"]
-        
-        # Update token usage statistics
-        if hasattr(MetricCoder, 'get_token_usage'):
-            metric_usage = MetricCoder.get_token_usage()
-            self.token_usage["metric_coder"]["prompt"] += metric_usage["prompt"]
-            self.token_usage["metric_coder"]["completion"] += metric_usage["completion"]
-            self.token_usage["metric_coder"]["total"] += metric_usage["total"]
-            
-            self.token_usage["total"]["prompt"] += metric_usage["prompt"]
-            self.token_usage["total"]["completion"] += metric_usage["completion"]
-            self.token_usage["total"]["total"] += metric_usage["total"]
+        if self.code_executor:
+            self.code_executor = None
+            await release_code_executor(self.code_executor_backend)
             
-        if hasattr(LogCoder, 'get_token_usage'):
-            log_usage = LogCoder.get_token_usage()
-            self.token_usage["log_coder"]["prompt"] += log_usage["prompt"]
-            self.token_usage["log_coder"]["completion"] += log_usage["completion"]
-            self.token_usage["log_coder"]["total"] += log_usage["total"]
-            
-            self.token_usage["total"]["prompt"] += log_usage["prompt"]
-            self.token_usage["total"]["completion"] += log_usage["completion"]
-            self.token_usage["total"]["total"] += log_usage["total"]
-            
-        if hasattr(TraceCoder, 'get_token_usage'):
-            trace_usage = TraceCoder.get_token_usage()
-            self.token_usage["trace_coder"]["prompt"] += trace_usage["prompt"]
-            self.token_usage["trace_coder"]["completion"] += trace_usage["completion"]
-            self.token_usage["trace_coder"]["total"] += trace_usage["total"]
-            
-            self.token_usage["total"]["prompt"] += trace_usage["prompt"]
-            self.token_usage["total"]["completion"] += trace_usage["completion"]
-            self.token_usage["total"]["total"] += trace_usage["total"]
-        
         # Output LLM call count statistics
         print(f"\n{'='*50}")
         print(f"[LLM Call Statistics Summary]")
@@ -219,6 +368,20 @@ class DiagnosisWorkflow:
                 print(f"  - {agent}: input={usage['prompt']}, output={usage['completion']}, total={usage['total']}")
         print(f"  - Total: input={self.token_usage['total']['prompt']}, output={self.token_usage['total']['completion']}, total={self.token_usage['total']['total']}")
 
+        # Output LLM gateway statistics
+        print(f"\n[LLM Gateway Statistics Summary]")
+        print(f"  - model_client: {llm_gateway.stats}")
+        print(f"  - reason_model_client: {reason_llm_gateway.stats}")
+        
+        # Output budget statistics
+        print(f"\n[Budget Statistics Summary]")
+        for step, stats in self.budget.summary().items():
+            print(f"  - {step}: count={stats['count']}, mean time={stats['mean_seconds']}s, mean tokens={stats['mean_tokens']}")
+        
+        # Output trace statistics
+        print(f"\n[Trace Statistics Summary]")
+        for kind, stats in self.tracer.summary().items():
+            print(f"  - {kind}: count={stats['count']}, time={stats['seconds']}s, tokens={stats['tokens']}")
         
         # Output time usage statistics
         print(f"[Time Statistics] Diagnosis process end, total time: {self.timing['total']}")
@@ -239,6 +402,16 @@ class DiagnosisWorkflow:
         await self.cleanup()
 
     async def generate_tool(self, task_description: str, explorer_name: str) -> str:
+        coder_name = explorer_name[:-8] + "coder"
+        async with self._tool_lock:
+            # Coder and executor handlers run in runtime tasks, their spans are adopted by this one
+            with self.tracer.span(f"{coder_name} tool", "tool", agent=coder_name) as span, self.tracer.adopt(span):
+                result = await self._generate_tool(task_description, explorer_name)
+                if result is None:
+                    span.outcome = "failed"
+                return result
+
+    async def _generate_tool(self, task_description: str, explorer_name: str) -> str:
         start_time = datetime.now()
         try:
             self.runtime.start()
@@ -251,7 +424,10 @@ class DiagnosisWorkflow:
         # Add coder's identifier when sending messages
         message_content = f"""
         [From {coder_name}]
-        {data_description[f"{coder_name}"]}
+        {self.data_description[f"{coder_name}"]}
+        {self.format_tool_window()}
+        {self.format_catalog(explorer_name[:-9])}
+        {tunable_parameters_guide}
         <task>{task_description}</task>
         """
         
@@ -263,13 +439,15 @@ class DiagnosisWorkflow:
         try:
             await self.runtime.send_message(
                 message=Message(enriched_message),
-                recipient=AgentId(f"{coder_name}", "default")
+                recipient=AgentId(f"{coder_name}", "default"),
+                cancellation_token=self.cancellation_token
             )
             
             await self.runtime.stop_when_idle()
             
             # Get execution result
-            code_blocks = Executor.get_execution_code()
+            executor = await self.get_executor()
+            code_blocks = executor.get_execution_code()
             if not code_blocks:
                 print(f"Warning: No code blocks generated for {coder_name}")
                 return None
@@ -288,10 +466,12 @@ class DiagnosisWorkflow:
                     print(f"Skipping non-Python code block, language: {code_block.language}")
             
             if blocks_to_save:
-                save_code_blocks(blocks_to_save)
-                save_code_as_functions(blocks_to_save, task_description)
+                with self.tracer.span("save tool", "tool_save", agent=coder_name, blocks=len(blocks_to_save),
+                                      code_bytes=sum(len(block.code.encode("utf-8")) for block in blocks_to_save)):
+                    save_code_blocks(blocks_to_save)
+                    save_code_as_functions(blocks_to_save, task_description)
             
-            execution_result = Executor.get_execution_result()
+            execution_result = executor.get_execution_result()
             print("======generate_tool execution_result=======")
             pprint.pprint(execution_result)
             print("======generate_tool execution_result=======")
@@ -315,13 +495,145 @@ class DiagnosisWorkflow:
             return None
 
 
+    def format_diagnosis_window(self) -> str:
+        """Format the parsed diagnosis window for the planner, investigator and reasoner"""
+        window = self.query_window
+        if window is None:
+            return ""
+        return diagnosis_window_prompt.format(
+            dataset=window.dataset + (f" ({window.system})" if window.system else ""),
+            window=window.describe(),
+            start=window.start,
+            end=window.end,
+            extended_window=f"{QueryWindow.format_time(window.extended_start)} to {QueryWindow.format_time(window.extended_end)} (UTC+8)",
+            extended_start=window.extended_start,
+            extended_end=window.extended_end,
+            num_failures=window.num_failures if window.num_failures is not None else "unknown",
+            telemetry_dir=window.telemetry_dir,
+        )
+
+    def format_tool_window(self) -> str:
+        """Format the parsed diagnosis window as constants for the coders"""
+        if self.query_window is None:
+            return ""
+        return tool_window_prompt.format(
+            window=self.query_window.describe(),
+            parameters=self.query_window.tool_parameters_code(),
+        )
+
+    def format_catalog(self, modality: str) -> str:
+        """
+        Format the catalog of the queried day for a coder, only the files of its modality
+
+        Empty until the day's derived data has been built, the coder then lists what it needs itself.
+        """
+        if self.query_window is None:
+            return ""
+        catalog = telemetry_catalog.read_catalog(os.path.join(CODE_WORK_DIR, self.query_window.telemetry_dir))
+        if catalog is None:
+            return ""
+        return telemetry_catalog_prompt.format(catalog=telemetry_catalog.format_catalog(catalog, modality=modality))
+
+    async def build_columnar_day(self) -> None:
+        """
+        Build the derived data of the queried day (see telemetry.build_day): the shared
+        memory-mapped columns used by telemetry.loader, the catalog, the baselines, the metric
+        store, the rollups, the trace rollups, the log templates and the log index
+
+        Concurrent diagnoses of the same day share one build and, afterwards, one copy of the
+        day's data in memory. Tools read the CSV files until the build is done.
+        """
+        if self.query_window is None:
+            return
+        day_dir = os.path.join(CODE_WORK_DIR, self.query_window.telemetry_dir)
+        if not os.path.isdir(day_dir):
+            return
+        started = datetime.now()
+        try:
+            built = await asyncio.shield(start_columnar_build(day_dir))
+            print(f"[Columnar] {len(built)} files of {self.query_window.telemetry_dir} ready in {(datetime.now() - started).total_seconds():.1f}s")
+        except Exception as e:
+            print(f"[Columnar] Build of {self.query_window.telemetry_dir} failed, tools read the CSV files: {e}")
+
+    def start_speculative_scans(self) -> Optional[asyncio.Task]:
+        """
+        Start the standard per-modality window scans of the parsed query window in the background
+
+        Returns:
+            asyncio.Task running the scans, or None if the query window is not recognisable
+        """
+        if self.query_window is None:
+            print("[Speculation] Query window not recognised, skipping speculative scans")
+            return None
+        window = self.query_window.describe()
+        
+        loop = asyncio.get_running_loop()
+        explorers = [coder[:-5] + "explorer" for coder in self.data_description if coder.endswith("_coder")]
+        self._speculative_needed = set(explorers)
+        self.speculative_results = {explorer: loop.create_future() for explorer in explorers}
+        
+        async def run_scans():
+            for explorer_name in explorers:
+                future = self.speculative_results[explorer_name]
+                if explorer_name not in self._speculative_needed:
+                    print(f"[Speculation] {explorer_name} scan not needed by the plan, skipped")
+                    future.set_result(None)
+                    continue
+                scan_task = speculative_scan_tasks.get(explorer_name, "").format(window=window)
+                result = None
+                if scan_task:
+                    print(f"[Speculation] Starting {explorer_name} scan: {scan_task}")
+                    try:
+                        result = await self.generate_tool(scan_task, explorer_name)
+                    except Exception as e:
+                        print(f"[Speculation] {explorer_name} scan failed: {e}")
+                if explorer_name not in self._speculative_needed:
+                    # The plan decided against this modality while the scan was running
+                    self.coder_notebook.discard(explorer_name[:-8] + "coder")
+                    result = None
+                future.set_result((scan_task, result) if result else None)
+        
+        return asyncio.create_task(run_scans())
+
+    def prune_speculative_scans(self, diagnosis_plan: str) -> None:
+        """Discard speculative scans of modalities the diagnosis plan does not use"""
+        modality_patterns = {
+            "metric_explorer": r"\bmetrics?\b",
+            "log_explorer": r"\blogs?\b",
+            "trace_explorer": r"\btraces?\b",
+        }
+        planned = {
+            explorer for explorer, pattern in modality_patterns.items()
+            if re.search(pattern, diagnosis_plan, re.IGNORECASE)
+        }
+        # A plan naming no modality at all gives no reason to discard anything
+        if not planned:
+            return
+        for explorer_name in list(self._speculative_needed):
+            if explorer_name not in planned:
+                print(f"[Speculation] Plan does not use {explorer_name}, discarding its scan")
+                self._speculative_needed.discard(explorer_name)
+                future = self.speculative_results.get(explorer_name)
+                if future is not None and future.done() and future.result() is not None:
+                    self.coder_notebook.discard(explorer_name[:-8] + "coder")
+                    self.speculative_results[explorer_name] = None
+
+    async def take_speculative_result(self, explorer_name: str):
+        """Wait for and consume the speculative scan of an explorer, returns (scan_task, result) or None"""
+        future = self.speculative_results.pop(explorer_name, None)
+        if future is None:
+            return None
+        return await future
+
     async def run_investigation(self, investigator_msg: str) -> List[Dict]:
         start_time = datetime.now()
         print(f"[Time Statistics] Investigation phase start: {start_time}")
         
-        investigation_results = []
+        investigation_results = self.investigation_results = []
         max_rounds = 5  # Set maximum investigation rounds
         current_round = 0
+        round_mark = None
+        round_span = None
         
         # List all available explorers
         available_explorers = {
@@ -331,10 +643,18 @@ class DiagnosisWorkflow:
         }
         
         while True:
+            if round_mark is not None:
+                self.budget.end(round_mark)
+                self.tracer.finish(round_span)
             current_round += 1
             if current_round > max_rounds:
                 print(f"[investigator] Reached maximum investigation rounds {max_rounds}, forcing investigation to end")
                 break
+            if current_round > 1 and not self.budget.allow("round"):
+                print(f"[investigator] Budget exhausted after {current_round - 1} rounds, forcing investigation to end")
+                break
+            round_mark = self.budget.begin("round")
+            round_span = self.tracer.start_span(f"round {current_round}", "round", activate=True)
             
             # 1. Investigator decides next investigation direction
             investigator_prompt = investigator_prompt_template.format(
@@ -342,29 +662,12 @@ class DiagnosisWorkflow:
                 available_explorers=available_explorers
             )
             
-            response = await self.agents["investigator"].on_messages(
+            # Act as soon as the decision is parseable instead of waiting for the full reply
+            response = await self.stream_agent_response(
+                "investigator",
                 [TextMessage(content=investigator_prompt, source="user")],
-                cancellation_token=CancellationToken(),
+                stop_when=lambda text: parse_investigator_decision(text) is not None,
             )
-            # Increase LLM call count and token statistics - investigator
-            self.llm_call_count["investigator"] += 1
-            self.llm_call_count["total"] += 1
-            
-            # Check if token statistics exist
-            if hasattr(response, 'chat_message') and response.chat_message:
-                if hasattr(response.chat_message, 'models_usage'):
-                    prompt_tokens = getattr(response.chat_message.models_usage, 'prompt_tokens', 0)
-                    completion_tokens = getattr(response.chat_message.models_usage, 'completion_tokens', 0)
-                    
-                    self.token_usage["investigator"]["prompt"] += prompt_tokens
-                    self.token_usage["investigator"]["completion"] += completion_tokens
-                    self.token_usage["investigator"]["total"] += prompt_tokens + completion_tokens
-                    
-                    self.token_usage["total"]["prompt"] += prompt_tokens
-                    self.token_usage["total"]["completion"] += completion_tokens
-                    self.token_usage["total"]["total"] += prompt_tokens + completion_tokens
-                    
-                    print(f"[Token Statistics] investigator: prompt={prompt_tokens}, completion={completion_tokens}, current total={self.token_usage['investigator']['total']}")
             
             await self.print_llm_response("investigator", response)
             decision = response.chat_message.content
@@ -372,27 +675,28 @@ class DiagnosisWorkflow:
                 
             # 2. Parse investigator's decision
             try:
-                if "INVESTIGATION_COMPLETE" in decision:
+                decision_dict = parse_investigator_decision(decision)
+                if decision_dict == "INVESTIGATION_COMPLETE":
                     break
                     
-                # Try to remove possible leading/trailing whitespace characters
-                decision = decision.strip()
-                
-                # Handle markdown code block format (```json ... ```)
-                if decision.startswith("```json") and decision.endswith("```"):
-                    # Extract JSON content from markdown code block
-                    decision = decision[7:-3].strip()  # Remove ```json and ```
-                elif decision.startswith("```") and decision.endswith("```"):
-                    # Handle generic code block format (``` ... ```)
-                    decision = decision[3:-3].strip()  # Remove ``` and ```
-                
-                # Try JSON parsing first, then fall back to eval
-                try:
-                    import json
-                    decision_dict = json.loads(decision)
-                except json.JSONDecodeError:
-                    # Fall back to eval for non-JSON format
-                    decision_dict = eval(decision)
+                if decision_dict is None:
+                    # Try to remove possible leading/trailing whitespace characters
+                    decision = decision.strip()
+                    
+                    # Handle markdown code block format (```json ... ```)
+                    if decision.startswith("```json") and decision.endswith("```"):
+                        # Extract JSON content from markdown code block
+                        decision = decision[7:-3].strip()  # Remove ```json and ```
+                    elif decision.startswith("```") and decision.endswith("```"):
+                        # Handle generic code block format (``` ... ```)
+                        decision = decision[3:-3].strip()  # Remove ``` and ```
+                    
+                    # Try JSON parsing first, then fall back to eval
+                    try:
+                        decision_dict = json.loads(decision)
+                    except json.JSONDecodeError:
+                        # Fall back to eval for non-JSON format
+                        decision_dict = eval(decision)
                 
                 explorer_name = decision_dict["explorer"]
                 task = decision_dict["task"]
@@ -413,173 +717,146 @@ class DiagnosisWorkflow:
             # 3. Call selected explorer to perform investigation
             explorer_msg = explorer_task_prompt.format(task=task)
             
+            # Hand over the speculative window scan of this modality, if one was run
+            speculative_result = await self.take_speculative_result(explorer_name)
+            if speculative_result is not None:
+                scan_task, scan_result = speculative_result
+                explorer_msg += speculative_result_prompt.format(scan_task=scan_task, scan_result=scan_result)
+            
             # Add other explorer's execution result to message sent to explorer
             enriched_explorer_msg = self.explorer_notebook.enrich_message(
                 explorer_msg, 
                 explorer_name
             )
             
-            response = await self.agents[explorer_name].on_messages(
-                [TextMessage(content=enriched_explorer_msg, source="investigator")],
-                cancellation_token=CancellationToken(),
-            )
-            # Increase LLM call count and token statistics - explorer
-            self.llm_call_count[explorer_name] += 1
-            self.llm_call_count["total"] += 1
-            
-            # Check if token statistics exist
-            if hasattr(response, 'chat_message') and response.chat_message:
-                if hasattr(response.chat_message, 'models_usage'):
-                    prompt_tokens = getattr(response.chat_message.models_usage, 'prompt_tokens', 0)
-                    completion_tokens = getattr(response.chat_message.models_usage, 'completion_tokens', 0)
-                    
-                    self.token_usage[explorer_name]["prompt"] += prompt_tokens
-                    self.token_usage[explorer_name]["completion"] += completion_tokens
-                    self.token_usage[explorer_name]["total"] += prompt_tokens + completion_tokens
-                    
-                    self.token_usage["total"]["prompt"] += prompt_tokens
-                    self.token_usage["total"]["completion"] += completion_tokens
-                    self.token_usage["total"]["total"] += prompt_tokens + completion_tokens
-                    
-                    print(f"[Token Statistics] {explorer_name}: prompt={prompt_tokens}, completion={completion_tokens}, current total={self.token_usage[explorer_name]['total']}")
-            
-            await self.print_llm_response(explorer_name, response)
-            
-            # Check if need to generate new tool
+            # Start tool generation as soon as the explorer asks for it, while it is still replying
+            tool_generation = None
+
+            def start_tool_generation(text: str) -> None:
+                nonlocal tool_generation
+                if tool_generation is None and "NEED_TOOL_GENERATION" in text:
+                    print(f"[{explorer_name}] NEED_TOOL_GENERATION detected in stream, starting tool generation")
+                    tool_generation = asyncio.create_task(self.generate_tool(task, explorer_name))
+
             try:
-                # Check if response contains need_tool_generate
-                response_text = response.chat_message.content
-                need_tool = False
-                tool_description = None
-                retry_count = 0
-                max_retries = 3
-                while 'Error' in response_text and retry_count < max_retries:
-                    retry_count += 1
-                    print(f"[{explorer_name}] Call error occurred: {response_text}")
-                    response = await self.agents[explorer_name].on_messages(
-                        [TextMessage(content="Tool call failed, please regenerate tool based on error information"+"\n"+response_text, source="investigator")],
-                        cancellation_token=CancellationToken(),
-                    )
-                    # Increase LLM call count and token statistics - explorer (error retry)
-                    self.llm_call_count[explorer_name] += 1
-                    self.llm_call_count["total"] += 1
-                    
-                    # Check if token statistics exist
-                    if hasattr(response, 'chat_message') and response.chat_message:
-                        if hasattr(response.chat_message, 'models_usage'):
-                            prompt_tokens = getattr(response.chat_message.models_usage, 'prompt_tokens', 0)
-                            completion_tokens = getattr(response.chat_message.models_usage, 'completion_tokens', 0)
-                            
-                            self.token_usage[explorer_name]["prompt"] += prompt_tokens
-                            self.token_usage[explorer_name]["completion"] += completion_tokens
-                            self.token_usage[explorer_name]["total"] += prompt_tokens + completion_tokens
-                            
-                            self.token_usage["total"]["prompt"] += prompt_tokens
-                            self.token_usage["total"]["completion"] += completion_tokens
-                            self.token_usage["total"]["total"] += prompt_tokens + completion_tokens
-                            
-                            print(f"[Token Statistics] {explorer_name}(Retry): prompt={prompt_tokens}, completion={completion_tokens}, current total={self.token_usage[explorer_name]['total']}")
-                    
-                    await self.print_llm_response(explorer_name, response)
+                response = await self.stream_agent_response(
+                    explorer_name,
+                    [TextMessage(content=enriched_explorer_msg, source="investigator")],
+                    on_text=start_tool_generation,
+                )
+
+                await self.print_llm_response(explorer_name, response)
+
+                # Check if need to generate new tool
+                try:
+                    # Check if response contains need_tool_generate
                     response_text = response.chat_message.content
-                # Try to extract need_tool_generate and tool_description from response
-                if 'NEED_TOOL_GENERATION' in response_text:
-                
-                    need_tool = True
-                    tool_description = task
-                
-                if need_tool and tool_description:
-                    # Generate new tool
-                    generated_tool_execution_result = json.dumps(await self.generate_tool(tool_description, explorer_name))
-                    
-                    # Re-execute investigation task
-                    enriched_explorer_msg = tool_execution_result_prompt.format(
-                        task=task, 
-                        generated_tool_execution_result=generated_tool_execution_result
-                    )
-                    
-                    response = await self.agents[explorer_name].on_messages(
-                        [TextMessage(content=enriched_explorer_msg, source="investigator")],
-                        cancellation_token=CancellationToken(),
-                    )
-                    self.llm_call_count[explorer_name] += 1
-                    self.llm_call_count["total"] += 1
-                    
-                    # Check if token statistics exist
-                    if hasattr(response, 'chat_message') and response.chat_message:
-                        if hasattr(response.chat_message, 'models_usage'):
-                            prompt_tokens = getattr(response.chat_message.models_usage, 'prompt_tokens', 0)
-                            completion_tokens = getattr(response.chat_message.models_usage, 'completion_tokens', 0)
-                            
-                            self.token_usage[explorer_name]["prompt"] += prompt_tokens
-                            self.token_usage[explorer_name]["completion"] += completion_tokens
-                            self.token_usage[explorer_name]["total"] += prompt_tokens + completion_tokens
-                            
-                            self.token_usage["total"]["prompt"] += prompt_tokens
-                            self.token_usage["total"]["completion"] += completion_tokens
-                            self.token_usage["total"]["total"] += prompt_tokens + completion_tokens
-                            
-                            print(f"[Token Statistics] {explorer_name}(Tool generated): prompt={prompt_tokens}, completion={completion_tokens}, current total={self.token_usage[explorer_name]['total']}")
-                    
-                    await self.print_llm_response(explorer_name, response)
-                
-                result = response.chat_message.content
-                # Save result to explorer_notebook
-                self.explorer_notebook.save_task(explorer_name, task)
-                self.explorer_notebook.save_response(explorer_name, result)
-                
-                investigation_results.append({
-                    "explorer": explorer_name,
-                    "task": task,
-                    "result": result
-                })
-                
-            except Exception as e:
-                print(f"[{explorer_name}] Error occurred while processing response:")
-                print(f"Error type: {type(e).__name__}")
-                print(f"Error message: {str(e)}")
-                print(f"Original response content:")
-                print(response.chat_message.content)
-                
-                # If KeyError: '\ndata_source' error, try to parse response content
-                if isinstance(e, KeyError) and "data_source" in str(e):
-                    try:
-                        # Get original response content
-                        result = response.chat_message.content
-                        
-                        # If NEED_TOOL_GENERATION, use directly
-                        if "NEED_TOOL_GENERATION" in result:
-                            pass
-                        else:
-                            # Try to parse anomaly_event format response
-                            import re
-                            # Match anomaly_event = [...] format
-                            match = re.search(r'anomaly_event\s*=\s*\[(.*?)\]', result, re.DOTALL)
-                            if match:
-                                # Extract matched content
-                                content = match.group(1).strip()
-                                # Format as valid JSON
-                                content = content.replace("'", '"')
-                                # Add parsing success marker
-                                result = f"Successfully parsed response content: {content}"
-                            else:
-                                # If unable to parse, add error marker
-                                result = f"Unable to parse response content, original content: {result}"
-                    except Exception as parse_error:
-                        print(f"Error occurred while trying to parse response content: {str(parse_error)}")
-                        result = f"Parse error: {str(parse_error)}, original response content: {response.chat_message.content}"
-                else:
+                    need_tool = False
+                    tool_description = None
+                    retry_count = 0
+                    max_retries = 3
+                    while tool_generation is None and 'Error' in response_text and retry_count < max_retries and self.budget.allow("retry", explorer_name):
+                        retry_count += 1
+                        print(f"[{explorer_name}] Call error occurred: {response_text}")
+                        with self.budget.measure("retry"):
+                            response = await self.ask_agent(
+                                explorer_name,
+                                [TextMessage(content="Tool call failed, please regenerate tool based on error information"+"\n"+response_text, source="investigator")],
+                                label=f"{explorer_name}(Retry)",
+                            )
+
+                        await self.print_llm_response(explorer_name, response)
+                        response_text = response.chat_message.content
+                    # Try to extract need_tool_generate and tool_description from response
+                    if tool_generation is not None or 'NEED_TOOL_GENERATION' in response_text:
+
+                        need_tool = True
+                        tool_description = task
+
+                    if need_tool and tool_description:
+                        # Generate new tool, or collect the one started while the explorer was streaming
+                        if tool_generation is None:
+                            tool_generation = asyncio.create_task(self.generate_tool(tool_description, explorer_name))
+                        generated_tool_execution_result = json.dumps(await tool_generation)
+
+                        # Re-execute investigation task
+                        enriched_explorer_msg = tool_execution_result_prompt.format(
+                            task=task, 
+                            generated_tool_execution_result=generated_tool_execution_result
+                        )
+
+                        response = await self.ask_agent(
+                            explorer_name,
+                            [TextMessage(content=enriched_explorer_msg, source="investigator")],
+                            label=f"{explorer_name}(Tool generated)",
+                        )
+
+                        await self.print_llm_response(explorer_name, response)
+
                     result = response.chat_message.content
-                
-                # Save result to explorer_notebook
-                self.explorer_notebook.save_task(explorer_name, task)
-                self.explorer_notebook.save_response(explorer_name, result)
-                
-                investigation_results.append({
-                    "explorer": explorer_name,
-                    "task": task,
-                    "result": result
-                })
+                    # Save result to explorer_notebook
+                    self.explorer_notebook.save_task(explorer_name, task)
+                    self.explorer_notebook.save_response(explorer_name, result)
+
+                    investigation_results.append({
+                        "explorer": explorer_name,
+                        "task": task,
+                        "result": result
+                    })
+
+                except Exception as e:
+                    print(f"[{explorer_name}] Error occurred while processing response:")
+                    print(f"Error type: {type(e).__name__}")
+                    print(f"Error message: {str(e)}")
+                    print(f"Original response content:")
+                    print(response.chat_message.content)
+
+                    # If KeyError: '\ndata_source' error, try to parse response content
+                    if isinstance(e, KeyError) and "data_source" in str(e):
+                        try:
+                            # Get original response content
+                            result = response.chat_message.content
+
+                            # If NEED_TOOL_GENERATION, use directly
+                            if "NEED_TOOL_GENERATION" in result:
+                                pass
+                            else:
+                                # Try to parse anomaly_event format response
+                                import re
+                                # Match anomaly_event = [...] format
+                                match = re.search(r'anomaly_event\s*=\s*\[(.*?)\]', result, re.DOTALL)
+                                if match:
+                                    # Extract matched content
+                                    content = match.group(1).strip()
+                                    # Format as valid JSON
+                                    content = content.replace("'", '"')
+                                    # Add parsing success marker
+                                    result = f"Successfully parsed response content: {content}"
+                                else:
+                                    # If unable to parse, add error marker
+                                    result = f"Unable to parse response content, original content: {result}"
+                        except Exception as parse_error:
+                            print(f"Error occurred while trying to parse response content: {str(parse_error)}")
+                            result = f"Parse error: {str(parse_error)}, original response content: {response.chat_message.content}"
+                    else:
+                        result = response.chat_message.content
+
+                    # Save result to explorer_notebook
+                    self.explorer_notebook.save_task(explorer_name, task)
+                    self.explorer_notebook.save_response(explorer_name, result)
+
+                    investigation_results.append({
+                        "explorer": explorer_name,
+                        "task": task,
+                        "result": result
+                    })
+            finally:
+                # A tool generation started from the stream but never collected must not keep
+                # running in the background and holding the executor
+                if tool_generation is not None:
+                    tool_generation.cancel()
+                    await asyncio.gather(tool_generation, return_exceptions=True)
+
             
             
         
@@ -587,6 +864,9 @@ class DiagnosisWorkflow:
                 investigation_results=investigation_results
             )
         
+        if round_span is not None:
+            self.tracer.finish(round_span)
+        
         end_time = datetime.now()
         investigation_time = end_time - start_time
         self.timing["investigate"] = investigation_time
@@ -595,93 +875,153 @@ class DiagnosisWorkflow:
             
         return investigation_results
 
-    async def run_diagnosis(self, user_query: str, queried_issue: Dict, reference_books: List[str]):
+    async def run_diagnosis(
+        self,
+        user_query: str,
+        queried_issue: Dict,
+        reference_books: List[str],
+        speculative: Optional[bool] = None,
+        timeout: Optional[float] = None,
+        deadline: Optional[float] = None,
+        token_budget: Optional[int] = None,
+    ):
+        """
+        Diagnose a query within an optional deadline
+
+        When the deadline passes, every in-flight model call, coder and code execution of
+        this diagnosis is cancelled and TimeoutError is raised. Other diagnoses running in
+        the same process are not affected.
+
+        Args:
+            user_query: The user's RCA query
+            queried_issue: Failure information passed to the reasoner
+            reference_books: Reference material (unused)
+            speculative: Run speculative window scans, defaults to the workflow setting
+            timeout: Seconds the diagnosis may take, None for no limit
+            deadline: Absolute event loop time (loop.time()) by which the diagnosis must finish,
+                the earlier of timeout and deadline applies
+            token_budget: Tokens the diagnosis may use, defaults to the workflow setting
+
+        Returns:
+            dict: diagnosis_plan, diagnosis_events and root_cause
+        """
+        if self.cancellation_token.is_cancelled():
+            # A previous diagnosis of this workflow was cancelled
+            self.cancellation_token = CancellationToken()
+        loop = asyncio.get_running_loop()
+        if timeout is not None:
+            deadline = min(deadline, loop.time() + timeout) if deadline is not None else loop.time() + timeout
+        self.deadline = deadline
+        self.budget.start(
+            deadline,
+            token_budget if token_budget is not None else self.token_budget,
+            self.tokens_used,
+        )
+        
+        try:
+            # Every diagnosis is a trace of its own
+            with self.tracer.trace("diagnosis", query=user_query) as self.trace_span:
+                async with asyncio.timeout_at(deadline):
+                    return await self._run_diagnosis(user_query, queried_issue, reference_books, speculative)
+        except (asyncio.CancelledError, TimeoutError):
+            print("[Deadline] Diagnosis cancelled or out of time, cancelling in-flight work")
+            await self.cancel()
+            raise
+
+    async def _run_diagnosis(self, user_query: str, queried_issue: Dict, reference_books: List[str], speculative: Optional[bool] = None):
         # Overall start time
         total_start_time = datetime.now()
         print(f"[Time Statistics] Diagnosis process start: {total_start_time}")
         
-        # 1. Planning Stage
-        plan_start_time = datetime.now()
-        print(f"[Time Statistics] Planning phase start: {plan_start_time}")
-        
-        planning_msg = planning_msg_template.format(
-            planner_role_description=planner_role_description,
-            user_query=user_query,
-            background=background
-        )
-        
-        response = await self.agents["planner"].on_messages(
-            [TextMessage(content=planning_msg, source="user")],
-            cancellation_token=CancellationToken(),
-        )
-        await self.print_llm_response("planner", response)
-        diagnosis_plan = response.chat_message.content
-        if hasattr(response, 'chat_message') and response.chat_message:
-            if hasattr(response.chat_message, 'models_usage'):
-                prompt_tokens = getattr(response.chat_message.models_usage, 'prompt_tokens', 0)
-                completion_tokens = getattr(response.chat_message.models_usage, 'completion_tokens', 0)
-                
-                self.token_usage["planner"]["prompt"] += prompt_tokens
-                self.token_usage["planner"]["completion"] += completion_tokens
-                self.token_usage["planner"]["total"] += prompt_tokens + completion_tokens
-                
-                self.token_usage["total"]["prompt"] += prompt_tokens
-                self.token_usage["total"]["completion"] += completion_tokens
-                self.token_usage["total"]["total"] += prompt_tokens + completion_tokens
-                
-                print(f"[Token Statistics] planner: prompt={prompt_tokens}, completion={completion_tokens}, current total={self.token_usage['investigator']['total']}")     
-        
-        
-        plan_end_time = datetime.now()
-        plan_time = plan_end_time - plan_start_time
-        self.timing["plan"] = plan_time
-        print(f"[Time Statistics] Planning phase end: {plan_end_time}, time used: {plan_time}")
-        
-        investigation_msg = investigation_msg_template.format(
-            user_query=user_query,
-            diagnosis_plan=diagnosis_plan
-        )
+        # 0. Parse the diagnosis window once, every stage receives the same values
+        dataset = next((name for name, prompt_type in PROMPT_TYPES.items() if prompt_type == self.prompt_type), None)
+        self.query_window = parse_query(user_query, dataset=dataset)
+        # Pick the prompt set from the query unless the workflow was created for a dataset
+        await self.load_prompt_set(self.query_window.prompt_type if self.query_window else DEFAULT_PROMPT_TYPE)
+        # Long-term memory of this dataset, without past diagnoses of the same window
+        self.memory_scope.dataset = next((name for name, prompt_type in PROMPT_TYPES.items() if prompt_type == self.prompt_type), None)
+        self.memory_scope.window = self.query_window.describe() if self.query_window else None
+        # A workflow can answer several queries, each one starts from empty agent contexts
+        for agent in self.agents.values():
+            if isinstance(agent, AssistantAgent):
+                await agent.on_reset(self.cancellation_token)
+        for agent_type, coder_class in (("metric_coder", MetricCoder), ("log_coder", LogCoder), ("trace_coder", TraceCoder)):
+            coder = await self.runtime.try_get_underlying_agent_instance(AgentId(agent_type, "default"), coder_class)
+            coder.reset()
+        if self.query_window is not None:
+            print(f"[Query] {self.query_window.to_dict()}")
+        else:
+            print("[Query] Diagnosis window not recognised in the query")
+        window_msg = self.format_diagnosis_window()
         
-        diagnosis_events = await self.run_investigation(investigation_msg)
+        # 1-2. Planning and investigation, skipped if the failure window has been investigated
+        # for an earlier query about the same incident
+        cached = self.investigation_cache.get(self.query_window) if self.investigation_cache is not None else None
+        if cached is not None:
+            print(f"[Cache] Reusing the investigation of {self.query_window.describe()} "
+                  f"({len(cached.investigation_results)} results) from the query: {cached.query}")
+            self.tracer.event("investigation cache", decision="hit", results=len(cached.investigation_results))
+            cached.restore_notebooks(self.coder_notebook, self.explorer_notebook)
+            diagnosis_plan = cached.diagnosis_plan
+            diagnosis_events = cached.investigation_results
+            self.timing["plan"] = self.timing["investigate"] = timedelta()
+        else:
+            diagnosis_plan, diagnosis_events, complete = await self.plan_and_investigate(user_query, window_msg, speculative)
+            if complete and self.investigation_cache is not None and self.query_window is not None:
+                window = self.query_window
+                self.investigation_cache.put(InvestigationEntry(
+                    dataset=window.dataset,
+                    system=window.system,
+                    start=window.start,
+                    end=window.end,
+                    query=user_query,
+                    diagnosis_plan=diagnosis_plan,
+                    investigation_results=diagnosis_events,
+                    coder_notebook=snapshot_notebook(self.coder_notebook),
+                    explorer_notebook=snapshot_notebook(self.explorer_notebook),
+                ))
         
         # 3. Reasoning Stage
         reason_start_time = datetime.now()
         print(f"[Time Statistics] Reasoning phase start: {reason_start_time}")
         
-        reasoning_msg = reasoning_msg_template.format(
-            user_query=user_query,
-            queried_issue=queried_issue,
-            diagnosis_plan=diagnosis_plan,
-            diagnosis_events=diagnosis_events
-        )
+        if cached is not None:
+            # Tailored to the elements this query asks for
+            reasoning_msg = cached_reasoning_msg_template.format(
+                user_query=user_query + window_msg,
+                queried_issue=queried_issue,
+                diagnosis_plan=diagnosis_plan,
+                diagnosis_events=diagnosis_events,
+                cached_query=cached.query,
+                targets=format_targets(self.query_window.targets),
+            )
+        else:
+            reasoning_msg = reasoning_msg_template.format(
+                user_query=user_query + window_msg,
+                queried_issue=queried_issue,
+                diagnosis_plan=diagnosis_plan,
+                diagnosis_events=diagnosis_events
+            )
         
-        response = await self.agents["reasoner"].on_messages(
-            [TextMessage(content=reasoning_msg, source="investigator")],
-            cancellation_token=CancellationToken(),
-        )
-        # Increase LLM call count and token statistics - reasoner
-        self.llm_call_count["reasoner"] += 1
-        self.llm_call_count["total"] += 1
-        
-        # Check if token statistics exist
-        if hasattr(response, 'chat_message') and response.chat_message:
-            if hasattr(response.chat_message, 'models_usage'):
-                prompt_tokens = getattr(response.chat_message.models_usage, 'prompt_tokens', 0)
-                completion_tokens = getattr(response.chat_message.models_usage, 'completion_tokens', 0)
-                
-                self.token_usage["reasoner"]["prompt"] += prompt_tokens
-                self.token_usage["reasoner"]["completion"] += completion_tokens
-                self.token_usage["reasoner"]["total"] += prompt_tokens + completion_tokens
-                
-                self.token_usage["total"]["prompt"] += prompt_tokens
-                self.token_usage["total"]["completion"] += completion_tokens
-                self.token_usage["total"]["total"] += prompt_tokens + completion_tokens
-                
-                print(f"[Token Statistics] reasoner: prompt={prompt_tokens}, completion={completion_tokens}, current total={self.token_usage['reasoner']['total']}")
+        with self.budget.measure("reason"), self.tracer.span("reason", "phase"):
+            response = await self.ask_agent(
+                "reasoner",
+                [TextMessage(content=reasoning_msg, source="investigator")],
+            )
         
         await self.print_llm_response("reasoner", response)
         root_cause = response.chat_message.content
         
+        # Later diagnoses retrieve the outcome of this one from long-term memory
+        if self.record_memory:
+            answer = re.search(r"```json\n(.*)\n```", root_cause, re.S)
+            record_diagnosis(
+                user_query,
+                answer.group(1).strip() if answer else root_cause,
+                window=self.memory_scope.window,
+                dataset=self.memory_scope.dataset,
+            )
+        
         reason_end_time = datetime.now()
         reason_time = reason_end_time - reason_start_time
         self.timing["reason"] = reason_time
@@ -711,6 +1051,11 @@ class DiagnosisWorkflow:
                 print(f"  - {agent}: input={usage['prompt']}, output={usage['completion']}, total={usage['total']}")
         print(f"  - Total: input={self.token_usage['total']['prompt']}, output={self.token_usage['total']['completion']}, total={self.token_usage['total']['total']}")
         
+        # Output trace statistics of this diagnosis
+        print(f"[Trace Statistics] Time by span kind:")
+        for kind, stats in self.tracer.summary(self.trace_span.trace_id).items():
+            print(f"  - {kind}: count={stats['count']}, time={stats['seconds']}s, tokens={stats['tokens']}")
+        
         return {
             "diagnosis_plan": diagnosis_plan,
             "diagnosis_events": diagnosis_events,
@@ -718,6 +1063,210 @@ class DiagnosisWorkflow:
         } 
     
     
+    async def plan_and_investigate(self, user_query: str, window_msg: str, speculative: Optional[bool] = None):
+        """
+        Planning and investigation stages of a diagnosis
+
+        Args:
+            user_query: The user's RCA query
+            window_msg: Formatted diagnosis window, see format_diagnosis_window
+            speculative: Run speculative window scans, defaults to the workflow setting
+
+        Returns:
+            (diagnosis_plan, investigation results, whether the investigation ran to completion)
+        """
+        # Speculation and investigation share a token, so that they can be cut short on their own
+        # when the reasoning stage has to start
+        diagnosis_token = self.cancellation_token
+        investigation_token = self.cancellation_token = self.child_cancellation_token()
+        
+        # The columnar copy of the day is built while the planner is thinking
+        self.columnar_task = asyncio.create_task(self.build_columnar_day())
+        
+        # Speculatively start the standard window scans, hidden behind planning
+        if speculative is None:
+            speculative = self.speculative
+        speculation = self.start_speculative_scans() if speculative else None
+        self.speculation_task = speculation
+        
+        # 1. Planning Stage
+        plan_start_time = datetime.now()
+        print(f"[Time Statistics] Planning phase start: {plan_start_time}")
+        
+        planning_msg = planning_msg_template.format(
+            planner_role_description=planner_role_description,
+            user_query=user_query + window_msg,
+            background=self.background
+        )
+        
+        try:
+            with self.budget.measure("plan"), self.tracer.span("plan", "phase"):
+                async with asyncio.timeout_at(self.budget.planning_deadline()):
+                    response = await self.ask_agent(
+                        "planner",
+                        [TextMessage(content=planning_msg, source="user")],
+                    )
+        except TimeoutError:
+            print("[Budget] Planning exceeded its share of the time budget, using the default diagnosis plan")
+            response = Response(chat_message=TextMessage(content=getattr(self.prompt_module, "diagnosis_plan", ""), source="planner"))
+        await self.print_llm_response("planner", response)
+        diagnosis_plan = response.chat_message.content
+        
+        
+        plan_end_time = datetime.now()
+        plan_time = plan_end_time - plan_start_time
+        self.timing["plan"] = plan_time
+        print(f"[Time Statistics] Planning phase end: {plan_end_time}, time used: {plan_time}")
+        
+        if speculation is not None:
+            self.prune_speculative_scans(diagnosis_plan)
+        
+        investigation_msg = investigation_msg_template.format(
+            user_query=user_query + window_msg,
+            diagnosis_plan=diagnosis_plan
+        )
+        
+        # 2. Investigation Stage, ended early if reasoning would otherwise miss the deadline
+        investigation_start_time = datetime.now()
+        complete = True
+        try:
+            with self.tracer.span("investigate", "phase"):
+                async with asyncio.timeout_at(self.budget.reasoning_deadline()):
+                    diagnosis_events = await self.run_investigation(investigation_msg)
+                    if speculation is not None:
+                        # Scans the investigator never asked for are not used by the reasoner
+                        await speculation
+        except TimeoutError:
+            print(f"[Budget] Investigation stopped to leave time for reasoning, continuing with {len(self.investigation_results)} results")
+            investigation_token.cancel()
+            if speculation is not None:
+                speculation.cancel()
+            await self.stop_runtime()
+            diagnosis_events = self.investigation_results
+            self.timing["investigate"] = datetime.now() - investigation_start_time
+            complete = False
+        finally:
+            self.cancellation_token = diagnosis_token
+            self.speculative_results = {}
+        
+        return diagnosis_plan, diagnosis_events, complete
+
+    async def stream_agent_response(
+        self,
+        agent_name: str,
+        messages: List[TextMessage],
+        stop_when: Optional[Callable[[str], bool]] = None,
+        on_text: Optional[Callable[[str], None]] = None,
+    ) -> Response:
+        """
+        Consume an agent's streamed reply, optionally stopping as soon as it is decisive
+
+        Args:
+            agent_name: Name of the agent in self.agents
+            messages: Messages to send to the agent
+            stop_when: Called with the text received so far, the stream is closed when it returns True
+            on_text: Called with the text received so far after every chunk
+
+        Returns:
+            Response: The agent's final response, or a response carrying the partial text if stopped early
+        """
+        agent = self.agents[agent_name]
+        # Closing the stream early must not cancel the rest of the diagnosis
+        cancellation_token = self.child_cancellation_token()
+        text = ""
+        with self.tracer.span(agent_name, "llm", agent=agent_name, streamed=True) as span:
+            async with aclosing(agent.on_messages_stream(messages, cancellation_token=cancellation_token)) as stream:
+                async for event in stream:
+                    if isinstance(event, Response):
+                        self.record_agent_response(span, agent_name, event)
+                        return event
+                    if isinstance(event, ModelClientStreamingChunkEvent):
+                        text += event.content
+                        if on_text:
+                            on_text(text)
+                        if stop_when and stop_when(text):
+                            break
+            cancellation_token.cancel()
+            print(f"[{agent_name}] Decision parsed from stream, stopped after {len(text)} characters")
+            # The usage chunk only arrives at the end of a stream, estimate the tokens of the call instead
+            prompt = [SystemMessage(content=system_message(self.prompt_module, agent_name))]
+            prompt += await agent.model_context.get_messages()
+            reply = AssistantMessage(content=text, source=agent_name)
+            usage = RequestUsage(prompt_tokens=llm_gateway.estimate_tokens(prompt),
+                                 completion_tokens=llm_gateway.estimate_tokens([reply]))
+            # The agent only records its reply once the stream completes, keep its context consistent
+            await agent.model_context.add_message(reply)
+            response = Response(chat_message=TextMessage(content=text, source=agent_name, models_usage=usage))
+            span.set(stopped_early=True)
+            self.record_agent_response(span, agent_name, response)
+            return response
+
+    async def ask_agent(self, agent_name: str, messages: List[TextMessage], label: Optional[str] = None) -> Response:
+        """
+        Send messages to an agent of this workflow and record the call
+
+        Args:
+            agent_name: Name of the agent in self.agents
+            messages: Messages to send to the agent
+            label: Name of the call in the statistics, e.g. "metric_explorer(Retry)"
+
+        Returns:
+            Response: The agent's response
+        """
+        with self.tracer.span(label or agent_name, "llm", agent=agent_name) as span:
+            response = await self.agents[agent_name].on_messages(messages, cancellation_token=self.cancellation_token)
+            self.record_agent_response(span, agent_name, response, label)
+        return response
+
+    def record_agent_response(self, span, agent_name: str, response: Response, label: Optional[str] = None) -> None:
+        """Count an agent's reply in the LLM call and token statistics and attach its usage to span"""
+        message = response.chat_message
+        prompt_tokens, completion_tokens = self.tracer.record_llm(
+            span, agent_name, getattr(message, "models_usage", None), getattr(message, "content", "")
+        )
+        print(f"[Token Statistics] {label or agent_name}: prompt={prompt_tokens}, completion={completion_tokens}, current total={self.token_usage[agent_name]['total']}")
+
+    def export_trace(self, path: str, format: Optional[str] = None) -> str:
+        """
+        Write the spans of this workflow's diagnoses to a trace file
+
+        Args:
+            path: Output file
+            format: "chrome" or "otlp", by default "otlp" for *.otlp.json files and "chrome" otherwise
+
+        Returns:
+            str: The path written
+        """
+        return self.tracer.export(path, format)
+
+    def child_cancellation_token(self) -> CancellationToken:
+        """Return a token that can be cancelled on its own, and is cancelled with the diagnosis"""
+        token = CancellationToken()
+        self.cancellation_token.add_callback(token.cancel)
+        return token
+
+    async def cancel(self) -> None:
+        """Cancel every in-flight model call, coder and code execution of the current diagnosis"""
+        self.cancellation_token.cancel()
+        if self.speculation_task is not None:
+            self.speculation_task.cancel()
+        if self.columnar_task is not None:
+            # Only stops waiting, the shared build finishes for other diagnoses of the day
+            self.columnar_task.cancel()
+        await self.stop_runtime()
+
+    async def stop_runtime(self) -> None:
+        """Stop the coder runtime, the next tool generation starts it again"""
+        try:
+            await self.runtime.stop()
+        except RuntimeError:
+            # The runtime was not running
+            pass
+
+    def tokens_used(self) -> int:
+        """Tokens used by this workflow so far, including the coders"""
+        return self.tracer.tokens_used()
+
     async def print_llm_response(self, agent_name, response):
         print(f"--------------------------------{agent_name}--------------------------------")
         print(f"[{agent_name}] response:")